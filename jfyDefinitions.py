@@ -125,6 +125,18 @@ ReadCodes = {
     'ReadDescriptionResponseCode': 0xbf
 }
 
+# These Read Codes return information about the inverter itself rather
+# than its current state, so the responses basically never change. We
+# fetch them once after registration and cache them for INVARIANT_TTL
+# seconds (or until we re-register).
+InvariantCodes = [
+    "QueryInverterIdInfo",
+    "ReadSetInfo",
+    "ReadModelInfo",
+    "ReadMasterSlaveLoggerVersion"
+    ]
+
+INVARIANT_TTL = 24 * 60 * 60
 
 
 jfyHeader = [0xa5, 0xa5]
@@ -167,6 +179,194 @@ JFYDivisors = [
 # to muck about with exceptions.
 JFYEmpty = [0, 0, 0, 0, 0, 0]
 
+# How often (in seconds) we poll each inverter. Polls happen on
+# multiples of this on the wall clock, so it should divide evenly into
+# PVOUTPUT_INTERVAL. May be overridden with pollinterval= in [global].
+POLLINTERVAL = 30
+
+# pvoutput.org status interval (in seconds). We send one status per
+# interval, aggregated from the samples taken during it.
+PVOUTPUT_INTERVAL = 5 * 60
+
+# pvoutput.org requests time out after PVOUTPUT_TIMEOUT seconds. The
+# backfill (see jfypvoutput.py) sends PVOUTPUT_BATCHSIZE statuses per
+# request, makes at most PVOUTPUT_QUOTA requests an hour per system,
+# skips statuses more than PVOUTPUT_MAXAGE days old (pvoutput.org
+# refuses them), and waits PVOUTPUT_RETRY seconds after a network
+# error. Donating members may raise the size, quota and age.
+PVOUTPUT_TIMEOUT = 30
+PVOUTPUT_BATCHSIZE = 30
+PVOUTPUT_QUOTA = 60
+PVOUTPUT_MAXAGE = 14
+PVOUTPUT_RETRY = 60
+
+# Default tolerances (in scaled units) for the optional swinging-door
+# compression of logged samples, see jfycompress.py. These may be
+# overridden in the [global] section with tolerance-<field>= entries.
+COMPRESSTOLERANCES = {
+    "temperature": 0.5,
+    "powerGenerated": 10.0,
+    "voltageDC": 2.0,
+    "current": 0.1,
+    "energyGenerated": 10.0,
+    "voltageAC": 2.0
+}
+
+# Even if nothing is changing, persist a sample at least this often
+# (in seconds) so that the logfile shows we were still polling.
+COMPRESSMAXGAP = 15 * 60
+
+# Size (in bytes) of the blocks in the compressed time-series store,
+# see jfytsdb.py
+TSDB_BLOCKSIZE = 4096
+
+# Batching for the SQLite sink, see jfysqlite.py. We insert up to
+# SQLITE_BATCHSIZE samples per transaction, and commit at least every
+# SQLITE_BATCHTIME seconds. If the writer falls more than
+# SQLITE_QUEUELEN samples behind, new samples are dropped.
+SQLITE_BATCHSIZE = 500
+SQLITE_BATCHTIME = 5
+SQLITE_QUEUELEN = 10000
+
+# Where there's no sstored to attach to, usesstore= publishes the stats
+# in a shared memory segment instead; see jfyshm.py. The segment has
+# room for SHM_SLOTS inverters.
+SHM_PATH = "/dev/shm/jfy-stats"
+SHM_SLOTS = 512
+SHM_SERIALLEN = 16
+
+# Per-inverter health tracking. After a failed poll we back off for
+# HEALTH_BACKOFFBASE seconds, doubling with each consecutive failure up
+# to HEALTH_BACKOFFMAX. After HEALTH_OPENAFTER consecutive failures we
+# stop polling altogether and instead try to re-register the inverter
+# every HEALTH_PROBEINTERVAL seconds.
+HEALTH_BACKOFFBASE = 10
+HEALTH_BACKOFFMAX = 300
+HEALTH_OPENAFTER = 6
+HEALTH_PROBEINTERVAL = 300
+
+# Energy integration, see jfyenergy.py. We don't integrate power across
+# gaps of more than ENERGY_MAXGAP seconds between samples, and we
+# trust the inverter's energy counter over our own figure as long as
+# the two agree to within ENERGY_TOLERANCE (as a fraction).
+ENERGY_MAXGAP = 10 * 60
+ENERGY_TOLERANCE = 0.05
+ENERGY_SAVEINTERVAL = 5 * 60
+
+# On-demand profiling, see jfyprofile.py. SIGUSR1 samples every
+# thread's stack each PROFILE_INTERVAL seconds for (at most)
+# PROFILE_WINDOW seconds; SIGUSR2 snapshots the heap, recording
+# TRACEMALLOC_FRAMES frames of each allocation's traceback. Reports
+# list the top PROFILE_TOP entries.
+PROFILE_INTERVAL = 0.01
+PROFILE_WINDOW = 60
+PROFILE_TOP = 30
+TRACEMALLOC_FRAMES = 10
+
+# Logging, see jfylog.py. Each subsystem logs through its own logger,
+# jfy.<subsystem>; its level may be set in the [global] section of the
+# config file with a loglevel-<subsystem>= entry. After LOG_RATEBURST
+# copies of the same warning in LOG_RATEWINDOW seconds, further copies
+# are suppressed until the window ends.
+LOG_SUBSYSTEMS = [
+    "serial",
+    "register",
+    "poll",
+    "logfile",
+    "sstore",
+    "pvoutput",
+    "energy",
+    "sqlite",
+    "monitor",
+    "profile",
+    "http",
+    "fleet",
+    "sinks",
+    "mqtt",
+    "anomaly"
+]
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(threadName)s] " \
+    "%(message)s"
+LOG_RATEWINDOW = 60
+LOG_RATEBURST = 5
+
+# The history API, see jfyhttp.py. It listens on HTTP_ADDR unless
+# httpaddr= is given in [global], keeps the last HTTP_RECENT samples
+# from each inverter in memory, and downsamples each field to at most
+# HTTP_MAXPOINTS points (by default HTTP_DEFAULTPOINTS). Without a
+# start time, queries cover the last HTTP_DEFAULTSPAN seconds.
+HTTP_ADDR = "127.0.0.1"
+HTTP_RECENT = 24 * 60 * 2
+HTTP_MAXPOINTS = 10000
+HTTP_DEFAULTPOINTS = 1000
+HTTP_DEFAULTSPAN = 24 * 60 * 60
+
+# Streaming samples (GET /stream). At most HTTP_STREAMCLIENTS clients
+# may subscribe at once. Each has a buffer of HTTP_STREAMBUFFER
+# samples waiting to be sent; a client which lets its buffer fill, or
+# takes more than HTTP_STREAMTIMEOUT seconds to accept a write, is
+# disconnected. Idle streams get a keepalive comment every
+# HTTP_STREAMKEEPALIVE seconds.
+HTTP_STREAMCLIENTS = 100
+HTTP_STREAMBUFFER = 64
+HTTP_STREAMTIMEOUT = 10
+HTTP_STREAMKEEPALIVE = 15
+
+# Fleet mode, see jfyfleet.py. A serial transfer is tried XFER_TRIES
+# times before we give up on it; fleet workers wait FLEET_TIMEOUT
+# seconds for each response, reading at most FLEET_READSIZE bytes at
+# a time.
+XFER_TRIES = 10
+FLEET_TIMEOUT = 2
+FLEET_READSIZE = 256
+
+# The output pipeline, see jfysinks.py. Each sink has a queue of at
+# most SINK_QUEUELEN samples (sinkqueue= in [global]), and a policy for
+# when it's full, which may be overridden in [global] with
+# sinkpolicy-<sink>= entries. We warn when a sink is writing samples
+# more than SINK_LAGWARN seconds after they were taken, and wait at
+# most SINK_FLUSHTIMEOUT seconds for an inverter's samples to be
+# written when it stops. Spilled samples for an inverter which isn't
+# ready for them yet are tried again every SINK_DRAINRETRY seconds,
+# for up to SINK_HOLDTIME seconds, after which they're dropped: while
+# any are held, every sample for that sink goes through the disk.
+SINK_POLICIES = {
+    "logfile": "spill",
+    "tsdb": "spill",
+    "energy": "spill",
+    "history": "drop-oldest",
+    "stats": "drop-oldest",
+    "pvoutput": "spill",
+    "mqtt": "drop-oldest"
+}
+SINK_QUEUELEN = 1000
+SINK_LAGWARN = 60
+SINK_FLUSHTIMEOUT = 30
+SINK_DRAINRETRY = 5
+SINK_HOLDTIME = 600
+
+# Day file maintenance, see jfylogs.py. Closed days are compressed
+# once they're more than LOG_COMPRESSAFTER days old (compressafter= in
+# [global]), as a gzip member per LOG_GZFRAME seconds of samples.
+# downsampleafter= and retaindays= (both off by default) downsample
+# older days to one sample per LOG_DOWNSAMPLERES seconds (or
+# downsampleres=), and remove the oldest. Each pass over the logfiles
+# starts LOG_MAINTINTERVAL seconds after the last one finished, and
+# pauses for LOG_MAINTPAUSE seconds after each file it changes.
+LOG_COMPRESSAFTER = 1
+LOG_GZFRAME = 60 * 60
+LOG_DOWNSAMPLERES = 5 * 60
+LOG_MAINTINTERVAL = 60 * 60
+LOG_MAINTPAUSE = 0.05
+
+# Reports from jfyanalyze.py. Derating is judged from each inverter's
+# highest power in each ANALYZE_TEMPBIN degree band (of those with at
+# least ANALYZE_MINSAMPLES producing samples): it derates above the
+# band from which it never reaches ANALYZE_DERATEFRACTION of its peak.
+ANALYZE_TEMPBIN = 5
+ANALYZE_MINSAMPLES = 20
+ANALYZE_DERATEFRACTION = 0.95
+
 RESOURCE_SSID_PREFIX = "//:class.app/solar/jfy//:res.inverter/"
 
 STATS = [
@@ -178,8 +378,23 @@ STATS = [
     "voltage-ac"
     ]
 
+# sstored deadbands, in scaled units. We only push a stat to sstored
+# when it has moved by more than this much since the last value we
+# pushed. These may be overridden in the [global] section of the config
+# file with deadband-<stat>= entries.
+STATDEADBANDS = {
+    "temperature": 0.0,
+    "power-generated": 0.0,
+    "voltage-dc": 0.0,
+    "current": 0.0,
+    "energy-generated": 0.0,
+    "voltage-ac": 0.0
+}
+
 # Basic url to connect to for PVOutput.org
 SERVICEURL = "http://pvoutput.org/service/r2/addstatus.jsp"
+# ... and the one for uploading several statuses at once
+BATCHURL = "http://pvoutput.org/service/r2/addbatchstatus.jsp"
 
 
 # sstored only accepts [-a-z]|[A-Z]|[0-9\\/] for class names, so
@@ -192,3 +407,50 @@ charset = set([45, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 65, 66,
                99, 100, 101, 102, 103, 104, 105, 106, 107, 108,
                109, 110, 111, 112, 113, 114, 115, 116, 117, 118,
                119, 120, 121, 122])
+
+# MQTT, see jfymqtt.py. mqtthost= in [global] turns it on; the port,
+# topic prefix and QoS (0 or 1) default to MQTT_PORT, MQTT_TOPIC and
+# MQTT_QOS. Samples are coalesced for MQTT_FLUSHINTERVAL seconds and
+# then sent together; at most MQTT_MAXINFLIGHT QoS 1 messages await
+# acknowledgement, and at most MQTT_QUEUELEN wait to be sent (eg while
+# the broker is unreachable). We ping an idle broker within
+# MQTT_KEEPALIVE seconds, give up on it if it doesn't answer within
+# MQTT_TIMEOUT, and wait at most MQTT_RECONNECTMAX seconds between
+# reconnection attempts. When stopping, we wait MQTT_CLOSETIMEOUT
+# seconds for the broker to acknowledge what we've sent.
+MQTT_PORT = 1883
+MQTT_TOPIC = "jfy"
+MQTT_QOS = 1
+MQTT_FLUSHINTERVAL = 0.5
+MQTT_MAXINFLIGHT = 100
+MQTT_QUEUELEN = 10000
+MQTT_KEEPALIVE = 60
+MQTT_TIMEOUT = 10
+MQTT_RECONNECTMAX = 60
+MQTT_CLOSETIMEOUT = 5
+
+# The site totals, see jfysite.py. A [site] section in the config file
+# publishes them to the outputs as a virtual inverter, whose serial
+# number is SITE_SERIAL unless serial= is given. An inverter which
+# hasn't reported for SITE_STALEPOLLS poll intervals stops counting
+# towards the site's power.
+SITE_SERIAL = "site"
+SITE_STALEPOLLS = 3
+
+# Anomaly detection, see jfyanomaly.py; anomalies= True in [global]
+# turns it on. Each check's baseline is an EWMA with weight
+# ANOMALY_ALPHA (about ANOMALY_ALPHA ** -1 samples), and its level one
+# with ANOMALY_FASTALPHA. After ANOMALY_WARMUP samples, a level more
+# than ANOMALY_DROP (anomalydrop= in [global]) below the baseline, and
+# ANOMALY_SIGMAS of its standard deviations, for ANOMALY_HOLD samples
+# in a row is an anomaly. The peer checks need ANOMALY_MINPEERS other
+# inverters reporting; no check is made while the power (or the
+# peers' mean power) is below ANOMALY_MINPOWER watts.
+ANOMALY_ALPHA = 0.002
+ANOMALY_FASTALPHA = 0.1
+ANOMALY_WARMUP = 100
+ANOMALY_DROP = 0.15
+ANOMALY_SIGMAS = 4
+ANOMALY_HOLD = 10
+ANOMALY_MINPEERS = 2
+ANOMALY_MINPOWER = 100
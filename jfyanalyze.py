@@ -0,0 +1,340 @@
+#! /usr/bin/python3
+
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Reports on each inverter's yield, peak power, temperature derating
+and availability over (part of) a logfile hierarchy.
+
+$ jfyanalyze.py -l /path/to/logfile/hierarchy [-s YYYY-MM-DD]
+      [-e YYYY-MM-DD] [-c cachedir] [-j jobs] [-m] [-J] [serial ...]
+
+    -l /path/to/logfile/hierarchy (logpath/<serial>/YYYY/MM/DD)
+    -s first day to report on (default: the earliest there is)
+    -e last day to report on (default: the latest there is)
+    -c directory for the cache of parsed days (default: .jfyanalyze
+       in the logfile hierarchy)
+    -j number of processes (default: one per CPU)
+    -m also report each inverter's yield by month
+    -J write the report as JSON instead
+
+If serial numbers are given, only those inverters are reported on.
+
+Each day file is parsed once into a NumPy array, which is cached as a
+.npy file and memory-mapped on later runs (until the day file
+changes), and each day is summarised in a pool of processes. Only the
+small per-day summaries come back to be combined, so a whole archive
+takes about as long as the slowest day times the number of days,
+divided by the number of CPUs.
+
+    yield         the day's energyGenerated counter, or the integral
+                  of powerGenerated where the counter is missing
+    vs median     yield relative to the median inverter's
+    peak          the highest powerGenerated, and when
+    availability  the share of the fleet's producing hours (first to
+                  last non-zero power sample of any inverter, each
+                  day) in which this inverter was logging samples no
+                  more than ENERGY_MAXGAP seconds apart
+    derating      the temperature above which the inverter never
+                  reaches ANALYZE_DERATEFRACTION of its peak, from its
+                  highest power in each ANALYZE_TEMPBIN degree band
+
+NumPy is required.
+"""
+
+import concurrent.futures
+import datetime
+import getopt
+import json
+import os
+import statistics
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from jfyDefinitions import (JFYData, ENERGY_MAXGAP, ANALYZE_TEMPBIN,
+                            ANALYZE_DERATEFRACTION, ANALYZE_MINSAMPLES)
+from jfylogs import walk_days, parse_day, GZSUFFIX
+
+
+# Columns of a day's array: epoch seconds, then JFYData
+_SECS = 0
+_TEMP = 1 + JFYData.index("temperature")
+_POWER = 1 + JFYData.index("powerGenerated")
+_ENERGY = 1 + JFYData.index("energyGenerated")
+
+
+def usage():
+    """ Provides the usage statement for the utility """
+    print(__doc__, file=sys.stderr)
+    sys.exit(1)
+
+
+def load_day(path, cachename=None):
+    """
+    Returns a day's samples as an array of (epoch seconds, JFYData
+    values...) rows, memory-mapped from the cache if it's at least as
+    new as the day file.
+    """
+    srcmtime = max([os.stat(name).st_mtime_ns
+                    for name in [path, path + GZSUFFIX]
+                    if os.path.exists(name)])
+    if cachename and os.path.exists(cachename) and \
+       os.stat(cachename).st_mtime_ns >= srcmtime:
+        return numpy.load(cachename, mmap_mode="r")
+
+    tstamps, rows, _bad = parse_day(path)
+    day = numpy.empty((len(tstamps), 1 + len(JFYData)))
+    if tstamps:
+        day[:, _SECS] = tstamps
+        day[:, 1:] = rows
+    if cachename:
+        with open(cachename + ".tmp", "wb") as cachef:
+            numpy.save(cachef, day)
+        os.replace(cachename + ".tmp", cachename)
+    return day
+
+
+def summarise(day):
+    """
+    Reduces a day's samples to the figures we combine across days.
+    Everything here is a whole-array operation.
+    """
+    if not len(day):
+        return None
+    if numpy.any(numpy.diff(day[:, _SECS]) < 0):
+        # samples appended out of order
+        day = day[numpy.argsort(day[:, _SECS], kind="stable")]
+    secs = day[:, _SECS]
+    power = numpy.nan_to_num(day[:, _POWER])
+    temp = day[:, _TEMP]
+    energy = day[:, _ENERGY]
+
+    gaps = numpy.diff(secs)
+    joined = gaps <= ENERGY_MAXGAP
+    integrated = float(numpy.sum(((power[1:] + power[:-1]) / 2 *
+                                  gaps)[joined]) / 3600)
+    counter = float(numpy.nanmax(energy)) \
+        if numpy.any(~numpy.isnan(energy)) else None
+
+    # the stretches in which we were logging
+    breaks = numpy.nonzero(~joined)[0]
+    starts = secs[numpy.concatenate(([0], breaks + 1))]
+    ends = secs[numpy.concatenate((breaks, [len(secs) - 1]))]
+
+    producing = (power > 0) & ~numpy.isnan(temp)
+    bands = {}
+    if numpy.any(producing):
+        band = numpy.floor(temp[producing] / ANALYZE_TEMPBIN).astype(int)
+        uniq, inverse = numpy.unique(band, return_inverse=True)
+        highest = numpy.zeros(len(uniq))
+        numpy.maximum.at(highest, inverse, power[producing])
+        counts = numpy.bincount(inverse)
+        bands = dict([(int(bnd) * ANALYZE_TEMPBIN, [int(cnt), float(top)])
+                      for bnd, cnt, top in zip(uniq, counts, highest)])
+    prodsecs = secs[power > 0]
+
+    peak = int(numpy.argmax(power))
+    return {
+        "samples": len(secs),
+        "yield": counter if counter else integrated,
+        "counter": counter,
+        "integrated": integrated,
+        "peak": [float(power[peak]), float(secs[peak])],
+        "bands": bands,
+        "runs": [[float(start), float(end)]
+                 for start, end in zip(starts, ends)],
+        "producing": [float(prodsecs[0]), float(prodsecs[-1])]
+                     if len(prodsecs) else None
+    }
+
+
+def _analyse(args):
+    """ Process pool worker: summarise one day """
+    serial, date, path, cachename = args
+    return serial, date, summarise(load_day(path, cachename))
+
+
+def _covered(runs, start, end):
+    """ Seconds of [start, end] covered by the (start, end) runs """
+    return sum([max(0, min(rend, end) - max(rstart, start))
+                for rstart, rend in runs])
+
+
+def combine(summaries):
+    """
+    Combines the per-day summaries, given as (serial, date, summary),
+    into a report for each inverter.
+    """
+    # the fleet's producing hours each day
+    windows = {}
+    for _serial, date, summ in summaries:
+        if summ and summ["producing"]:
+            first, last = summ["producing"]
+            if date in windows:
+                first = min(first, windows[date][0])
+                last = max(last, windows[date][1])
+            windows[date] = (first, last)
+
+    report = {}
+    for serial, date, summ in summaries:
+        rep = report.setdefault(serial, {
+            "days": 0, "samples": 0, "yield": 0.0, "daily": {},
+            "monthly": {}, "peak": [0.0, None], "bands": {},
+            "window": 0.0, "covered": 0.0})
+        if summ is None:
+            continue
+        rep["days"] += 1
+        rep["samples"] += summ["samples"]
+        rep["yield"] += summ["yield"]
+        rep["daily"][date.isoformat()] = summ["yield"]
+        month = date.strftime("%Y-%m")
+        rep["monthly"][month] = rep["monthly"].get(month, 0.0) + \
+            summ["yield"]
+        if summ["peak"][0] > rep["peak"][0]:
+            rep["peak"] = summ["peak"]
+        for band, (count, top) in summ["bands"].items():
+            old = rep["bands"].get(band, [0, 0.0])
+            rep["bands"][band] = [old[0] + count, max(old[1], top)]
+        if date in windows:
+            first, last = windows[date]
+            rep["window"] += last - first
+            rep["covered"] += _covered(summ["runs"], first, last)
+    # days on which an inverter logged nothing still count against it
+    for serial, rep in report.items():
+        for date, (first, last) in windows.items():
+            if date.isoformat() not in rep["daily"]:
+                rep["window"] += last - first
+
+    median = statistics.median([rep["yield"] for rep in report.values()]) \
+        if report else 0
+    for rep in report.values():
+        rep["vsmedian"] = rep["yield"] / median if median else None
+        rep["availability"] = rep["covered"] / rep["window"] \
+            if rep["window"] else None
+        rep["derating"] = derating(rep["bands"], rep["peak"][0])
+    return report
+
+
+def derating(bands, peak):
+    """
+    Returns (onset, fraction): the lowest temperature band from which
+    the inverter never again reaches ANALYZE_DERATEFRACTION of its
+    peak, and the fraction of peak it manages in the hottest band. Both
+    are None if it doesn't derate.
+    """
+    populated = sorted([(band, top) for band, (count, top) in bands.items()
+                        if count >= ANALYZE_MINSAMPLES])
+    onset = None
+    for band, top in reversed(populated):
+        if top >= ANALYZE_DERATEFRACTION * peak:
+            break
+        onset = band
+    if onset is None or not peak:
+        return None, None
+    return onset, populated[-1][1] / peak
+
+
+def print_report(report, monthly):
+    """ Prints the report as a table """
+    print("{0:<12} {1:>5} {2:>10} {3:>8} {4:>7} {5:>8} {6:<16} {7:>6}  "
+          "{8}".format("serial", "days", "yield kWh", "kWh/day", "vs med",
+                       "peak W", "peak at", "avail", "derating"))
+    for serial in sorted(report):
+        rep = report[serial]
+        when = datetime.datetime.fromtimestamp(rep["peak"][1]).strftime(
+            "%Y-%m-%d %H:%M") if rep["peak"][1] else "-"
+        onset, fraction = rep["derating"]
+        print("{0:<12} {1:>5} {2:>10.1f} {3:>8.2f} {4:>7} {5:>8.0f} "
+              "{6:<16} {7:>6}  {8}".format(
+                  serial, rep["days"], rep["yield"] / 1000,
+                  rep["yield"] / 1000 / max(rep["days"], 1),
+                  "{0:.0%}".format(rep["vsmedian"])
+                  if rep["vsmedian"] is not None else "-",
+                  rep["peak"][0], when,
+                  "{0:.1%}".format(rep["availability"])
+                  if rep["availability"] is not None else "-",
+                  "above {0}C: {1:.0%} of peak".format(onset, fraction)
+                  if onset is not None else "none"))
+    if not monthly:
+        return
+    months = sorted(set([month for rep in report.values()
+                         for month in rep["monthly"]]))
+    print()
+    print("{0:<12} ".format("kWh") +
+          " ".join(["{0:>8}".format(month) for month in months]))
+    for serial in sorted(report):
+        print("{0:<12} ".format(serial) + " ".join(
+            ["{0:>8.1f}".format(report[serial]["monthly"].get(month, 0) /
+                                1000) for month in months]))
+
+
+def main():
+    """ The utility proper starts here """
+    try:
+        lopts, serials = getopt.getopt(sys.argv[1:], "l:s:e:c:j:mJ")
+    except getopt.GetoptError:
+        usage()
+    dopts = dict(lopts)
+    if "-l" not in dopts:
+        usage()
+    if numpy is None:
+        print("jfyanalyze.py needs NumPy", file=sys.stderr)
+        sys.exit(1)
+    logpath = dopts["-l"]
+    try:
+        first = datetime.date.fromisoformat(dopts["-s"]) \
+            if "-s" in dopts else datetime.date.min
+        last = datetime.date.fromisoformat(dopts["-e"]) \
+            if "-e" in dopts else datetime.date.max
+    except ValueError:
+        usage()
+    cachedir = dopts.get("-c", os.path.join(logpath, ".jfyanalyze"))
+    os.makedirs(cachedir, exist_ok=True)
+    jobs = int(dopts["-j"]) if "-j" in dopts else None
+
+    todo = [(serial, date, path, os.path.join(
+        cachedir, "{0}-{1}.npy".format(serial, date.strftime("%Y%m%d"))))
+            for serial, date, path in walk_days(logpath, serials)
+            if first <= date <= last]
+    started = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        summaries = list(pool.map(_analyse, todo, chunksize=16))
+    report = combine(summaries)
+    print("Analysed {0} day files in {1:.1f}s".format(
+        len(todo), time.monotonic() - started), file=sys.stderr)
+
+    if "-J" in dopts:
+        for rep in report.values():
+            del rep["daily"]
+            rep["bands"] = dict([(str(band), val)
+                                 for band, val in rep["bands"].items()])
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_report(report, "-m" in dopts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Notices an inverter, or the PV string feeding it, producing less than
+it usually does compared with its peers.
+
+Each check follows one ratio per inverter:
+
+    power       its AC power over the mean of the other inverters'
+    voltageDC   its string voltage over the others' mean
+    current     its string current over the others' mean
+    conversion  its AC power over its DC power (V * I), which needs
+                no peers
+
+The peer checks compare each inverter's sample with the other
+inverters' samples for the same poll slot, so they run one slot
+behind, and only with at least ANOMALY_MINPEERS others reporting. The
+ratios don't need the inverters to be alike: each check learns what
+is usual for its inverter, as exponentially weighted moving averages,
+so the state per inverter is a few numbers however long we run, and
+each sample costs a handful of arithmetic operations.
+
+A check keeps two averages of its ratio: a slow baseline
+(ANOMALY_ALPHA), with its variance, and a fast level (ANOMALY_FASTALPHA)
+which smooths over passing clouds. Once the baseline has seen
+ANOMALY_WARMUP samples, a fast level more than ANOMALY_DROP below it,
+and further below it than ANOMALY_SIGMAS standard deviations of the
+fast level, for ANOMALY_HOLD samples in a row raises an event; it
+clears once the fast level recovers to within half of ANOMALY_DROP.
+The baseline stops learning while the level is low, so it doesn't come
+to think the fault is usual. Nothing is judged while the light is too
+poor for the ratios to mean much (below ANOMALY_MINPOWER watts).
+
+Events are dicts of serial, tstamp (epoch seconds), check, state
+("raised" or "cleared") and ratio (the fast level as a fraction of the
+baseline), handed to the callback outside our lock.
+"""
+
+import math
+import threading
+
+from jfyDefinitions import (JFYDivisors, ANOMALY_ALPHA, ANOMALY_FASTALPHA,
+                            ANOMALY_WARMUP, ANOMALY_SIGMAS,
+                            ANOMALY_HOLD, ANOMALY_MINPEERS, ANOMALY_MINPOWER)
+
+
+# The fields compared with the peers, and the checks they feed
+_PEERED = ["powerGenerated", "voltageDC", "current"]
+_CHECKS = {"powerGenerated": "power", "voltageDC": "voltageDC",
+           "current": "current"}
+
+# A fast EWMA's standard deviation, as a fraction of the samples'
+_FASTSCALE = math.sqrt(ANOMALY_FASTALPHA / (2 - ANOMALY_FASTALPHA))
+
+# ANOMALY_MINPOWER in the inverter's unscaled units
+_MINPOWER = ANOMALY_MINPOWER * JFYDivisors[1]
+
+
+class Check():
+    """ The moving averages of one ratio for one inverter """
+
+    __slots__ = ["mean", "var", "count", "level", "low", "raised"]
+
+    def __init__(self):
+        self.mean = 0.0          # the slow baseline
+        self.var = 0.0
+        self.count = 0           # samples in the baseline
+        self.level = None        # the fast level
+        self.low = 0             # consecutive samples below the threshold
+        self.raised = False
+
+    def update(self, ratio, drop):
+        """
+        Adds a ratio, returning "raised" or "cleared" if the check's
+        state has changed, or None.
+        """
+        if self.level is None:
+            self.level = ratio
+        else:
+            self.level += ANOMALY_FASTALPHA * (ratio - self.level)
+        if self.count >= ANOMALY_WARMUP:
+            deficit = self.mean - self.level
+            if self.raised:
+                if deficit <= self.mean * drop / 2:
+                    self.raised = False
+                    self.low = 0
+                    return "cleared"
+                return None
+            if deficit > self.mean * drop and \
+               deficit > ANOMALY_SIGMAS * _FASTSCALE * math.sqrt(self.var):
+                self.low += 1
+                if self.low >= ANOMALY_HOLD:
+                    self.raised = True
+                    return "raised"
+                return None
+            self.low = 0
+        # the incremental, exponentially weighted mean and variance
+        alpha = max(ANOMALY_ALPHA, 1.0 / (self.count + 1))
+        diff = ratio - self.mean
+        incr = alpha * diff
+        self.mean += incr
+        self.var = (1 - alpha) * (self.var + diff * incr)
+        self.count += 1
+        return None
+
+    def ratio(self):
+        """ The fast level as a fraction of the baseline """
+        return self.level / self.mean if self.mean else 0.0
+
+
+class AnomalyDetector():
+    """ Runs the checks on every sample from every inverter """
+
+    def __init__(self, settings, notify):
+        self.settings = dict(settings)
+        self.drop = settings["drop"]
+        self.notify = notify     # called with each event
+        self.checks = {}         # serial -> {check name -> Check}
+        self.last = {}           # serial -> (secs, values) last added
+        self.slot = None         # epoch seconds of the slot we're filling
+        self.sums = dict.fromkeys(_PEERED, 0)
+        self.count = 0
+        self.prevslot = None     # the slot before, complete
+        self.prevsums = dict.fromkeys(_PEERED, 0)
+        self.prevcount = 0
+        self.lock = threading.Lock()
+
+    def forget(self, serial):
+        """ Drops the state for an inverter which has stopped """
+        with self.lock:
+            self.checks.pop(serial, None)
+            self.last.pop(serial, None)
+
+    def _check(self, serial, tstamp, name, ratio, events):
+        """ Updates one check, noting the event if it changes state """
+        checks = self.checks.setdefault(serial, {})
+        check = checks.get(name)
+        if check is None:
+            check = checks[name] = Check()
+        state = check.update(ratio, self.drop)
+        if state:
+            events.append({"serial": serial, "tstamp": tstamp,
+                           "check": name, "state": state,
+                           "ratio": round(check.ratio(), 3)})
+
+    def add(self, serial, tstamp, stats):
+        """ Adds a datetime-stamped sample of (unscaled) stats """
+        secs = tstamp.timestamp()
+        events = []
+        with self.lock:
+            if self.slot is None or secs > self.slot:
+                if self.slot is not None:
+                    self.prevslot = self.slot
+                    self.prevsums = self.sums
+                    self.prevcount = self.count
+                self.slot = secs
+                self.sums = dict.fromkeys(_PEERED, 0)
+                self.count = 0
+            values = dict([(fname, stats[fname]) for fname in _PEERED])
+
+            # our last sample against the others' in the same slot
+            last = self.last.get(serial)
+            if last is not None and last[0] == self.prevslot and \
+               self.prevcount - 1 >= ANOMALY_MINPEERS:
+                others = self.prevcount - 1
+                peers = dict([(fname, (self.prevsums[fname] -
+                                       last[1][fname]) / others)
+                              for fname in _PEERED])
+                if peers["powerGenerated"] >= _MINPOWER:
+                    for fname in _PEERED:
+                        if peers[fname] > 0:
+                            self._check(serial, last[0], _CHECKS[fname],
+                                        last[1][fname] / peers[fname],
+                                        events)
+
+            # conversion needs nothing but this sample
+            dcpower = stats["voltageDC"] * stats["current"]
+            if stats["powerGenerated"] >= _MINPOWER and dcpower > 0:
+                self._check(serial, secs, "conversion",
+                            stats["powerGenerated"] / dcpower, events)
+
+            if secs == self.slot:
+                for fname in _PEERED:
+                    self.sums[fname] += values[fname]
+                self.count += 1
+                self.last[serial] = (secs, values)
+        for event in events:
+            self.notify(event)
@@ -0,0 +1,314 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Raw serial traffic capture, and reading captures back for replay.
+
+A capture is a pair of files:
+
+  <name>.cap     every byte we transmitted or received, in order, just
+                 as an external sniffer would have recorded it, so that
+                 parse-jfy-dump.py can read it
+  <name>.cap.ts  a header line, then one line per transfer:
+                 <monotonic ns> <tx|rx> <offset in .cap> <length>
+
+The header line records the device name, and the wall clock and
+monotonic clock at the start of the capture, so that replay can
+recover the wall-clock time of each transfer.
+
+Captures from external sniffers have no .cap.ts file; we can still
+replay them, but without any timing information.
+
+Any capture (ours or a sniffer's) can be given a sidecar index,
+<name>.cap.idx, so that frame N, or every frame with a given function
+code, can be found without scanning the whole capture again. The
+index is a header (magic, how much of the capture has been scanned,
+and the number of frames) followed by a fixed-size entry per frame:
+its offset and length, the source, destination, control and function
+codes, and flags for the direction and checksum. Captures only ever
+grow, so CaptureIndex just scans the part added since the index was
+last brought up to date.
+"""
+
+import datetime
+import mmap
+import os
+import struct
+import time
+
+from jfyDefinitions import jfyHeader
+
+
+TSSUFFIX = ".ts"
+IDXSUFFIX = ".idx"
+_HDRLEN = 7         # header, src, dest, ctrl, func, datalen
+_TAILLEN = 4        # checksum, ender
+_MAXFRAME = _HDRLEN + 255 + _TAILLEN
+
+# The index header and entries
+_IDXMAGIC = b"JFYIDX1\n"
+# magic, bytes of the capture scanned, frames
+_IDXHEAD = struct.Struct("<8sQQ")
+# offset, length, src, dest, ctrl, func, flags
+_IDXENTRY = struct.Struct("<QHBBBBB")
+IDX_RX = 0x01       # inverter->ap, from the function code
+IDX_CSUMOK = 0x02   # the checksum is right
+
+
+class CaptureTee():
+    """
+    Wraps a serial device, teeing everything written to and read from
+    it into a capture.
+    """
+
+    def __init__(self, dev, devname, capname):
+        self.dev = dev
+        self.capfile = open(capname, "ab")
+        self.tsfile = open(capname + TSSUFFIX, "a")
+        self.offset = self.capfile.tell()
+        self.tsfile.write("# jfy-capture devname={0} wall={1} mono={2}\n".
+                          format(devname, time.time(), time.monotonic_ns()))
+        self.tsfile.flush()
+
+    def _record(self, direction, data):
+        """ Appends a transfer to the capture """
+        self.capfile.write(data)
+        self.capfile.flush()
+        self.tsfile.write("{0} {1} {2} {3}\n".format(
+            time.monotonic_ns(), direction, self.offset, len(data)))
+        self.tsfile.flush()
+        self.offset += len(data)
+
+    def write(self, data):
+        """ Writes to the device, capturing what we wrote """
+        self._record("tx", data)
+        return self.dev.write(data)
+
+    def read_until(self, expected=b'\n\r'):
+        """ Reads from the device, capturing what we got back """
+        data = self.dev.read_until(expected=expected)
+        if data:
+            self._record("rx", data)
+        return data
+
+    def read(self, size=1):
+        """ Reads from the device, capturing what we got back """
+        data = self.dev.read(size)
+        if data:
+            self._record("rx", data)
+        return data
+
+    def close(self):
+        """ Closes the device and the capture """
+        self.dev.close()
+        self.capfile.close()
+        self.tsfile.close()
+
+    def __getattr__(self, name):
+        # Anything else (flush, reset_input_buffer...) goes to the device
+        return getattr(self.dev, name)
+
+
+def capture_name(capturepath, devname):
+    """ Returns a fresh capture name for this device """
+    return os.path.join(capturepath, "{0}-{1}.cap".format(
+        os.path.basename(devname),
+        datetime.datetime.now().strftime("%Y%m%dT%H%M%S")))
+
+
+def scan_frames(data, start=0):
+    """
+    Generator yielding (offset, frame) for each complete packet in a
+    buffer of raw traffic. parse-jfy-dump.py decodes these, so its
+    frame numbers are the index's.
+    """
+    idx = start
+    while idx + _HDRLEN <= len(data):
+        if data[idx] == jfyHeader[0] and data[idx + 1] == jfyHeader[1]:
+            tlen = _HDRLEN + data[idx + 6] + _TAILLEN
+            if idx + tlen <= len(data):
+                yield idx, bytes(data[idx:idx + tlen])
+                idx += tlen
+                continue
+        idx += 1
+
+
+def checksum_ok(frame):
+    """ Does the frame's checksum match its contents? """
+    return 1 + (sum(frame[:-_TAILLEN]) ^ 0xffff) == \
+        struct.unpack("!H", frame[-_TAILLEN:-2])[0]
+
+
+class CaptureIndex():
+    """
+    The sidecar index of a capture, brought up to date when opened.
+    Frames are numbered from 0, in the order parse-jfy-dump.py finds
+    them.
+    """
+
+    def __init__(self, capname):
+        self.capname = capname
+        self.idxname = capname + IDXSUFFIX
+        self.update()
+        self.idxfile = open(self.idxname, "rb")
+        self.count = _IDXHEAD.unpack(self.idxfile.read(_IDXHEAD.size))[2]
+        self.map = None
+        if self.count:
+            self.map = mmap.mmap(self.idxfile.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        self.capfile = open(capname, "rb")
+
+    def __len__(self):
+        return self.count
+
+    def update(self):
+        """ Indexes whatever has been added to the capture """
+        size = os.path.getsize(self.capname)
+        scanned = count = 0
+        try:
+            with open(self.idxname, "rb") as idxf:
+                magic, scanned, count = _IDXHEAD.unpack(
+                    idxf.read(_IDXHEAD.size))
+            if magic != _IDXMAGIC or scanned > size:
+                # not ours, or the capture has been replaced
+                scanned = count = 0
+        except (OSError, struct.error):
+            scanned = count = 0
+        if scanned == size and count:
+            return
+        with open(self.capname, "rb") as capf:
+            capf.seek(scanned)
+            data = capf.read()
+        entries = []
+        end = 0
+        for offset, frame in scan_frames(data):
+            flags = IDX_RX if frame[5] >= 0x50 else 0
+            if checksum_ok(frame):
+                flags |= IDX_CSUMOK
+            entries.append(_IDXENTRY.pack(scanned + offset, len(frame),
+                                          frame[2], frame[3], frame[4],
+                                          frame[5], flags))
+            end = offset + len(frame)
+        # a frame starting in the last _MAXFRAME bytes may be incomplete
+        end = max(end, len(data) - _MAXFRAME + 1, 0)
+        mode = "r+b" if count else "wb"
+        with open(self.idxname, mode) as idxf:
+            # drop anything written after the header was last updated
+            idxf.truncate(_IDXHEAD.size + count * _IDXENTRY.size)
+            idxf.seek(0, os.SEEK_END)
+            idxf.write(b"".join(entries))
+            idxf.seek(0)
+            idxf.write(_IDXHEAD.pack(_IDXMAGIC, scanned + end,
+                                     count + len(entries)))
+
+    def entry(self, num):
+        """
+        Returns frame num's (offset, length, src, dest, ctrl, func,
+        flags) from the index.
+        """
+        if not 0 <= num < self.count:
+            raise IndexError("no frame {0}".format(num))
+        return _IDXENTRY.unpack_from(self.map,
+                                     _IDXHEAD.size + num * _IDXENTRY.size)
+
+    def frame(self, num):
+        """ Returns frame num, read straight from the capture """
+        offset, length = self.entry(num)[:2]
+        self.capfile.seek(offset)
+        return self.capfile.read(length)
+
+    def find(self, ctrl=None, func=None):
+        """ Generator yielding the numbers of the matching frames """
+        if not self.count:
+            return
+        entries = _IDXENTRY.iter_unpack(self.map[_IDXHEAD.size:])
+        for num, entry in enumerate(entries):
+            if (ctrl is None or entry[4] == ctrl) and \
+               (func is None or entry[5] == func):
+                yield num
+
+    def close(self):
+        """ Closes the index and the capture """
+        if self.map:
+            self.map.close()
+        self.idxfile.close()
+        self.capfile.close()
+
+
+def read_header(capname):
+    """
+    Returns the header fields of a capture's .cap.ts file as a dict,
+    or an empty dict if there isn't one.
+    """
+    try:
+        with open(capname + TSSUFFIX) as tsf:
+            line = tsf.readline()
+    except OSError:
+        return {}
+    if not line.startswith("# jfy-capture"):
+        return {}
+    return dict([field.split("=", 1) for field in line.split()[2:]])
+
+
+def read_capture(capname):
+    """
+    Generator yielding (monotonic ns, wall-clock datetime, direction,
+    frame) for each frame in the capture. Without a .cap.ts file the
+    times are None, and the direction comes from the function code.
+    """
+    with open(capname, "rb") as capf:
+        data = capf.read()
+
+    if not os.path.exists(capname + TSSUFFIX):
+        for _offset, frame in scan_frames(data):
+            direction = "tx" if frame[5] < 0x50 else "rx"
+            yield None, None, direction, frame
+        return
+
+    wall = mono = None
+    # A frame may span several reads (fleet workers read whatever has
+    # arrived), so we carry the unparsed tail of each transfer over to
+    # the next one in the same direction.
+    pending = b""
+    pdir = None
+    with open(capname + TSSUFFIX) as tsf:
+        for line in tsf:
+            if line.startswith("#"):
+                # a new header each time the capture was reopened
+                header = dict([field.split("=", 1)
+                               for field in line.split()[2:]])
+                wall = float(header["wall"])
+                mono = int(header["mono"])
+                continue
+            fields = line.split()
+            if len(fields) != 4:
+                continue
+            nsecs, direction = int(fields[0]), fields[1]
+            offset, length = int(fields[2]), int(fields[3])
+            tstamp = datetime.datetime.fromtimestamp(
+                wall + (nsecs - mono) / 1e9)
+            if direction != pdir:
+                pending = b""
+                pdir = direction
+            pending += data[offset:offset + length]
+            consumed = 0
+            for start, frame in scan_frames(pending):
+                consumed = start + len(frame)
+                yield nsecs, tstamp, direction, frame
+            pending = pending[consumed:]
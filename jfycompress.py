@@ -0,0 +1,177 @@
+#! /usr/bin/python3
+
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Swinging-door compression of the samples we write to the logfiles.
+
+Rather than writing every sample, we only persist a sample when the
+line from the last persisted sample can no longer represent every
+sample in between to within the per-field tolerances. Overnight, when
+all the values sit at zero, that means one row at dusk and one every
+COMPRESSMAXGAP seconds until dawn.
+
+The persisted rows are ordinary getline() rows, so anything that reads
+the logfiles still works. reconstruct() interpolates them back out to
+the polling cadence; a gap longer than COMPRESSMAXGAP wasn't written
+by the compressor, so it's an outage and is left as a gap. Run this
+file with a day logfile (compressed or not) as its argument to do so
+from the command line:
+
+$ jfycompress.py [-p period] /path/to/logfile
+"""
+
+import datetime
+import getopt
+import sys
+
+from jfyDefinitions import (JFYData, JFYDivisors, COMPRESSMAXGAP,
+                            POLLINTERVAL)
+from jfylogs import parseline, read_lines, GZSUFFIX
+
+
+class SwingingDoor():
+    """
+    Swinging-door compressor for a stream of JFYData samples. Each
+    call to add() returns the list of (timestamp, stats) samples which
+    should be persisted; that list is usually empty.
+    """
+
+    def __init__(self, tolerances, maxgap=COMPRESSMAXGAP):
+        # tolerances are in scaled units, keyed by JFYData field name
+        self.tolerances = [tolerances[fname] for fname in JFYData]
+        self.maxgap = maxgap
+        self.archived = None     # (timestamp, values) last persisted
+        self.held = None         # (timestamp, values, stats) not persisted
+        self.lower = None        # per-field lowest feasible slope
+        self.upper = None        # per-field highest feasible slope
+
+    def _archive(self, tstamp, values, stats):
+        """ Persist this sample and open the doors again from it """
+        self.archived = (tstamp, values)
+        self.held = None
+        self.lower = [float("-inf")] * len(values)
+        self.upper = [float("inf")] * len(values)
+        return [(tstamp, stats)]
+
+    def _admit(self, tstamp, values):
+        """
+        Narrows the doors to include this sample. Returns False (and
+        leaves the doors alone) if any field's doors have closed.
+        """
+        atime, avals = self.archived
+        delta = (tstamp - atime).total_seconds()
+        if delta <= 0 or delta > self.maxgap:
+            return False
+        lower = []
+        upper = []
+        for idx, val in enumerate(values):
+            tol = self.tolerances[idx]
+            low = max(self.lower[idx], (val - tol - avals[idx]) / delta)
+            high = min(self.upper[idx], (val + tol - avals[idx]) / delta)
+            if low > high:
+                return False
+            lower.append(low)
+            upper.append(high)
+        self.lower = lower
+        self.upper = upper
+        return True
+
+    def add(self, tstamp, stats):
+        """ Feeds in one sample, returns the samples to persist """
+        values = [stats[fname] / JFYDivisors[idx]
+                  for idx, fname in enumerate(JFYData)]
+        if self.archived is None:
+            return self._archive(tstamp, values, stats)
+        if self._admit(tstamp, values):
+            self.held = (tstamp, values, stats)
+            return []
+
+        rval = []
+        if self.held is not None:
+            rval.extend(self._archive(*self.held))
+            if self._admit(tstamp, values):
+                self.held = (tstamp, values, stats)
+                return rval
+        rval.extend(self._archive(tstamp, values, stats))
+        return rval
+
+    def flush(self):
+        """
+        Returns the held sample (if any) so that it can be persisted,
+        eg before the logfile is rotated or closed. The next sample is
+        then persisted unconditionally.
+        """
+        held = self.held
+        self.archived = None
+        self.held = None
+        if held is None:
+            return []
+        return [(held[0], held[2])]
+
+
+def reconstruct(lines, period=POLLINTERVAL, maxgap=COMPRESSMAXGAP):
+    """
+    Generator which interpolates compressed logfile lines back out to
+    one (timestamp, values) pair every period seconds. The compressor
+    writes a line at least every maxgap seconds, so we don't invent
+    samples across a longer gap: nothing was polled then.
+    """
+    prev = None
+    for line in lines:
+        if not line.strip():
+            continue
+        tstamp, values = parseline(line)
+        if prev is not None:
+            ptime, pvals = prev
+            span = (tstamp - ptime).total_seconds()
+            offset = period if span <= maxgap else span
+            while offset < span:
+                frac = offset / span
+                yield (ptime + datetime.timedelta(seconds=offset),
+                       [pval + (val - pval) * frac
+                        for pval, val in zip(pvals, values)])
+                offset += period
+        yield tstamp, values
+        prev = (tstamp, values)
+
+
+def main():
+    """ Writes a reconstructed logfile to stdout """
+    try:
+        lopts, extra = getopt.getopt(sys.argv[1:], "p:")
+    except getopt.GetoptError:
+        lopts, extra = [], []
+    if len(extra) != 1:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    period = int(dict(lopts).get("-p", POLLINTERVAL))
+    path = extra[0]
+    if path.endswith(GZSUFFIX):
+        path = path[:-len(GZSUFFIX)]
+    for tstamp, values in reconstruct(read_lines(path), period):
+        line = datetime.date.strftime(tstamp, "%Y-%m-%dT%H:%M:%S")
+        for val in values:
+            line = line + "," + "{0}".format(val)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
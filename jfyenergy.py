@@ -0,0 +1,180 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Running energy totals for an inverter.
+
+The inverter's energyGenerated counter only has a resolution of 10Wh,
+and occasionally glitches. We integrate powerGenerated over time
+(trapezoidally, one sample at a time) to get our own figure for the
+day, and keep the counter alongside it. If we started partway through
+the day, the counter's first reading tells us what we missed. If the
+inverter restarts, its counter starts again from zero, so what it had
+counted until then is carried over and added to its later readings. The
+day's total is the counter's figure if the two agree to within
+ENERGY_TOLERANCE, and ours if they don't.
+
+Completed days are folded into per-day and per-month totals, and the
+lot is persisted as JSON so that it survives restarts. Looking up a
+day or month total never needs to read a logfile.
+"""
+
+import json
+import os
+
+from jfyDefinitions import JFYDivisors, ENERGY_MAXGAP, ENERGY_TOLERANCE
+
+
+# Resolution of the energyGenerated counter, in Wh
+COUNTER_STEP = 1 / JFYDivisors[4]
+
+
+class EnergyIntegrator():
+    """ Integrates one inverter's power samples into energy totals """
+
+    def __init__(self, statefile=None):
+        self.statefile = statefile
+        self.days = {}           # "YYYY-MM-DD" -> Wh, for completed days
+        self.months = {}         # "YYYY-MM" -> Wh, for completed days
+        self.today = None        # "YYYY-MM-DD" of the current day
+        self.integrated = 0.0    # Wh integrated from power today
+        self.counter = None      # last accepted energyGenerated, in Wh
+        self.counter_base = 0.0  # self.integrated when it was accepted
+        self.counter_reset = 0.0  # Wh counted before the counter restarted
+        self.offset = 0.0        # Wh generated today before we integrated
+        self.last = None         # (epoch seconds, watts) of last sample
+        self.glitches = 0        # counter readings we've rejected
+        if statefile and os.path.exists(statefile):
+            self.load()
+
+    def load(self):
+        """ Restores our state from the statefile """
+        try:
+            with open(self.statefile) as stf:
+                state = json.load(stf)
+        except (OSError, ValueError):
+            return
+        self.days = state.get("days", {})
+        self.months = state.get("months", {})
+        self.today = state.get("today")
+        self.integrated = state.get("integrated", 0.0)
+        self.counter = state.get("counter")
+        self.counter_base = state.get("counter_base", 0.0)
+        self.counter_reset = state.get("counter_reset", 0.0)
+        self.offset = state.get("offset", 0.0)
+        self.last = state.get("last")
+        self.glitches = state.get("glitches", 0)
+
+    def save(self):
+        """ Persists our state, atomically replacing the statefile """
+        if not self.statefile:
+            return
+        state = {
+            "days": self.days,
+            "months": self.months,
+            "today": self.today,
+            "integrated": self.integrated,
+            "counter": self.counter,
+            "counter_base": self.counter_base,
+            "counter_reset": self.counter_reset,
+            "offset": self.offset,
+            "last": self.last,
+            "glitches": self.glitches
+        }
+        tmpname = self.statefile + ".tmp"
+        with open(tmpname, "w") as stf:
+            json.dump(state, stf)
+        os.replace(tmpname, self.statefile)
+
+    def reconciled(self):
+        """ Returns our best figure (in Wh) for today's energy """
+        ours = self.offset + self.integrated
+        if self.counter is None:
+            return ours
+        slack = max(ENERGY_TOLERANCE * ours, 2 * COUNTER_STEP)
+        if abs(self.counter - ours) <= slack:
+            return self.counter
+        return ours
+
+    def close_day(self):
+        """ Folds the current day into the day and month totals """
+        if self.today is None:
+            return
+        total = self.reconciled()
+        # a day may be closed again, eg after the clock steps back
+        month = self.today[:7]
+        self.months[month] = self.months.get(month, 0.0) - \
+            self.days.get(self.today, 0.0) + total
+        self.days[self.today] = total
+        self.today = None
+        self.integrated = 0.0
+        self.counter = None
+        self.counter_base = 0.0
+        self.counter_reset = 0.0
+        self.offset = 0.0
+        self.last = None
+
+    def add(self, tstamp, stats):
+        """ Feeds in a datetime-stamped sample of (unscaled) stats """
+        day = tstamp.strftime("%Y-%m-%d")
+        if day != self.today:
+            self.close_day()
+            self.today = day
+        secs = tstamp.timestamp()
+        watts = stats["powerGenerated"] / JFYDivisors[1]
+        if self.last is not None:
+            delta = secs - self.last[0]
+            # Don't guess across gaps, eg while the inverter was off
+            if 0 < delta <= ENERGY_MAXGAP:
+                self.integrated += (self.last[1] + watts) / 2 * delta / 3600
+        self.last = [secs, watts]
+
+        # The counter should only go up, and by no more than we could
+        # plausibly have generated since the last accepted reading. It
+        # may also go back to (about) zero when the inverter restarts.
+        reading = stats["energyGenerated"] / JFYDivisors[4]
+        limit = 2 * (self.integrated - self.counter_base) + 2 * COUNTER_STEP
+        if self.counter is None:
+            # first reading today
+            self.offset = reading - self.integrated
+        elif reading < self.counter - self.counter_reset and \
+                reading <= limit:
+            # the inverter has restarted; carry on from what it counted
+            self.counter_reset = self.counter
+        counter = self.counter_reset + reading
+        if self.counter is not None and \
+           not self.counter <= counter <= self.counter + limit:
+            self.glitches += 1
+            return
+        self.counter = counter
+        self.counter_base = self.integrated
+
+    def day_total(self, day):
+        """ Returns the energy (Wh) for "YYYY-MM-DD", or None """
+        if day == self.today:
+            return self.reconciled()
+        return self.days.get(day)
+
+    def month_total(self, month):
+        """ Returns the energy (Wh) for "YYYY-MM", or None """
+        total = self.months.get(month)
+        if self.today and self.today.startswith(month):
+            total = (total or 0.0) - self.days.get(self.today, 0.0) + \
+                self.reconciled()
+        return total
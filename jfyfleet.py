@@ -0,0 +1,160 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Fleet mode: a few worker threads driving many serial ports.
+
+Rather than one thread per inverter, each sleeping through its serial
+transfers, a FleetWorker waits on all of its ports at once with
+selectors (epoll on Linux, /dev/poll or poll elsewhere), and on the
+earliest of their deadlines. Whatever a port is doing - waiting for a
+response, or for its next poll - is up to its session, which must
+provide:
+
+    fileno()    the port's file descriptor
+    deadline    time.monotonic() at which expired() should be called
+    readable()  called when the port has data for us
+    expired()   called once the deadline has passed
+    close()     called when the session is removed from the worker
+    finished    True once the session has nothing more to do
+
+A session which raises is logged and removed, so that one misbehaving
+port can't take its worker's other ports down with it.
+"""
+
+import os
+import queue
+import selectors
+import threading
+import time
+
+from jfylog import getlogger
+
+
+LOG = getlogger("fleet")
+
+# How long we'll sleep with nothing due, in case a deadline was missed
+_MAXWAIT = 60
+
+
+class FleetWorker(threading.Thread):
+    """ Drives the sessions it's given from one thread """
+
+    def __init__(self, name):
+        self.selector = selectors.DefaultSelector()
+        self.sessions = {}       # session -> its file descriptor
+        self.pending = queue.SimpleQueue()   # (add or remove, session)
+        self.stopping = threading.Event()
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+        threading.Thread.__init__(self, name=name, daemon=True)
+
+    def __len__(self):
+        return len(self.sessions) + self.pending.qsize()
+
+    def wake(self):
+        """ Interrupts the worker's wait """
+        try:
+            os.write(self.wake_w, b"x")
+        except BlockingIOError:
+            # it's already due to wake up
+            pass
+
+    def add(self, session):
+        """ Starts driving a session """
+        self.pending.put((True, session))
+        self.wake()
+
+    def remove(self, session):
+        """ Stops driving a session, and closes it """
+        self.pending.put((False, session))
+        self.wake()
+
+    def stop(self):
+        """ Closes all the sessions and stops the worker """
+        self.stopping.set()
+        self.wake()
+
+    def _drop(self, session):
+        """ Forgets a session, closing it """
+        fdesc = self.sessions.pop(session, None)
+        if fdesc is not None:
+            self.selector.unregister(fdesc)
+        try:
+            session.close()
+        except Exception:          # pylint: disable=broad-except
+            LOG.exception("Error closing %s", session)
+
+    def _apply_pending(self):
+        """ Adds and removes the sessions we've been asked to """
+        while True:
+            try:
+                adding, session = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            if adding:
+                try:
+                    fdesc = session.fileno()
+                    self.selector.register(fdesc, selectors.EVENT_READ,
+                                           session)
+                except (ValueError, OSError) as exc:
+                    LOG.error("Unable to wait on %s: %s", session, exc)
+                    session.close()
+                    continue
+                self.sessions[session] = fdesc
+            elif session in self.sessions:
+                self._drop(session)
+
+    def _call(self, session, method):
+        """ Calls a session method, dropping the session if it fails """
+        try:
+            method()
+        except Exception:          # pylint: disable=broad-except
+            LOG.exception("Error in %s, dropping it", session)
+            self._drop(session)
+            return
+        if session.finished:
+            self._drop(session)
+
+    def run(self):
+        while not self.stopping.is_set():
+            self._apply_pending()
+            now = time.monotonic()
+            due = min([session.deadline for session in self.sessions],
+                      default=now + _MAXWAIT)
+            for key, _mask in self.selector.select(max(due - now, 0)):
+                if key.data is None:
+                    try:
+                        os.read(self.wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                elif key.data in self.sessions:
+                    self._call(key.data, key.data.readable)
+            now = time.monotonic()
+            for session in list(self.sessions):
+                if session.deadline <= now:
+                    self._call(session, session.expired)
+        self._apply_pending()
+        for session in list(self.sessions):
+            self._drop(session)
+        self.selector.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
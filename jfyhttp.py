@@ -0,0 +1,669 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A small HTTP API for the daemon's history.
+
+    GET /inverters
+        the latest sample from each inverter, what it told us about
+        itself (model, firmware and so on) and its energy (Wh) today
+        and this month (see jfyenergy.py), as JSON
+
+    GET /sinks
+        each output's queue metrics (see jfysinks.py), as JSON
+
+    GET /stream?serial=S,S
+        each new sample as it arrives, as Server-Sent Events
+        serial  the inverters to watch (default: all of them)
+
+    GET /history?serial=S&fields=F,F&start=T&end=T&res=R&ds=D&format=X
+        serial  the inverter (optional if there's only one)
+        fields  JFYData field names (default: all of them)
+        start   epoch seconds or ISO8601 (default: HTTP_DEFAULTSPAN
+                seconds before end)
+        end     epoch seconds or ISO8601 (default: now)
+        res     resolution in seconds; alternatively
+        points  the number of points wanted per field (default
+                HTTP_DEFAULTPOINTS, at most HTTP_MAXPOINTS)
+        ds      lttb (default), minmax or none
+        format  json (default) or csv
+
+Each field is downsampled on its own: lttb picks the points which
+best preserve the shape of the curve (Largest-Triangle-Three-Buckets),
+and minmax keeps the lowest and highest sample in each bucket, so
+spikes are never lost. Samples are reduced to each bucket's extremes
+as they're read (see M4), so a long span never has to fit in memory.
+With ds=none, a query which would return more than HTTP_MAXPOINTS
+points per field is refused. A store we can't read (eg a locked or
+corrupt database) gets a 503.
+
+Queries are answered from the last HTTP_RECENT samples we keep in
+memory when they reach back far enough. Otherwise, the older part
+comes from the time-series store or the SQLite database, whichever the
+inverter is configured to use first, and from the logfiles for
+anything older than the store holds (or without either).
+
+Each streamed sample is a "sample" event whose data is the JSON
+{"serial", "tstamp", "values"} and whose id is its tstamp, so a
+reconnecting browser (which sends Last-Event-ID) is first sent the
+recent samples it missed. A sample is encoded once, however many
+clients are watching, and handed to each client's bounded buffer; the
+client's own thread writes it out, and a client which falls
+HTTP_STREAMBUFFER samples behind is dropped rather than being allowed
+to hold anything else up. Anomalies (see jfyanomaly.py) are streamed
+the same way, as "anomaly" events whose data is the event's JSON.
+"""
+
+import collections
+import datetime
+import http.server
+import itertools
+import json
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+from jfyDefinitions import (JFYData, JFYDivisors, HTTP_RECENT,
+                            HTTP_MAXPOINTS, HTTP_DEFAULTPOINTS,
+                            HTTP_DEFAULTSPAN, HTTP_STREAMCLIENTS,
+                            HTTP_STREAMBUFFER, HTTP_STREAMTIMEOUT,
+                            HTTP_STREAMKEEPALIVE)
+from jfylog import getlogger
+from jfylogs import read_range
+from jfysqlite import earliest, query_rows
+from jfytsdb import TSDBReader
+
+
+LOG = getlogger("http")
+
+
+def encode_event(serial, secs, values):
+    """ Returns a sample as a Server-Sent Event """
+    return "event: sample\nid: {0}\ndata: {1}\n\n".format(secs, json.dumps({
+        "serial": serial,
+        "tstamp": secs,
+        "values": dict(zip(JFYData, [_clean(val) for val in values]))
+    })).encode("utf-8")
+
+
+def encode_anomaly(event):
+    """ Returns an anomaly event as a Server-Sent Event """
+    return "event: anomaly\ndata: {0}\n\n".format(
+        json.dumps(event)).encode("utf-8")
+
+
+class Subscriber():
+    """ One streaming client's filter and buffer of encoded events """
+
+    def __init__(self, serials=None, maxlen=HTTP_STREAMBUFFER):
+        self.serials = serials   # None means all of them
+        self.maxlen = maxlen
+        self.buffer = collections.deque()
+        self.ready = threading.Event()
+        self.evicted = False
+
+    def offer(self, serial, event):
+        """ Queues an event; returns False if we're too far behind """
+        if self.serials is not None and serial not in self.serials:
+            return True
+        if len(self.buffer) >= self.maxlen:
+            return False
+        self.buffer.append(event)
+        self.ready.set()
+        return True
+
+    def evict(self):
+        """ Tells the client's thread to give up """
+        self.evicted = True
+        self.ready.set()
+
+    def wait(self, timeout):
+        """ Returns the events queued, waiting at most timeout seconds """
+        self.ready.wait(timeout)
+        self.ready.clear()
+        events = []
+        while self.buffer:
+            events.append(self.buffer.popleft())
+        return events
+
+
+class Broadcaster():
+    """ Hands each sample, encoded once, to every streaming client """
+
+    def __init__(self, maxclients=HTTP_STREAMCLIENTS):
+        self.maxclients = maxclients
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def subscribe(self, serials=None):
+        """ Returns a new Subscriber, or None if we have too many """
+        with self.lock:
+            if len(self.subscribers) >= self.maxclients:
+                return None
+            sub = Subscriber(serials)
+            self.subscribers = self.subscribers + [sub]
+            return sub
+
+    def unsubscribe(self, sub):
+        """ Forgets a client """
+        with self.lock:
+            self.subscribers = [other for other in self.subscribers
+                                if other is not sub]
+
+    def publish(self, serial, secs, values):
+        """ Sends a sample to everyone watching its inverter """
+        # the list is replaced, never changed, so we needn't hold the lock
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        self._offer(subscribers, serial, encode_event(serial, secs, values))
+
+    def announce(self, event):
+        """ Sends an anomaly event to everyone watching its inverter """
+        subscribers = self.subscribers
+        if subscribers:
+            self._offer(subscribers, event["serial"], encode_anomaly(event))
+
+    def _offer(self, subscribers, serial, event):
+        """ Hands an encoded event to each client, dropping laggards """
+        for sub in subscribers:
+            if not sub.evicted and not sub.offer(serial, event):
+                sub.evict()
+                self.unsubscribe(sub)
+                with self.lock:
+                    self.evicted += 1
+                LOG.info("Dropped a stream client %s samples behind",
+                         sub.maxlen)
+
+    def close(self):
+        """ Disconnects every client """
+        with self.lock:
+            subscribers = self.subscribers
+            self.subscribers = []
+        for sub in subscribers:
+            sub.evict()
+
+
+class History():
+    """ Recent samples from each inverter, and where to find older ones """
+
+    def __init__(self, maxlen=HTTP_RECENT):
+        self.maxlen = maxlen
+        self.recent = {}         # serial -> deque of (secs, values)
+        self.sources = {}        # serial -> on-disk settings
+        self.info = {}           # serial -> Read Code -> invariant text
+        self.energy = {}         # serial -> {"day", "month"} in Wh
+        self.lock = threading.Lock()
+        self.stream = Broadcaster()
+
+    def track(self, serial, inv):
+        """ Notes where this inverter's samples are stored on disk """
+        with self.lock:
+            self.sources[serial] = {
+                "logpath": inv["logpath"],
+                "tsdbpath": inv["tsdbpath"],
+                "sqlitedb": inv["sqlitedb"]
+            }
+
+    def describe(self, serial, invariants):
+        """ Notes an inverter's invariant information, see /inverters """
+        with self.lock:
+            self.info[serial] = dict([(readcode, info["text"]) for
+                                      readcode, info in invariants.items()])
+
+    def tally(self, serial, totals):
+        """ Notes an inverter's latest energy totals, see /inverters """
+        with self.lock:
+            self.energy[serial] = dict(totals)
+
+    def add(self, serial, tstamp, stats):
+        """ Adds a datetime-stamped sample of (unscaled) stats """
+        values = [stats[fname] / JFYDivisors[idx]
+                  for idx, fname in enumerate(JFYData)]
+        secs = tstamp.timestamp()
+        with self.lock:
+            if serial not in self.recent:
+                self.recent[serial] = collections.deque(maxlen=self.maxlen)
+            self.recent[serial].append((secs, values))
+        self.stream.publish(serial, secs, values)
+
+    def serials(self):
+        """ Returns the serial numbers we know about """
+        with self.lock:
+            return sorted(set(self.recent) | set(self.sources))
+
+    def latest(self, serial):
+        """ Returns the most recent (secs, values), or None """
+        with self.lock:
+            recent = self.recent.get(serial)
+            return recent[-1] if recent else None
+
+    def invariants(self, serial):
+        """ Returns an inverter's invariant information, or None """
+        with self.lock:
+            info = self.info.get(serial)
+            return dict(info) if info is not None else None
+
+    def totals(self, serial):
+        """ Returns an inverter's energy totals, or None """
+        with self.lock:
+            totals = self.energy.get(serial)
+            return dict(totals) if totals is not None else None
+
+    def since(self, serial, after):
+        """ Returns the recent (secs, values) later than after """
+        with self.lock:
+            recent = list(self.recent.get(serial, ()))
+        return [sample for sample in recent if sample[0] > after]
+
+    def read_disk(self, serial, start, end):
+        """
+        Returns (sources, samples) for the samples between the start
+        and end epoch seconds, from the time-series store or the
+        SQLite database if we have either, and from the logfiles for
+        any earlier part of the span which the store doesn't hold (eg
+        from before it was set up). samples is an iterator, so a long
+        span is never held in memory.
+        """
+        with self.lock:
+            src = dict(self.sources.get(serial, {}))
+        source = first = None
+        if src.get("tsdbpath"):
+            reader = TSDBReader(src["tsdbpath"])
+            if serial in reader.serials():
+                source = "tsdb"
+                first = reader.earliest(serial)
+        if source is None and src.get("sqlitedb") and \
+           os.path.exists(src["sqlitedb"]):
+            source = "sqlite"
+            first = earliest(src["sqlitedb"], serial)
+
+        sources = []
+        samples = []
+        if src.get("logpath") and (first is None or start < first):
+            sources.append("logfiles")
+            samples.append(read_range(
+                src["logpath"], serial, start,
+                end if first is None else min(end, first - 1)))
+        if first is not None and end >= first:
+            sources.append(source)
+            if source == "tsdb":
+                samples.append(
+                    (tstamp.timestamp(), values) for tstamp, values in
+                    reader.query(serial,
+                                 datetime.datetime.fromtimestamp(start),
+                                 datetime.datetime.fromtimestamp(end)))
+            else:
+                samples.append(query_rows(src["sqlitedb"], serial, start,
+                                          end))
+        return sources, itertools.chain(*samples)
+
+    def query(self, serial, start, end):
+        """
+        Returns (sources, samples) for the samples between the start
+        and end epoch seconds, where samples is an iterator of (secs,
+        values) in time order and sources says where they came from.
+        """
+        with self.lock:
+            recent = list(self.recent.get(serial, ()))
+        memory = [sample for sample in recent if start <= sample[0] <= end]
+        if recent and recent[0][0] <= start:
+            return ["memory"], iter(memory)
+        cutoff = recent[0][0] if recent else end + 1
+        sources, older = self.read_disk(serial, start,
+                                        min(end, cutoff - 1))
+        if memory:
+            sources.append("memory")
+        return sources, itertools.chain(older, memory)
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of (x, y) points to at
+    most threshold points, always keeping the first and last.
+    """
+    if len(points) <= threshold:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:max(threshold, 0)]
+
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    prev = 0
+    for bucket in range(threshold - 2):
+        # the average of the next bucket is the third corner
+        nstart = int((bucket + 1) * every) + 1
+        nend = min(int((bucket + 2) * every) + 1, len(points))
+        nxt = points[nstart:nend]
+        avgx = sum([pnt[0] for pnt in nxt]) / len(nxt)
+        avgy = sum([pnt[1] for pnt in nxt]) / len(nxt)
+
+        prevx, prevy = points[prev]
+        chosen = None
+        best = -1.0
+        for idx in range(int(bucket * every) + 1, nstart):
+            pntx, pnty = points[idx]
+            area = abs((prevx - avgx) * (pnty - prevy) -
+                       (prevx - pntx) * (avgy - prevy))
+            if area > best:
+                best = area
+                chosen = idx
+        sampled.append(points[chosen])
+        prev = chosen
+    sampled.append(points[-1])
+    return sampled
+
+
+def minmax(points, start, end, buckets):
+    """
+    Reduces (x, y) points to the lowest and highest point in each of
+    buckets equal slices of [start, end], in x order.
+    """
+    width = (end - start + 1) / max(buckets, 1)
+    lows = {}
+    highs = {}
+    for pnt in points:
+        slot = int((pnt[0] - start) / width)
+        if slot not in lows or pnt[1] < lows[slot][1]:
+            lows[slot] = pnt
+        if slot not in highs or pnt[1] > highs[slot][1]:
+            highs[slot] = pnt
+    rval = []
+    for slot in sorted(lows):
+        rval.extend(sorted(set([lows[slot], highs[slot]])))
+    return rval
+
+
+class M4():
+    """
+    Reduces a stream of samples, as they're read, to the first, last,
+    lowest and highest point of each column in each of buckets equal
+    slices of [start, end]. A query then costs memory for its buckets
+    rather than its samples, however long its span. minmax() over the
+    points, with buckets a multiple of its own, gives what it would
+    over every sample, and lttb() still sees every extreme.
+    """
+
+    def __init__(self, start, end, buckets, cols):
+        self.start = start
+        self.width = (end - start + 1) / max(buckets, 1)
+        self.cols = cols
+        self.slots = [{} for _col in cols]  # slot -> [first, last, lo, hi]
+        self.count = 0           # samples seen
+
+    def add(self, secs, values):
+        """ Adds a sample; they must arrive in time order """
+        self.count += 1
+        slot = int((secs - self.start) / self.width)
+        for idx, col in enumerate(self.cols):
+            val = values[col]
+            if math.isnan(val):
+                continue
+            pnt = (secs, val)
+            agg = self.slots[idx].get(slot)
+            if agg is None:
+                self.slots[idx][slot] = [pnt, pnt, pnt, pnt]
+                continue
+            agg[1] = pnt
+            if val < agg[2][1]:
+                agg[2] = pnt
+            if val > agg[3][1]:
+                agg[3] = pnt
+
+    def points(self, idx):
+        """ Returns the kept (x, y) points for the idx'th column """
+        rval = []
+        for _slot, agg in sorted(self.slots[idx].items()):
+            rval.extend(sorted(set(agg)))
+        return rval
+
+
+def parse_time(text):
+    """ Returns epoch seconds from epoch seconds or ISO8601 text """
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def _clean(value):
+    """ JSON has no NaN """
+    return None if math.isnan(value) else value
+
+
+class HistoryHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers the requests for /inverters, /sinks, /stream and /history """
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        LOG.debug("%s " + format, self.address_string(), *args)
+
+    def reply(self, code, body, ctype="application/json"):
+        """ Sends a complete response """
+        data = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def error(self, code, message):
+        """ Sends an error as JSON """
+        self.reply(code, json.dumps({"error": message}))
+
+    def do_GET(self):
+        """ Dispatches a GET request """
+        url = urllib.parse.urlsplit(self.path)
+        params = dict([(key, vals[-1]) for key, vals in
+                       urllib.parse.parse_qs(url.query).items()])
+        if url.path == "/inverters":
+            self.inverters()
+        elif url.path == "/sinks" and self.server.metrics:
+            self.reply(200, json.dumps(self.server.metrics()))
+        elif url.path == "/stream":
+            self.stream(params)
+        elif url.path == "/history":
+            try:
+                self.history(params)
+            except ValueError as exc:
+                self.error(400, str(exc))
+            except ConnectionError:
+                # the client went away
+                pass
+            except (OSError, EOFError, sqlite3.Error) as exc:
+                LOG.error("Unable to read the history: %s", exc)
+                self.error(503, "Unable to read the history: {0}".format(
+                    exc))
+        else:
+            self.error(404, "No such resource {0}".format(url.path))
+
+    def inverters(self):
+        """ The latest sample from each inverter """
+        history = self.server.history
+        rval = {}
+        for serial in history.serials():
+            latest = history.latest(serial)
+            info = history.invariants(serial)
+            if latest is None and info is None:
+                rval[serial] = None
+                continue
+            rval[serial] = {"info": info or {}}
+            totals = history.totals(serial)
+            if totals is not None:
+                rval[serial]["energy"] = totals
+            if latest is not None:
+                rval[serial]["tstamp"] = latest[0]
+                rval[serial]["values"] = dict(zip(
+                    JFYData, [_clean(val) for val in latest[1]]))
+        self.reply(200, json.dumps(rval))
+
+    def stream(self, params):
+        """ Streams new samples until the client goes away """
+        history = self.server.history
+        serials = params.get("serial")
+        serials = set(serials.split(",")) if serials else None
+        if serials and not serials <= set(history.serials()):
+            self.error(404, "No such inverter {0}".format(
+                ",".join(sorted(serials - set(history.serials())))))
+            return
+        sub = history.stream.subscribe(serials)
+        if sub is None:
+            self.error(503, "Too many clients are streaming")
+            return
+        try:
+            # a slow reader blocks only this thread, and not for long
+            self.connection.settimeout(HTTP_STREAMTIMEOUT)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(b"retry: 5000\n\n")
+            last = self.headers.get("Last-Event-ID")
+            if last:
+                self.replay(serials, float(last))
+            self.wfile.flush()
+            while not sub.evicted:
+                events = sub.wait(HTTP_STREAMKEEPALIVE)
+                self.wfile.write(b"".join(events) if events else b":\n\n")
+                self.wfile.flush()
+        except (OSError, socket.timeout, ValueError) as exc:
+            LOG.debug("Stream to %s ended: %s", self.address_string(), exc)
+        finally:
+            history.stream.unsubscribe(sub)
+        self.close_connection = True
+
+    def replay(self, serials, after):
+        """ Sends the recent samples a reconnecting client missed """
+        history = self.server.history
+        missed = []
+        for serial in serials or history.serials():
+            missed.extend([(secs, serial, values) for secs, values in
+                           history.since(serial, after)])
+        for secs, serial, values in sorted(missed, key=lambda m: m[0]):
+            self.wfile.write(encode_event(serial, secs, values))
+
+    def history(self, params):
+        """ A range query, downsampled """
+        history = self.server.history
+        serials = history.serials()
+        serial = params.get("serial")
+        if serial is None and len(serials) == 1:
+            serial = serials[0]
+        if serial not in serials:
+            self.error(404, "No such inverter {0}".format(serial))
+            return
+        fields = params.get("fields")
+        fields = fields.split(",") if fields else list(JFYData)
+        for fname in fields:
+            if fname not in JFYData:
+                raise ValueError("No such field {0}".format(fname))
+        end = parse_time(params["end"]) if "end" in params else time.time()
+        start = parse_time(params["start"]) if "start" in params else \
+            end - HTTP_DEFAULTSPAN
+        if start > end:
+            raise ValueError("start is after end")
+        if "res" in params:
+            res = float(params["res"])
+            if not res > 0:
+                raise ValueError("res must be positive")
+            npoints = math.ceil((end - start) / res)
+        else:
+            npoints = int(params.get("points", HTTP_DEFAULTPOINTS))
+        npoints = min(max(npoints, 2), HTTP_MAXPOINTS)
+        method = params.get("ds", "lttb")
+        if method not in ["lttb", "minmax", "none"]:
+            raise ValueError("Unknown downsampling method {0}".format(method))
+        fmt = params.get("format", "json")
+        if fmt not in ["json", "csv"]:
+            raise ValueError("Unknown format {0}".format(fmt))
+
+        sources, samples = history.query(serial, start, end)
+        cols = [JFYData.index(fname) for fname in fields]
+        series = {}
+        if method == "none":
+            kept = []
+            for sample in samples:
+                if len(kept) >= HTTP_MAXPOINTS:
+                    raise ValueError("More than {0} samples is too many "
+                                     "without downsampling".format(
+                                         HTTP_MAXPOINTS))
+                kept.append(sample)
+            nsamples = len(kept)
+            for fname, col in zip(fields, cols):
+                series[fname] = [(secs, values[col]) for secs, values in kept
+                                 if not math.isnan(values[col])]
+        else:
+            # four fine buckets to each of minmax()'s
+            reducer = M4(start, end, 4 * max(npoints // 2, 1), cols)
+            for secs, values in samples:
+                reducer.add(secs, values)
+            nsamples = reducer.count
+            for idx, fname in enumerate(fields):
+                points = reducer.points(idx)
+                if method == "lttb":
+                    points = lttb(points, npoints)
+                else:
+                    points = minmax(points, start, end, npoints // 2)
+                series[fname] = points
+
+        if fmt == "csv":
+            lines = ["field,tstamp,value"]
+            for fname in fields:
+                lines.extend(["{0},{1},{2}".format(fname, secs, val)
+                              for secs, val in series[fname]])
+            self.reply(200, "\n".join(lines) + "\n", "text/csv")
+            return
+        self.reply(200, json.dumps({
+            "serial": serial,
+            "start": start,
+            "end": end,
+            "sources": sources,
+            "samples": nsamples,
+            "downsample": method,
+            "fields": dict([(fname, [[secs, val] for secs, val in points])
+                            for fname, points in series.items()])
+        }))
+
+
+class HistoryServer(threading.Thread):
+    """ Serves the history API from its own threads """
+
+    def __init__(self, history, addr, port, metrics=None):
+        self.addr = (addr, port)
+        self.httpd = http.server.ThreadingHTTPServer((addr, port),
+                                                     HistoryHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.history = history
+        self.httpd.metrics = metrics
+        threading.Thread.__init__(self, name="http", daemon=True)
+
+    def run(self):
+        LOG.info("Serving history on %s:%s", *self.httpd.server_address[:2])
+        self.httpd.serve_forever()
+
+    def close(self):
+        """ Stops serving """
+        self.httpd.history.stream.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,167 @@
+#! /usr/bin/python3
+
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Bulk-loads an existing logfile hierarchy into the SQLite database
+and/or the compressed time-series store.
+
+$ jfyimport.py -l /path/to/logfile/hierarchy [-s sqlitedb] [-t tsdbpath]
+      [-p progressfile] [-j jobs] [-c column,column,...] [serial ...]
+
+    -l /path/to/logfile/hierarchy (logpath/<serial>/YYYY/MM/DD)
+    -s SQLite database to load into
+    -t time-series store directory to load into
+    -p file recording which day files have been loaded; if the
+       import is interrupted, rerunning it skips those files
+       (default: .jfyimport in the logfile hierarchy)
+    -j number of parser processes (default: one per CPU)
+    -c the JFYData field name in each column after the timestamp,
+       for day files written in a different order (eg by solarmonj)
+
+If serial numbers are given, only those inverters are imported.
+Day files are parsed in parallel; all the writing is done from this
+process, in date order for each inverter.
+"""
+
+import collections
+import concurrent.futures
+import getopt
+import os
+import sys
+import time
+
+from jfylogs import walk_days, parse_day
+from jfysqlite import connect, insert_rows
+from jfytsdb import TSDBWriter
+
+
+def usage():
+    """ Provides the usage statement for the utility """
+    print(__doc__, file=sys.stderr)
+    sys.exit(1)
+
+
+def load_progress(progname):
+    """ Returns the set of day files we've already imported """
+    if not os.path.exists(progname):
+        return set()
+    with open(progname) as progf:
+        return set(progf.read().splitlines())
+
+
+def _parse(args):
+    """ Process pool worker: parse one day file """
+    serial, path, columns = args
+    tstamps, rows, bad = parse_day(path, columns)
+    return serial, path, tstamps, rows, bad
+
+
+def _inorder(pool, func, items, window):
+    """
+    Generator yielding func(item) for each item, in order, from the
+    pool, with no more than window of them in flight at once: unlike
+    pool.map(), which submits them all up front, this never holds more
+    than window parsed days however far ahead of us the workers get.
+    """
+    items = iter(items)
+    inflight = collections.deque()
+    for item in items:
+        inflight.append(pool.submit(func, item))
+        if len(inflight) >= window:
+            break
+    while inflight:
+        result = inflight.popleft().result()
+        for item in items:
+            inflight.append(pool.submit(func, item))
+            break
+        yield result
+
+
+def main():
+    """ The utility proper starts here """
+    try:
+        lopts, serials = getopt.getopt(sys.argv[1:], "l:s:t:p:j:c:")
+    except getopt.GetoptError:
+        usage()
+    dopts = dict(lopts)
+    if "-l" not in dopts or ("-s" not in dopts and "-t" not in dopts):
+        usage()
+    logpath = dopts["-l"]
+    progname = dopts.get("-p", os.path.join(logpath, ".jfyimport"))
+    jobs = int(dopts["-j"]) if "-j" in dopts else os.cpu_count() or 1
+    columns = dopts["-c"].split(",") if "-c" in dopts else None
+
+    done = load_progress(progname)
+    todo = [(serial, path, columns)
+            for serial, _date, path in walk_days(logpath, serials)
+            if path not in done]
+    print("{0} day files to import ({1} already done)".format(
+        len(todo), len(done)), file=sys.stderr)
+
+    conn = connect(dopts["-s"]) if "-s" in dopts else None
+    tsdbs = {}
+    nfiles = nrows = nbad = 0
+    started = time.monotonic()
+    with open(progname, "a") as progf, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        # _inorder() hands back results in submission order, which
+        # keeps each inverter's samples in date order for the
+        # time-series store, with a couple of files queued per worker
+        for serial, path, tstamps, rows, bad in _inorder(pool, _parse, todo,
+                                                         2 * jobs):
+            if conn:
+                insert_rows(conn, [[serial, tstamp] + row
+                                   for tstamp, row in zip(tstamps, rows)])
+            if "-t" in dopts:
+                if serial not in tsdbs:
+                    tsdbs[serial] = TSDBWriter(dopts["-t"], serial)
+                writer = tsdbs[serial]
+                for tstamp, row in zip(tstamps, rows):
+                    if writer.last is None or tstamp > writer.last:
+                        writer.append_values(tstamp, row)
+                # Seal the day so that the progress file never gets
+                # ahead of what's on disk
+                writer.flush()
+            progf.write(path + "\n")
+            progf.flush()
+            nfiles += 1
+            nrows += len(rows)
+            nbad += bad
+            if bad:
+                print("{0}: skipped {1} unparseable lines".format(path, bad),
+                      file=sys.stderr)
+            if nfiles % 100 == 0:
+                print("{0}/{1} files, {2} samples, {3:.0f}s".format(
+                    nfiles, len(todo), nrows, time.monotonic() - started),
+                      file=sys.stderr)
+
+    for writer in tsdbs.values():
+        writer.close()
+    if conn:
+        conn.close()
+    print("Imported {0} samples from {1} files in {2:.0f}s "
+          "({3} lines skipped)".format(nrows, nfiles,
+                                       time.monotonic() - started, nbad),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
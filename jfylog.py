@@ -0,0 +1,157 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Logging for the daemon.
+
+Each subsystem (see LOG_SUBSYSTEMS) logs through its own logger,
+jfy.<subsystem>, so that eg the per-packet serial dumps can be turned
+on without everything else:
+
+    [global]
+    loglevel-serial= DEBUG
+
+The polling threads never write to stderr themselves. A record is put
+on a queue (after the rate limiter has had its say), and one listener
+thread does all the writing, so a slow stderr can't hold up the serial
+loop and lines from different threads can't interleave. Records below
+a logger's level cost no more than the level check, since we pass the
+arguments through rather than formatting the message up front.
+
+Until start_logging() is called, warnings and errors still go to
+stderr via the logging module's last resort handler.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+from jfyDefinitions import (LOG_SUBSYSTEMS, LOG_FORMAT, LOG_RATEWINDOW,
+                            LOG_RATEBURST)
+
+
+LOGGER = "jfy"
+
+_LISTENER = None
+
+
+def getlogger(subsystem):
+    """ Returns the logger for this subsystem """
+    return logging.getLogger(LOGGER + "." + subsystem)
+
+
+class RateLimit(logging.Filter):
+    """
+    Passes at most LOG_RATEBURST copies of each warning or error (by
+    logger and format string) per LOG_RATEWINDOW seconds. The first
+    copy after a window in which some were suppressed says how many.
+    Debug and info messages have been asked for, so they all pass.
+    """
+
+    def __init__(self, window=LOG_RATEWINDOW, burst=LOG_RATEBURST):
+        logging.Filter.__init__(self)
+        self.window = window
+        self.burst = burst
+        self.seen = {}           # (name, msg) -> [window start, count]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                suppressed = 0
+                if entry is not None:
+                    suppressed = max(entry[1] - self.burst, 0)
+                self.seen[key] = [now, 1]
+            else:
+                entry[1] += 1
+                return entry[1] <= self.burst
+        if suppressed:
+            record.msg = "{0} ({1} similar messages suppressed)".format(
+                record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+def parse_level(name):
+    """ Returns the numeric level for a level name, eg from the config """
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level {0}".format(name))
+    return level
+
+
+def set_levels(debug, levels=None):
+    """
+    Sets the level of each subsystem's logger: DEBUG if we're
+    debugging, otherwise INFO, unless levels (by subsystem) says
+    otherwise.
+    """
+    default = logging.DEBUG if debug else logging.INFO
+    logging.getLogger(LOGGER).setLevel(default)
+    levels = levels or {}
+    for subsystem in LOG_SUBSYSTEMS:
+        getlogger(subsystem).setLevel(levels.get(subsystem, logging.NOTSET))
+
+
+def _start_listener():
+    """ Starts the thread which writes the queued records """
+    if _LISTENER is not None:
+        _LISTENER.start()
+
+
+def _stop_listener():
+    """ Writes out the queued records and stops the listener thread """
+    if _LISTENER is not None and _LISTENER._thread is not None:
+        _LISTENER.stop()
+
+
+def start_logging(debug, levels=None):
+    """ Routes the jfy loggers through a queue to a writer thread """
+    global _LISTENER
+    if _LISTENER is not None:
+        set_levels(debug, levels)
+        return
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(RateLimit())
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+    _LISTENER = logging.handlers.QueueListener(records, stream)
+
+    root = logging.getLogger(LOGGER)
+    root.addHandler(handler)
+    root.propagate = False
+    set_levels(debug, levels)
+
+    _start_listener()
+    # Threads don't survive fork(), so give each side its own listener
+    os.register_at_fork(before=_stop_listener,
+                        after_in_parent=_start_listener,
+                        after_in_child=_start_listener)
+    atexit.register(_stop_listener)
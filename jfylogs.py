@@ -0,0 +1,481 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Helpers for reading the logfile hierarchy written by jfymonitor,
+
+  logpath/<serial>/YYYY/MM/DD
+
+where each day file holds one getline() row per sample: an ISO8601
+timestamp followed by the scaled values in JFYData order.
+
+Once a day is closed, the Maintainer compresses it to DD.gz: a series
+of gzip members (any gzip tool reads them as one stream), one for
+each LOG_GZFRAME seconds of samples, with DD.idx recording where each
+member starts so that readers can skip straight to the part of the
+day they want (without DD.idx, eg for a day gzipped by hand, they
+read the whole day, and the Maintainer rebuilds it). Anything
+appended to DD afterwards (eg samples spilled during an outage)
+becomes further members when DD is next compressed.
+Older days may be downsampled, and the oldest pruned altogether.
+
+Day paths are always the uncompressed name, DD: read_lines() and
+everything built on it read DD.gz and DD alike, so callers needn't
+care which they have.
+"""
+
+import datetime
+import gzip
+import math
+import os
+import shutil
+import threading
+import time
+import zlib
+
+from jfyDefinitions import (JFYData, LOG_GZFRAME, LOG_MAINTINTERVAL,
+                            LOG_MAINTPAUSE)
+from jfylog import getlogger
+
+
+LOG = getlogger("logfile")
+
+GZSUFFIX = ".gz"
+IDXSUFFIX = ".idx"
+
+
+def parseline(line):
+    """
+    Splits a line produced by getline() back into a datetime and the
+    list of scaled values, in JFYData order.
+    """
+    fields = line.strip().split(",")
+    tstamp = datetime.datetime.strptime(fields[0], "%Y-%m-%dT%H:%M:%S")
+    return tstamp, [float(fld) for fld in fields[1:]]
+
+
+def walk_days(logpath, serials=None):
+    """
+    Generator yielding (serial, date, path) for every day file under
+    logpath, in date order for each serial. If serials is given, only
+    those inverters are included.
+    """
+    for serial in sorted(os.listdir(logpath)):
+        if serials and serial not in serials:
+            continue
+        serpath = os.path.join(logpath, serial)
+        if not os.path.isdir(serpath):
+            continue
+        for year in sorted(os.listdir(serpath)):
+            yrpath = os.path.join(serpath, year)
+            if not (year.isdigit() and os.path.isdir(yrpath)):
+                continue
+            for month in sorted(os.listdir(yrpath)):
+                mpath = os.path.join(yrpath, month)
+                if not (month.isdigit() and os.path.isdir(mpath)):
+                    continue
+                days = set()
+                for day in os.listdir(mpath):
+                    if day.endswith(GZSUFFIX):
+                        day = day[:-len(GZSUFFIX)]
+                    if day.isdigit():
+                        days.add(day)
+                for day in sorted(days):
+                    try:
+                        date = datetime.date(int(year), int(month), int(day))
+                    except ValueError:
+                        continue
+                    yield serial, date, os.path.join(mpath, day)
+
+
+def read_index(path):
+    """
+    Returns (settings, frames) from a day's index, where frames are
+    (first epoch, last epoch, offset) for each gzip member, in file
+    order. Without an index, both are empty.
+    """
+    settings = {}
+    frames = []
+    try:
+        with open(path + IDXSUFFIX) as idxf:
+            for line in idxf:
+                if line.startswith("#"):
+                    settings.update([field.split("=", 1)
+                                     for field in line.split()[1:]])
+                    continue
+                first, last, offset = line.split()
+                frames.append((int(first), int(last), int(offset)))
+    except (OSError, ValueError):
+        return {}, []
+    return settings, frames
+
+
+def write_index(path, settings, frames):
+    """ Replaces a day's index """
+    with open(path + IDXSUFFIX + ".tmp", "w") as idxf:
+        idxf.write("# " + " ".join(["{0}={1}".format(key, val)
+                                    for key, val in settings.items()]) +
+                   "\n")
+        for frame in frames:
+            idxf.write("{0} {1} {2}\n".format(*frame))
+    os.replace(path + IDXSUFFIX + ".tmp", path + IDXSUFFIX)
+
+
+def day_exists(path):
+    """ Is there a day file (compressed or not) at this path? """
+    return os.path.exists(path) or os.path.exists(path + GZSUFFIX)
+
+
+def read_lines(path, start=None):
+    """
+    Generator yielding the lines of a day file, compressed or not. If
+    start (epoch seconds) is given, compressed members which end
+    before then are skipped, so some earlier lines may still appear.
+    """
+    if os.path.exists(path + GZSUFFIX):
+        offset = 0
+        if start is not None:
+            # without an index (eg the day was compressed by hand) we
+            # have to read it all
+            frames = read_index(path)[1]
+            later = [foffset for _first, last, foffset in frames
+                     if last >= start]
+            if later:
+                offset = later[0]
+            elif frames:
+                offset = os.path.getsize(path + GZSUFFIX)
+        with open(path + GZSUFFIX, "rb") as raw:
+            raw.seek(offset)
+            with gzip.open(raw, "rt") as gzf:
+                yield from gzf
+    try:
+        with open(path) as dayf:
+            yield from dayf
+    except FileNotFoundError:
+        # compressed while we were reading the members
+        pass
+
+
+def parse_day(path, columns=None, start=None):
+    """
+    Reads a whole day file and returns (tstamps, rows, bad), where
+    tstamps are epoch seconds, rows are the scaled values in JFYData
+    order and bad is the number of lines we couldn't parse. With
+    start, we may skip (compressed) samples from before then.
+
+    columns names the JFYData field in each column after the
+    timestamp, for files written in a different order (eg by
+    solarmonj); fields which aren't present come back as NaN.
+    """
+    if columns is None:
+        columns = JFYData
+    # Where each JFYData field comes from, or None if it's missing
+    srcs = [columns.index(fname) if fname in columns else None
+            for fname in JFYData]
+    ncols = len(columns) + 1
+    nan = float("nan")
+
+    lines = [line.rstrip("\n") for line in read_lines(path, start)]
+
+    tstamps = []
+    rows = []
+    bad = 0
+    for line in lines:
+        fields = line.split(",")
+        if len(fields) < ncols:
+            if line.strip():
+                bad += 1
+            continue
+        try:
+            # fromisoformat() is much quicker than strptime(), and
+            # accepts both "T" and " " as the separator.
+            tstamp = datetime.datetime.fromisoformat(fields[0].strip())
+            values = [float(fields[src + 1]) if src is not None else nan
+                      for src in srcs]
+        except ValueError:
+            bad += 1
+            continue
+        tstamps.append(int(tstamp.timestamp()))
+        rows.append(values)
+    return tstamps, rows, bad
+
+
+def day_path(logpath, serial, date):
+    """ Returns the path of an inverter's day file """
+    return os.path.join(logpath, serial, date.strftime("%Y/%m/%d"))
+
+
+def read_range(logpath, serial, start, end):
+    """
+    Generator yielding (epoch seconds, values) for an inverter's
+    samples between the start and end epoch seconds (inclusive),
+    reading only the day files which could hold them.
+    """
+    date = datetime.date.fromtimestamp(start)
+    last = datetime.date.fromtimestamp(end)
+    while date <= last:
+        path = day_path(logpath, serial, date)
+        date += datetime.timedelta(days=1)
+        if not day_exists(path):
+            continue
+        tstamps, rows, _bad = parse_day(path, start=start)
+        for secs, values in zip(tstamps, rows):
+            if start <= secs <= end:
+                yield secs, values
+
+
+def _line_secs(line):
+    """ Returns a line's epoch seconds, or None if it has none """
+    try:
+        return int(datetime.datetime.fromisoformat(
+            line.split(",", 1)[0].strip()).timestamp())
+    except ValueError:
+        return None
+
+
+def _write_frames(out, lines, frames):
+    """
+    Appends lines to out as gzip members of LOG_GZFRAME seconds each,
+    adding their (first, last, offset) to frames.
+    """
+    group = []
+    first = last = None
+    for line in lines + [None]:
+        secs = _line_secs(line) if line is not None else None
+        if group and (line is None or (secs is not None and
+                                       secs // LOG_GZFRAME !=
+                                       first // LOG_GZFRAME)):
+            frames.append((first, last, out.tell()))
+            out.write(gzip.compress("".join(group).encode(), mtime=0))
+            group = []
+            first = last = None
+        if line is None:
+            break
+        group.append(line)
+        if secs is not None:
+            first = secs if first is None else first
+            last = secs if last is None else max(last, secs)
+        elif first is None:
+            # something unparseable to start with; keep it with the
+            # samples which follow
+            first = last = 0
+
+
+def index_members(gzpath):
+    """
+    Works out the (first, last, offset) of each gzip member of a
+    compressed day, for one whose index has gone missing.
+    """
+    with open(gzpath, "rb") as raw:
+        data = memoryview(raw.read())
+    frames = []
+    offset = 0
+    while offset < len(data):
+        dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        text = dobj.decompress(data[offset:]).decode(errors="replace")
+        if not dobj.eof:
+            # truncated, or trailing garbage
+            break
+        secs = [sec for sec in map(_line_secs, text.splitlines())
+                if sec is not None]
+        frames.append((min(secs, default=0), max(secs, default=0), offset))
+        offset = len(data) - len(dobj.unused_data)
+    return frames
+
+
+def reindex_day(path):
+    """
+    Rebuilds a compressed day's index if it is missing, returning
+    whether it had to.
+    """
+    if not os.path.exists(path + GZSUFFIX) or read_index(path)[1]:
+        return False
+    write_index(path, {"frame": LOG_GZFRAME},
+                index_members(path + GZSUFFIX))
+    return True
+
+
+def compress_day(path):
+    """
+    Compresses a closed day file, appending it to the day's members
+    if it has already been (partly) compressed.
+    """
+    with open(path) as dayf:
+        lines = dayf.readlines()
+    settings, frames = read_index(path)
+    settings.setdefault("frame", LOG_GZFRAME)
+    gzpath = path + GZSUFFIX
+    with open(gzpath + ".tmp", "wb") as out:
+        if os.path.exists(gzpath):
+            with open(gzpath, "rb") as old:
+                shutil.copyfileobj(old, out)
+        _write_frames(out, lines, frames)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(gzpath + ".tmp", gzpath)
+    write_index(path, settings, frames)
+    os.remove(path)
+
+
+def downsample_day(path, res):
+    """
+    Rewrites a day (compressed) as one sample per res seconds: the
+    mean of each field over the period, except for energyGenerated,
+    which is a running total and so keeps its last value.
+    """
+    settings, _frames = read_index(path)
+    if int(settings.get("res", 0)) >= res:
+        return False
+    tstamps, rows, _bad = parse_day(path)
+    egen = JFYData.index("energyGenerated")
+    buckets = {}
+    for secs, row in zip(tstamps, rows):
+        buckets.setdefault(secs - secs % res, []).append(row)
+    lines = []
+    for secs in sorted(buckets):
+        values = []
+        for col in range(len(JFYData)):
+            vals = [row[col] for row in buckets[secs]
+                    if not math.isnan(row[col])]
+            if not vals:
+                values.append(float("nan"))
+            elif col == egen:
+                values.append(vals[-1])
+            else:
+                values.append(round(sum(vals) / len(vals), 3))
+        lines.append(datetime.datetime.fromtimestamp(secs).strftime(
+            "%Y-%m-%dT%H:%M:%S") + "".join(
+                [",{0}".format(val) for val in values]) + "\n")
+    frames = []
+    gzpath = path + GZSUFFIX
+    with open(gzpath + ".tmp", "wb") as out:
+        _write_frames(out, lines, frames)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(gzpath + ".tmp", gzpath)
+    write_index(path, {"frame": LOG_GZFRAME, "res": res}, frames)
+    if os.path.exists(path):
+        os.remove(path)
+    return True
+
+
+def remove_day(path):
+    """ Removes a day, and its month and year if they're now empty """
+    for name in [path, path + GZSUFFIX, path + IDXSUFFIX]:
+        if os.path.exists(name):
+            os.remove(name)
+    for parent in [os.path.dirname(path),
+                   os.path.dirname(os.path.dirname(path))]:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            # not empty
+            break
+
+
+class Maintainer(threading.Thread):
+    """
+    Compresses, downsamples and prunes the day files under each
+    logpath every LOG_MAINTINTERVAL seconds, pausing LOG_MAINTPAUSE
+    seconds after each file so as not to compete with polling. Days
+    are only touched once they're more than a day old, so we never
+    race the daemon writing today's (or, just after midnight,
+    yesterday's) file.
+    """
+
+    def __init__(self):
+        self.logpaths = []
+        self.compressafter = None   # days, or None to leave them alone
+        self.downsampleafter = None
+        self.downsampleres = None
+        self.retaindays = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        threading.Thread.__init__(self, name="maintainer", daemon=True)
+
+    def configure(self, logpaths, compressafter, downsampleafter,
+                  downsampleres, retaindays):
+        """ Applies the (reloaded) retention settings """
+        with self.lock:
+            self.logpaths = sorted(set(logpaths))
+            self.compressafter = compressafter
+            self.downsampleafter = downsampleafter
+            self.downsampleres = downsampleres
+            self.retaindays = retaindays
+
+    def stop(self):
+        """ Stops after the file we're working on """
+        self.stopping.set()
+
+    def tend(self, path, age):
+        """ Applies the retention tiers to one day """
+        with self.lock:
+            compressafter = self.compressafter
+            downsampleafter = self.downsampleafter
+            downsampleres = self.downsampleres
+            retaindays = self.retaindays
+        # before anything else relies on it
+        reindexed = reindex_day(path)
+        if retaindays is not None and age > retaindays:
+            remove_day(path)
+            return "pruned"
+        if downsampleafter is not None and age > downsampleafter and \
+           downsample_day(path, downsampleres):
+            return "downsampled"
+        if compressafter is not None and age > compressafter and \
+           os.path.exists(path):
+            compress_day(path)
+            return "compressed"
+        return "reindexed" if reindexed else None
+
+    def maintain(self):
+        """ One pass over all of the logpaths """
+        today = datetime.date.today()
+        counts = {}
+        with self.lock:
+            logpaths = list(self.logpaths)
+        for logpath in logpaths:
+            if not os.path.isdir(logpath):
+                continue
+            for _serial, date, path in walk_days(logpath):
+                if self.stopping.is_set():
+                    return counts
+                # never today's or yesterday's file
+                age = (today - date).days
+                if age < 2:
+                    continue
+                try:
+                    done = self.tend(path, age)
+                except (OSError, EOFError, ValueError) as exc:
+                    LOG.error("Unable to maintain %s: %s", path, exc)
+                    continue
+                if done:
+                    counts[done] = counts.get(done, 0) + 1
+                    LOG.debug("%s %s", done, path)
+                    self.stopping.wait(LOG_MAINTPAUSE)
+        return counts
+
+    def run(self):
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            counts = self.maintain()
+            if counts:
+                LOG.info("Maintained the logfiles in %.0fs: %s",
+                         time.monotonic() - started, counts)
+            self.stopping.wait(LOG_MAINTINTERVAL)
@@ -55,11 +55,56 @@ utility):
 [global]
 usesstore= True / False
 
+On systems without sstored, usesstore= publishes the stats in a
+shared memory segment instead (see jfyshm.py), at SHM_PATH unless
+
+shmpath=
+
+is given in [global].
+
+Each sstore stat is only updated when it moves by more than its
+deadband (see STATDEADBANDS); these may be overridden in [global] with
+
+deadband-<stat>= (eg deadband-power-generated= 5)
+
 [inverter-$N]
 devname= device path to access the inverter (eg /dev/term/a)
 pvout_sysid= PVoutput.org system id for this inverter
 pvout_apikey= PVoutput.org api key for this inverter
 
+Inverters are polled on multiples of POLLINTERVAL seconds on the wall
+clock; to change that, add
+
+pollinterval=
+
+to the [global] section. Each pvoutput.org status is aggregated from
+the samples taken during its PVOUTPUT_INTERVAL.
+
+Sending SIGHUP to the daemon rereads the configuration file. Inverters
+whose sections have been removed are stopped, new ones are registered
+and started, and changes to the output settings of the others take
+effect without interrupting their polling. Changing usesstore=,
+shmpath= or capturepath= restarts the affected inverters.
+
+SIGUSR1 and SIGUSR2 profile the daemon's CPU and memory use, writing
+their reports to the logfile hierarchy (see jfyprofile.py).
+
+Adding
+
+httpport=
+
+to the [global] section serves the inverters' history over HTTP on
+that port (see jfyhttp.py), on HTTP_ADDR unless httpaddr= is given.
+The same port streams new samples to dashboards as Server-Sent Events.
+
+Diagnostics go to stderr through a single writer thread (see
+jfylog.py). Each subsystem's level may be set in [global] with
+
+loglevel-<subsystem>= (eg loglevel-serial= DEBUG)
+
+where the subsystems are listed in LOG_SUBSYSTEMS; -d sets the
+default level to DEBUG.
+
 
 Note that you may specify a per-inverter logfile path if desired,
 by adding a
@@ -68,6 +113,111 @@ logpath=
 
 field to an [inverter-$N] section.
 
+Adding
+
+compress= True
+
+to an [inverter-$N] section only writes samples to the logfile when
+a field deviates from the trend by more than its tolerance (see
+COMPRESSTOLERANCES and jfycompress.py). The tolerances may be
+overridden in [global] with tolerance-<field>= entries.
+
+Adding
+
+tsdbpath=
+
+to the [global] section also stores every sample in the compressed
+time-series store (see jfytsdb.py) in that directory.
+
+Adding
+
+sqlitedb=
+
+to the [global] section (or to an [inverter-$N] section) also
+writes the samples which go to the logfile to that SQLite database
+(see jfysqlite.py).
+
+Adding
+
+capturepath=
+
+to the [global] section captures all of the serial traffic with each
+inverter to a file in that directory (see jfycapture.py), which
+parse-jfy-dump.py can read. Running with -r replays a capture through
+the outputs configured for its device, without pvoutput.org.
+
+Each inverter is normally polled by its own thread. For large
+installations (hundreds of serial ports), adding
+
+fleetworkers=
+
+to the [global] section instead drives all of the ports from that
+many threads, each waiting on its share of them with select() (see
+jfyfleet.py). Every port is a separate bus with its own inverter
+addresses. This only changes when the daemon is restarted.
+
+Samples are written to the outputs by one worker thread per output
+(see jfysinks.py), so a slow output can't delay polling. Each output
+has a queue of up to SINK_QUEUELEN samples (sinkqueue= in [global])
+and a policy for when it's full (see SINK_POLICIES), which
+
+sinkpolicy-<sink>= drop-oldest / block / spill
+
+in [global] overrides. Spilled samples are kept in
+
+spoolpath=
+
+(by default, the spool directory in the logfile hierarchy). Changing
+sinkqueue= or spoolpath= only takes effect when the daemon restarts.
+
+Once a day file is more than LOG_COMPRESSAFTER days old, it is
+compressed in the background (see jfylogs.py); jfylogs.py reads
+compressed and uncompressed days alike. In [global],
+
+compressafter= days (0 never compresses)
+downsampleafter= days after which to keep one sample per
+                 downsampleres= seconds (default LOG_DOWNSAMPLERES)
+retaindays= days after which to remove the day files altogether
+
+where downsampling and removal are off unless configured.
+
+Adding
+
+mqtthost=
+
+to the [global] section publishes each sample to that MQTT broker
+(see jfymqtt.py), as <mqtttopic>/<serial>/<field>, over a single
+connection. The optional
+
+mqttport= mqtttopic= mqttqos= mqttretain= mqttclientid=
+mqttuser= mqttpassword=
+
+default to MQTT_PORT, MQTT_TOPIC, MQTT_QOS (0 or 1), retained
+messages, jfy-<hostname> and no authentication.
+
+Adding a
+
+[site]
+
+section publishes the site's totals across all of the inverters (see
+jfysite.py) to every output, as a virtual inverter whose serial number
+is SITE_SERIAL unless serial= is given. It may also have
+pvoutput_apikey=, pvoutput_sysid= and logpath= entries, as for an
+inverter.
+
+Adding
+
+anomalies= True
+
+to the [global] section checks every sample for an inverter, or its
+PV string, falling behind what it usually produces alongside the
+others (see jfyanomaly.py). Anomalies are logged, published on MQTT
+as <mqtttopic>/<serial>/anomaly/<check>, and sent to /stream clients.
+
+anomalydrop=
+
+sets how far below usual counts as an anomaly (default ANOMALY_DROP).
+
 ----
 External dependency: [pySerial][https://pypi.python.org/pypi/pyserial]
 """
@@ -75,16 +225,18 @@ External dependency: [pySerial][https://pypi.python.org/pypi/pyserial]
 import configparser
 import datetime
 import getopt
+import http.client
+import logging
+import math
 import os
 
 import platform
 
+import signal
 import struct
 import sys
 import threading
 import time
-import urllib.parse
-import urllib.request
 
 # This is in what appears to be the wrong spot from pylint's point
 # of view - but only because pyserial is installed in $HOME rather
@@ -94,12 +246,40 @@ from serial import serialposix
 
 from jfyDefinitions import (CtrlCodes, UnsupportedOpCodes, RegisterCodes,
                             ReadCodes, jfyHeader, jfyEnder, jfyAck, APid,
-                            bcast, JFYData, JFYDivisors, JFYEmpty,
+                            bcast, JFYData, JFYDivisors,
                             RESOURCE_SSID_PREFIX, STATS, SERVICEURL,
-                            charset)
+                            charset, InvariantCodes, INVARIANT_TTL,
+                            STATDEADBANDS, COMPRESSTOLERANCES,
+                            POLLINTERVAL, SHM_PATH, HEALTH_BACKOFFBASE,
+                            HEALTH_BACKOFFMAX, HEALTH_OPENAFTER,
+                            HEALTH_PROBEINTERVAL, ENERGY_SAVEINTERVAL,
+                            LOG_SUBSYSTEMS, HTTP_ADDR,
+                            XFER_TRIES, FLEET_TIMEOUT, FLEET_READSIZE,
+                            SINK_POLICIES, SINK_QUEUELEN, LOG_COMPRESSAFTER,
+                            LOG_DOWNSAMPLERES, MQTT_PORT, MQTT_TOPIC,
+                            MQTT_QOS, SITE_SERIAL, SITE_STALEPOLLS,
+                            ANOMALY_DROP)
+from jfycompress import SwingingDoor
+from jfytsdb import TSDBWriter
+from jfysqlite import SQLiteSink
+from jfyshm import ShmWriter
+from jfyenergy import EnergyIntegrator
+from jfycapture import (CaptureTee, capture_name, read_capture, read_header,
+                        scan_frames)
+from jfyprofile import Profiler
+from jfylog import getlogger, parse_level, set_levels, start_logging
+from jfyhttp import History, HistoryServer
+from jfyfleet import FleetWorker
+from jfysinks import Dispatcher, POLICIES
+from jfylogs import Maintainer
+from jfypvoutput import PVOutputSlot, post
+from jfymqtt import MQTTPublisher
+from jfysite import SiteAggregator
+from jfyanomaly import AnomalyDetector
 
 
 # This is a little bit ugly
+SStore = None
 OSNAME, _HOST, _BIGREL, DOTREL = platform.uname()[0:4]
 if OSNAME == "SunOS":
     majrel, minrel = DOTREL.split(".")[0:2]
@@ -107,17 +287,88 @@ if OSNAME == "SunOS":
         from libsstore import SStore, SSException
 
 
-# Process-wide mapping of inverter serial number to id
-_INVERTER_MAP = {1: "application"}
+SERIALLOG = getlogger("serial")
+REGLOG = getlogger("register")
+POLLLOG = getlogger("poll")
+LOGFILELOG = getlogger("logfile")
+SSTORELOG = getlogger("sstore")
+PVOUTPUTLOG = getlogger("pvoutput")
+ENERGYLOG = getlogger("energy")
+MONLOG = getlogger("monitor")
+ANOMALYLOG = getlogger("anomaly")
+
+# The addresses we may give inverters on a bus: not broadcast (0), not
+# ours (APid), and not 0xff
+BUS_ADDRESSES = range(APid + 1, 254)
+
+
+class BusMap():
+    """
+    The addresses allocated to inverters on one bus. Each bus has its
+    own address space, and allocation is safe from any thread.
+    """
+
+    def __init__(self, devname):
+        self.devname = devname
+        self.addrs = {APid: "application"}   # address -> serial number
+        self.lock = threading.Lock()
+
+    def allocate(self, serial, current=None):
+        """
+        Returns an address for this serial number, preferring the one
+        it already has (current), or None if the bus is full.
+        """
+        with self.lock:
+            if current is not None and \
+               self.addrs.get(current, serial) == serial:
+                self.addrs[current] = serial
+                return current
+            for addr, owner in self.addrs.items():
+                if owner == serial:
+                    return addr
+            for addr in BUS_ADDRESSES:
+                if addr not in self.addrs:
+                    self.addrs[addr] = serial
+                    return addr
+        return None
+
+    def release(self, addr, serial):
+        """ Frees an address, if this serial number still holds it """
+        with self.lock:
+            if self.addrs.get(addr) == serial:
+                del self.addrs[addr]
+
+    def items(self):
+        """ Returns the (address, serial) pairs in use """
+        with self.lock:
+            return sorted(self.addrs.items())
+
+
+# Process-wide mapping of bus (device name) to its BusMap
+_BUSES = {}
+_BUSES_LOCK = threading.Lock()
+
+
+def bus_for(devname):
+    """ Returns the BusMap for this device, creating it if need be """
+    with _BUSES_LOCK:
+        if devname not in _BUSES:
+            _BUSES[devname] = BusMap(devname)
+        return _BUSES[devname]
+
 
 USAGE_STMT = """
 
 $ jfymonitor -F /path/to/cfg/file -l /path/to/logfiles [-x code] [-od]
+      [-r capture [-s speed]]
 
     -d provide debug output from various functions
     -F /path/to/config/file
     -o oneshot (do not daemonize)
     -l /path/to/logfile/hierarchy
+    -r /path/to/capture   replay a capture instead of polling
+    -s speed   replay at this multiple of real time (default 1;
+               0 replays as fast as possible)
     -x hex   run this specific Read Code and output to stdout **
 
     logpath may be inverter-specific, by serial number
@@ -139,21 +390,30 @@ def usage(do_exit=False):
         sys.exit(1)
 
 
-def getline(stats=None):
+def getline(stats=None, tstamp=None):
     """
     Formats a result line (in CSV) for writing to a logfile. We return the
     line in data-natural order, unlike solarmonj. This function applies the
-    divisors in JFYDivisors to return scaled data.
+    divisors in JFYDivisors to return scaled data. The line is stamped
+    with the current time unless tstamp is provided.
     """
-    tstamp = datetime.date.strftime(datetime.datetime.now(),
-                                    "%Y-%m-%dT%H:%M:%S")
-    line = tstamp
+    if tstamp is None:
+        tstamp = datetime.datetime.now()
+    line = datetime.date.strftime(tstamp, "%Y-%m-%dT%H:%M:%S")
     for idx, fname in enumerate(JFYData):
         line = line + "," + "{0}".format(stats[fname] / JFYDivisors[idx])
     line = line + "\n"
     return line
 
 
+def decode_string(data):
+    """
+    Turns the data portion of a response packet into a string, dropping
+    anything that isn't printable ASCII.
+    """
+    return "".join([chr(c) for c in data if 0x20 <= c < 0x7f]).strip()
+
+
 def checksum(packet=None, verify=False):
     """ Creates and verifies a packet checksum """
     rdict = {}
@@ -204,12 +464,22 @@ def decode_pkt(bytestream):
     rval["pktdata"] = data
     rval["chksum"] = checksum(bytestream[:-2], verify=True)
     if not rval["chksum"]["ok"]:
-        print("checksum invalid ({0} {1}, expected {2})".format(
-            hex(rval["chksum"]["value"][0]), hex(rval["chksum"]["value"][1]),
-            hex(rval["chksum"]["expected"])))
+        SERIALLOG.warning("checksum invalid (%s %s, expected %s)",
+                          hex(rval["chksum"]["value"][0]),
+                          hex(rval["chksum"]["value"][1]),
+                          hex(rval["chksum"]["expected"]))
     return rval
 
 
+class SingleTry(bytes):
+    """ A packet which is only sent once, rather than XFER_TRIES times """
+
+
+def xfer_tries(pkt):
+    """ How many times to send a packet before giving up on a response """
+    return 1 if isinstance(pkt, SingleTry) else XFER_TRIES
+
+
 def create_pkt(src, dest, ctrl, func, data):
     """
     Returns binary packet. The examples provided in the spec describe
@@ -233,33 +503,110 @@ def create_pkt(src, dest, ctrl, func, data):
     return pkt
 
 
+class InverterHealth():
+    """
+    Tracks whether an inverter is answering us. Consecutive failures
+    back off exponentially, and after HEALTH_OPENAFTER of them the
+    circuit opens: we stop polling and only probe (by re-registering)
+    every HEALTH_PROBEINTERVAL seconds until the inverter comes back.
+    """
+    OK = "ok"
+    BACKOFF = "backoff"
+    OPEN = "open"
+
+    def __init__(self):
+        self.state = self.OK
+        self.failures = 0        # consecutive failures
+        self.next_attempt = 0    # time.monotonic() of the next attempt
+
+    def succeeded(self):
+        """ The inverter answered """
+        self.state = self.OK
+        self.failures = 0
+        self.next_attempt = 0
+
+    def failed(self):
+        """ The inverter didn't answer, or answered with garbage """
+        self.failures += 1
+        now = time.monotonic()
+        if self.failures >= HEALTH_OPENAFTER:
+            self.state = self.OPEN
+            self.next_attempt = now + HEALTH_PROBEINTERVAL
+        else:
+            self.state = self.BACKOFF
+            self.next_attempt = now + min(
+                HEALTH_BACKOFFBASE * 2 ** (self.failures - 1),
+                HEALTH_BACKOFFMAX)
+
+    def wait(self):
+        """ Returns how long (in seconds) until we may try again """
+        return max(0, self.next_attempt - time.monotonic())
+
+    def is_open(self):
+        """ Have we given up polling until a probe succeeds? """
+        return self.state == self.OPEN
+
+
 class Inverter(threading.Thread):
     """ It's a collection of tubes """
 
     def __init__(self, inv, oneshot, debug):
         #
         # definitions we need
+        self.inv = inv
         self.devname = inv["devname"]
         self.usesstore = inv["usesstore"]
+        self.deadbands = inv["deadbands"]
         self.apikey = inv["apikey"]
         self.sysid = inv["sysid"]
         self.logpath = inv["logpath"]
+        self.tsdbpath = inv["tsdbpath"]
+        self.sqlite = inv.get("sqlite")   # shared SQLiteSink, if any
+        self.shm = inv.get("shm")         # shared ShmWriter, if any
+        self.history = inv.get("history")  # shared History, if any
+        self.mqtt = inv.get("mqtt")       # shared MQTTPublisher, if any
+        self.site = inv.get("site")       # shared SiteAggregator, if any
+        self.anomaly = inv.get("anomaly")  # shared AnomalyDetector, if any
+        self.sinks = inv.get("sinks")     # shared Dispatcher, if any
+        self.integrate = inv.get("integrate", True)  # keep energy.json?
         self.oneshot = oneshot
+        self.period = inv["pollinterval"]
+        self.pvslot = PVOutputSlot()
         starttime = datetime.datetime.now()
         # for rotating the logfile
         self.day = datetime.date.strftime(starttime, "%d")
         self.debug = debug
+        if inv["compress"]:
+            self.compressor = SwingingDoor(inv["tolerances"])
+        else:
+            self.compressor = None
 
         # properties filled in via setup()
         self.dev = None          # file handle for the monitoring device
         self.logfile = None      # full OS path to logfile
         self.sst = None          # handle to sstored
+        self.tsdb = None         # compressed time-series store writer
+        self.energy = None       # running energy totals
+        self.energy_saved = 0    # time.monotonic() of the last save
+        self.outputs_open = False  # has setup_outputs() opened them?
+        self.outputs_closed = False  # has shutdown() closed the outputs?
         self.isreg = None        # are we registered with the inverter?
         self.serial = None       # inverter serial number
         self.hr_serial = None    # human-readable form of serial number
         self.idx = None          # inverter ID in the map
         self.stats = None        # stat names
         self.stats_array = None  # array of stats for updating sstored
+        self.sst_last = {}       # last values pushed to sstored
+        self.sst_skipped = 0     # stat writes suppressed by the deadbands
+        self.invariants = {}     # cached invariant info, by Read Code
+        self.invariants_expiry = None  # time.monotonic() when cache expires
+        self.unsupported = set()  # Read Codes the inverter didn't answer
+        self.bus = bus_for(self.devname)
+        self.session = None      # FleetSession, if a fleet worker runs us
+        self.health = InverterHealth()
+        self.stopping = threading.Event()
+        # held while writing to the outputs, and while reconfiguring them
+        self.cfglock = threading.Lock()
         threading.Thread.__init__(self)
 
     def xfer_pkt(self, bytestream):
@@ -267,44 +614,46 @@ class Inverter(threading.Thread):
         Sends the packet out through the device and receives the
         response (if any)
         """
-        for _tries in range(0, 10):
+        for _tries in range(0, xfer_tries(bytestream)):
             rval = self.dev.write(bytestream)
             if rval != len(bytestream):
-                print("Unable to write all of bytestream. {0} of {1} "
-                      "transferred.".format(rval, len(bytestream)),
-                      file=sys.stderr)
+                SERIALLOG.warning("Unable to write all of bytestream. %s of "
+                                  "%s transferred.", rval, len(bytestream))
             # Inspection of the captured data files we have implies that
             # the largest packet received is 64 bytes *following* the
             # 7 bytes of header content.
             time.sleep(1)
             rpkt = self.dev.read_until(expected=b'\n\r')
             if len(rpkt) > 0:
-                if self.debug:
-                    print("response {0}".format(rpkt))
+                SERIALLOG.debug("response %s", rpkt)
                 return rpkt
         return None
 
-    def logrotate(self):
+    def logrotate(self, now=None):
         """
         Checks whether the logfile needs rotating (per-day), and
-        rotates it if necessary
+        rotates it if necessary. now is the time of the next sample
+        to be written, if that isn't now.
         """
 
-        now = datetime.datetime.now()
+        if now is None:
+            now = datetime.datetime.now()
         curday = datetime.date.strftime(now, "%d")
 
         if self.logfile is not None:
             if curday == self.day:
-                if self.debug:
-                    print("curday {0} self.day {1}: not rotating "
-                          "logfile {2}".format(curday, self.day, self.logfile))
-                    return
+                LOGFILELOG.debug("curday %s self.day %s: not rotating "
+                                 "logfile %s", curday, self.day, self.logfile)
+                return
             else:
-                if self.debug:
-                    print("Rotating logfile, curday {0} != self.day {1}".
-                          format(curday, self.day))
+                LOGFILELOG.debug("Rotating logfile, curday %s != self.day %s",
+                                 curday, self.day)
+                self.write_samples(self.flush_compressor())
                 self.logfile.close()
                 self.day = curday
+                # seal the day's last block in the time-series store
+                if self.tsdb:
+                    self.tsdb.flush()
 
         # Can we open the logfile for writing?
 
@@ -313,38 +662,140 @@ class Inverter(threading.Thread):
         try:
             _statbuf = os.stat(logdir)  # noqa: F841
         except FileNotFoundError as _exc:
-            if self.debug:
-                print("Creating toplevel logdir {0}".format(logdir))
+            LOGFILELOG.debug("Creating toplevel logdir %s", logdir)
             os.makedirs(logdir)
 
         logname = os.path.join(logdir, curday)
         self.logfile = open(logname, "a", buffering=1)
         if not self.logfile:
-            print("Unable to open logfile {0}".format(logname))
+            LOGFILELOG.error("Unable to open logfile %s", logname)
             self.dev.close()
             self.dev = None
             return
 
+    def write_samples(self, samples):
+        """
+        Writes (timestamp, stats) samples to the logfile, and queues
+        them for the SQLite database if we're using one.
+        """
+        for (tstamp, stats) in samples:
+            if self.logfile:
+                self.logfile.write(getline(stats, tstamp))
+            if self.sqlite:
+                self.sqlite.put(self.hr_serial, tstamp, stats)
+
+    def flush_compressor(self):
+        """ Returns any samples the compressor is still holding """
+        if not self.compressor:
+            return []
+        return self.compressor.flush()
+
+    def drive(self, steps):
+        """
+        Runs one of the *_steps() protocol generators over the device:
+        each packet it yields is sent with xfer_pkt(), and the response
+        (or None) is sent back in. Returns the generator's result.
+        Fleet workers drive the same generators without blocking.
+        """
+        try:
+            pkt = next(steps)
+            while True:
+                pkt = steps.send(self.xfer_pkt(pkt))
+        except StopIteration as stop:
+            return stop.value
+
+    def query_info(self, readcode):
+        """
+        Issues the named Read Code to the inverter and returns the data
+        from the response, or None if we didn't get a valid response.
+        """
+        return self.drive(self.query_info_steps(readcode))
+
+    def query_info_steps(self, readcode, once=False):
+        """
+        Protocol steps for query_info(), see drive(). With once, the
+        query isn't retried if there's no response.
+        """
+        pkt = create_pkt(APid, self.idx, CtrlCodes["Read"],
+                         ReadCodes[readcode], data=None)
+        inpkt = yield SingleTry(pkt) if once else pkt
+        if not inpkt:
+            return None
+        response = decode_pkt(inpkt)
+        if not response or not response["chksum"]["ok"]:
+            return None
+        return response["pktdata"]
+
+    def refresh_invariants(self):
+        """
+        Fetches the invariant information (inverter id, fixed settings,
+        model and firmware versions) from the inverter and caches it for
+        INVARIANT_TTL seconds. We cache whatever we got even if the
+        inverter didn't answer some of the queries, otherwise we'd be
+        spending bus time on them every poll cycle. Each query is only
+        sent once, and one which isn't answered isn't asked again until
+        we re-register: many inverters don't implement them all, and
+        retrying would hold up polling (and startup) for minutes.
+        """
+        self.drive(self.refresh_steps())
+
+    def refresh_steps(self):
+        """ Protocol steps for refresh_invariants(), see drive() """
+        info = {}
+        for readcode in InvariantCodes:
+            if readcode in self.unsupported:
+                continue
+            pktdata = yield from self.query_info_steps(readcode, once=True)
+            if pktdata is None:
+                POLLLOG.debug("No response to %s from %s, not asking "
+                              "again", readcode, self.hr_serial)
+                self.unsupported.add(readcode)
+                continue
+            info[readcode] = {"raw": pktdata, "text": decode_string(pktdata)}
+        self.invariants = info
+        self.invariants_expiry = time.monotonic() + INVARIANT_TTL
+        POLLLOG.debug("invariant info for %s: %s", self.hr_serial, info)
+        with self.cfglock:
+            if self.history:
+                self.history.describe(self.hr_serial, self.get_invariants())
+
+    def invariants_expired(self):
+        """ Do we need to refetch the invariant information? """
+        return self.invariants_expiry is None or \
+            time.monotonic() >= self.invariants_expiry
+
+    def get_invariants(self):
+        """
+        Returns the cached invariant information for sinks to use. We
+        never touch the bus here; refreshing the cache is done from the
+        polling loop.
+        """
+        return dict(self.invariants)
+
     def query_normal_info(self):
         """ Queries the inverter for instantaneous data. """
+        return self.drive(self.normal_info_steps())
 
+    def normal_info_steps(self):
+        """ Protocol steps for query_normal_info(), see drive() """
         # We assume that the inverter is online;
-        pkt = create_pkt(APid, self.idx, CtrlCodes["Read"],
-                         ReadCodes["QueryNormalInfo"], data=None)
-
-        inpkt = self.xfer_pkt(pkt)
+        inpkt = yield create_pkt(APid, self.idx, CtrlCodes["Read"],
+                                 ReadCodes["QueryNormalInfo"], data=None)
 
-        # Sometimes we won't get a response in after 10 tries, so
-        # don't worry about it
+        # Sometimes we won't get a response in after 10 tries; our
+        # caller deals with that via self.health
         if not inpkt:
-            return
+            return None
         response = decode_pkt(inpkt)
-        # Boo - didn't get a valid packet
+        # Boo - didn't get a valid packet. Report it as a failure rather
+        # than logging a row of JFYEmpty zeros; a gap is more honest.
         if not response or not response["chksum"]["ok"]:
-            return dict(zip(JFYData, JFYEmpty))
+            return None
+        return self.unpack_normal_info(response["pktdata"])
 
+    def unpack_normal_info(self, normalinfo):
+        """ Returns the stats from a QueryNormalInfoResponse's data """
         rvals = []
-        normalinfo = response["pktdata"]
         # See comment atop definition of JFYData. We return the un-scaled
         # data; our output functions handle scaling for us.
         for idx in range(0, 16, 2):
@@ -353,65 +804,71 @@ class Inverter(threading.Thread):
                 continue
             rvals.append((normalinfo[idx] << 8) | normalinfo[idx+1])
 
-        if self.debug:
+        if POLLLOG.isEnabledFor(logging.DEBUG):
             alldata = []
             for idx in range(0, len(normalinfo), 2):
                 alldata.append((normalinfo[idx] << 8) | normalinfo[idx+1])
-            print("alldata from pkt: {0}".format(alldata))
+            POLLLOG.debug("alldata from pkt: %s", alldata)
 
         return dict(zip(JFYData, rvals))
 
     def print_warnings(self):
         """ print SStore warnings to stderr """
         for warn in self.sst.warnings():
-            print("{0}".format(warn), file=sys.stderr)
+            SSTORELOG.warning("%s", warn)
 
     def sstore_update(self, vals):
         """
         Updates the stats in sstored after stripping out the ignore[12]
         fields in JFYData. We're using the shared memory region method
         provided by data_attach(), so this is a very simple function.
+        Only those stats which have moved outside their deadband since
+        we last pushed them are written.
         """
         values = {}
         for idx, fname in enumerate(JFYData):
-            values[self.stats[idx]] = vals[fname] / JFYDivisors[idx]
+            value = vals[fname] / JFYDivisors[idx]
+            last = self.sst_last.get(self.stats[idx])
+            if last is not None and \
+               abs(value - last) <= self.deadbands[STATS[idx]]:
+                self.sst_skipped += 1
+                continue
+            values[self.stats[idx]] = value
+
+        if not values:
+            SSTORELOG.debug("sstore unchanged, %s writes skipped so far",
+                            self.sst_skipped)
+            return
 
-        if self.debug:
-            print("sstore updated with values {0}".format(values))
+        SSTORELOG.debug("sstore updated with values %s", values)
         self.sst.data_update(values)
+        self.sst_last.update(values)
 
-    def pvoutput_update(self, vals):
-        """
-        Updates the pvoutput.org service, if the current minute is
-        divisible by 5 (complies with pvoutput.org rules). Refer to
-        API documentation at https://www.pvoutput.org/help.html#api-addstatus
-        """
-        curtime = datetime.datetime.now()
-        if curtime.minute % 5 != 0:
-            return
-        valdata = {
-            'd': curtime.strftime("%Y%m%d"),                 # date
-            't': curtime.strftime("%H:%M"),                  # time
-            'v1': vals["energyGenerated"] / JFYDivisors[4],  # energy
-            'v2': vals["powerGenerated"] / JFYDivisors[1],   # power
-            'v5': vals["temperature"] / JFYDivisors[0],      # temperature
-            'v6': vals["voltageDC"] / JFYDivisors[2]         # Vdc
-        }
-        data = urllib.parse.urlencode(valdata)
-        data = data.encode("ascii")
-        req = urllib.request.Request(url=SERVICEURL, data=data)
-        req.add_header("X-Pvoutput-Apikey", self.apikey)
-        req.add_header("X-Pvoutput-SystemId", self.sysid)
+    def pvoutput_send(self, valdata):
+        """ Sends a status to pvoutput.org """
         try:
-            urllib.request.urlopen(req, data)
-        except urllib.error.URLError as exc:
-            print("Failed: reason {0}".format(exc.reason), file=sys.stderr)
+            post(SERVICEURL, self.apikey, self.sysid, valdata)
+        except (OSError, http.client.HTTPException) as exc:
+            PVOUTPUTLOG.warning("Failed: reason %s",
+                                getattr(exc, "reason", exc))
+            return
 
-        if self.debug:
-            print("Updated pvoutput.org with valdata: {0}".format(valdata))
+        PVOUTPUTLOG.debug("Updated pvoutput.org with valdata: %s", valdata)
+
+    def set_serial(self, serial):
+        """ Records the serial number from an OfflineQueryResponse """
+        self.serial = serial
+        self.hr_serial = "".join([chr(s) for s in self.serial if s in charset])
+
+        # remove any trailing whitespace
+        self.hr_serial = self.hr_serial.strip()
 
     def register(self):
         """ Register this utility with the inverter """
+        self.drive(self.register_steps())
+
+    def register_steps(self):
+        """ Protocol steps to register with the inverter, see drive() """
         # Per the spec:
         #
         # OfflineQuery
@@ -430,25 +887,24 @@ class Inverter(threading.Thread):
         # AddressConfirm
         # Inverter sends ACK:
         #     src=N, dest=1, ctrl=0x31, func=0xbe, datalen=1, data=jfyAck
-        print("Registration process started at ", datetime.datetime.now(),
-              file=sys.stderr)
-        next_inv = max(_INVERTER_MAP.keys()) + 1
-        if next_inv > 253:
-            print("Too many ({0} > 253) inverters attached.".format(next_inv),
-                  file=sys.stderr)
+        REGLOG.info("Registration process started on %s", self.devname)
+        # Whatever we knew about the inverter before is now suspect
+        self.invariants = {}
+        self.invariants_expiry = None
+        self.unsupported = set()
+        self.isreg = False
+        inpkt = yield create_pkt(APid, bcast, CtrlCodes["Register"],
+                                 RegisterCodes["ReRegister"],
+                                 data=None)
+        inpkt = yield create_pkt(APid, bcast, CtrlCodes["Register"],
+                                 RegisterCodes["OfflineQuery"],
+                                 data=None)
+        if not inpkt:
+            REGLOG.warning("No response to OfflineQuery on %s", self.devname)
             return
-        pkt = create_pkt(APid, bcast, CtrlCodes["Register"],
-                         RegisterCodes["ReRegister"],
-                         data=None)
-
-        inpkt = self.xfer_pkt(pkt)
-        pkt = create_pkt(APid, bcast, CtrlCodes["Register"],
-                         RegisterCodes["OfflineQuery"],
-                         data=None)
-        inpkt = self.xfer_pkt(pkt)
         response = decode_pkt(inpkt)
         if not response:
-            print("Empty response from decode_pkt (1)")
+            REGLOG.warning("Empty response from decode_pkt (1)")
             return
         # Sanity-check the packet values
         if response["src"] != 0 or \
@@ -456,28 +912,32 @@ class Inverter(threading.Thread):
            response["ctrl"] != CtrlCodes["Register"] or \
            not response["chksum"]["ok"]:
             # Garbage from this inverter, fail out
-            print("Got garbage response (1)  {0}".format(response))
+            REGLOG.warning("Got garbage response (1)  %s", response)
             return
         # Packet seems ok, let's build the next
-        self.serial = response["pktdata"]
-        self.hr_serial = "".join([chr(s) for s in self.serial if s in charset])
+        self.set_serial(response["pktdata"])
 
-        # remove any trailing whitespace
-        self.hr_serial = self.hr_serial.strip()
-
-        _INVERTER_MAP[next_inv] = self.hr_serial
+        # Re-registering keeps the address we had, if we still own it
+        next_inv = self.bus.allocate(self.hr_serial, self.idx)
+        if next_inv is None:
+            REGLOG.error("Too many (> %s) inverters attached to %s.",
+                         len(BUS_ADDRESSES), self.devname)
+            return
 
         # We do this in two steps so that create_pkt generates things correctly
-        serial_reg = self.serial
+        serial_reg = list(self.serial)
         serial_reg.append(next_inv)
-        pkt = create_pkt(APid, bcast, CtrlCodes["Register"],
-                         RegisterCodes["SendRegisterAddress"],
-                         data=serial_reg)
-        inpkt = self.xfer_pkt(pkt)
+        inpkt = yield create_pkt(APid, bcast, CtrlCodes["Register"],
+                                 RegisterCodes["SendRegisterAddress"],
+                                 data=serial_reg)
+        if not inpkt:
+            REGLOG.warning("No response to SendRegisterAddress on %s",
+                           self.devname)
+            return
         response = decode_pkt(inpkt)
         # Sanity-check the packet values
         if not response:
-            print("Empty response from decode_pkt (2)")
+            REGLOG.warning("Empty response from decode_pkt (2)")
             return
         if response["src"] != next_inv or \
            response["dest"] != APid or \
@@ -485,14 +945,14 @@ class Inverter(threading.Thread):
            not response["chksum"]["ok"] or \
            response["pktdata"][0] != jfyAck:
             # Garbage from this inverter, fail out
-            print("Got garbage response (2): {0}".format(response))
+            REGLOG.warning("Got garbage response (2): %s", response)
             return
+        if self.idx is not None and self.idx != next_inv:
+            self.bus.release(self.idx, self.hr_serial)
         self.isreg = True
         self.idx = next_inv
-        print("Registration succeeded for device with "
-              "serial number {0} on {1}".format(self.hr_serial, self.devname))
-        print("Registration process ended at ", datetime.datetime.now(),
-              file=sys.stderr)        
+        REGLOG.info("Registration succeeded for device with "
+                    "serial number %s on %s", self.hr_serial, self.devname)
         return
 
     def setup_sstore(self):
@@ -517,8 +977,8 @@ class Inverter(threading.Thread):
             self.sst.resource_add(resname)
             self.print_warnings()
         except SSException as exc:
-            print("Unable to add resource {0} to sstored: {1}".format(
-                resname, SSException.__str__))
+            SSTORELOG.error("Unable to add resource %s to sstored: %s",
+                            resname, exc)
             self.usesstore = False
             return
 
@@ -527,98 +987,1029 @@ class Inverter(threading.Thread):
             stats.append("{0}{1}//:stat.{2}".format(
                 RESOURCE_SSID_PREFIX, hr_serial, sname))
         self.stats = stats
+        # A fresh attach means sstored hasn't seen anything from us yet
+        self.sst_last = {}
         try:
             self.stats_array = self.sst.data_attach(stats)
             self.print_warnings()
         except SSException as exc:
-            print("Unable to attach stats to sstored\n{0} / {1}".format(
-                exc.message, exc.errno),
-                  file=sys.stderr)
+            SSTORELOG.error("Unable to attach stats to sstored: %s / %s",
+                            exc.message, exc.errno)
             self.usesstore = False
             self.sst.free()
             self.sst = None
 
-    def setup(self):
-        """ Performs the actual setup functions """
-        #
-        # Can we open the device, at 9600/8/n/1?
+    def open_device(self, timeout=10):
+        """
+        Opens the device at 9600/8/n/1, capturing its traffic if we've
+        been asked to. Fleet workers use a timeout of 0, since they
+        only read once select() says there's something there. Returns
+        True if the device is open.
+        """
         try:
             self.dev = serialposix.Serial(port=self.devname,
-                                          timeout=10,
+                                          timeout=timeout,
                                           exclusive=True)
         except ValueError as valex:
-            print("Unable to exclusively open {0} with default "
-                  "9600/8/n/1 parameters: {1}".format(
-                      self.devname, valex.args))
-            return
+            SERIALLOG.error("Unable to exclusively open %s with default "
+                            "9600/8/n/1 parameters: %s", self.devname,
+                            valex.args)
+            return False
         except serial.SerialException as serex:
-            print("Received SerialException attempting to open {0}".
-                  format(self.devname))
-            print("{0} : {1}".format(serex.errno, serex.strerror))
-            return
+            SERIALLOG.error("Received SerialException attempting to open "
+                            "%s: %s : %s", self.devname, serex.errno,
+                            serex.strerror)
+            return False
 
         self.dev.reset_input_buffer()
         self.dev.reset_output_buffer()
+        # Capturing the serial traffic?
+        if self.inv.get("capturepath"):
+            capname = capture_name(self.inv["capturepath"], self.devname)
+            try:
+                self.dev = CaptureTee(self.dev, self.devname, capname)
+            except OSError as exc:
+                SERIALLOG.error("Unable to capture traffic on %s to %s: %s",
+                                self.devname, capname, exc)
+        return True
+
+    def setup(self):
+        """ Performs the actual setup functions """
+        if not self.open_device():
+            return
+
         # Register with the inverter
         self.register()
         if not self.isreg:
-            self.logfile.close()
             self.dev.close()
             self.dev = None
             return
 
+        self.setup_outputs()
+
+        # Fetch the invariant information while we're here
+        self.refresh_invariants()
+
+    def setup_outputs(self, now=None):
+        """
+        Opens the outputs, once we know the serial number. now is the
+        time of the first sample, if that isn't now.
+        """
         # logfile checking:
-        self.logrotate()
+        self.logrotate(now)
 
         # Using sstored?
-        if self.usesstore:
+        if self.usesstore and not self.shm:
             self.setup_sstore()
 
+        # Using the time-series store?
+        if self.tsdbpath:
+            self.tsdb = TSDBWriter(self.tsdbpath, self.hr_serial)
+
+        # Running energy totals, which live alongside the logfiles
+        if self.integrate:
+            self.energy = EnergyIntegrator(self.energy_statefile())
+            self.energy_saved = time.monotonic()
+
+        # Serving our history?
+        if self.history:
+            self.history.track(self.hr_serial, self.inv)
+
+        # Counting towards the site totals?
+        if self.site:
+            self.site.track(self.hr_serial)
+
+        # the sink workers may now write spilled samples to us
+        self.outputs_open = True
+
+    def energy_statefile(self):
+        """ Where we persist the running energy totals """
+        return os.path.join(self.logpath, self.hr_serial, "energy.json")
+
+    def probe(self):
+        """
+        The circuit is open: see whether the inverter has come back by
+        re-registering with it.
+        """
+        self.register()
+        if self.isreg:
+            POLLLOG.info("Inverter %s on %s is back", self.hr_serial,
+                         self.devname)
+            self.health.succeeded()
+        else:
+            self.health.failed()
+
+    def poll_failed(self):
+        """ Notes a failed poll, and says so if the circuit opens """
+        wasopen = self.health.is_open()
+        self.health.failed()
+        if self.health.is_open() and not wasopen:
+            POLLLOG.warning("Inverter %s on %s not responding after %s "
+                            "attempts; probing every %ss", self.hr_serial,
+                            self.devname, self.health.failures,
+                            HEALTH_PROBEINTERVAL)
+        else:
+            POLLLOG.debug("No valid response from %s, backing off %.0fs",
+                          self.hr_serial, self.health.wait())
+
+    def reconfigure(self, inv):
+        """
+        Swaps in the output settings from a reloaded configuration
+        without interrupting polling.
+        """
+        with self.cfglock:
+            old = self.inv
+            self.inv = inv
+            self.apikey = inv["apikey"]
+            self.sysid = inv["sysid"]
+            self.deadbands = inv["deadbands"]
+            self.period = inv["pollinterval"]
+            self.sqlite = inv.get("sqlite")
+            self.history = inv.get("history")
+            self.mqtt = inv.get("mqtt")
+            if inv.get("site") is not self.site and self.isreg:
+                if self.site:
+                    self.site.forget(self.hr_serial)
+                if inv.get("site"):
+                    inv["site"].track(self.hr_serial)
+            self.site = inv.get("site")
+            if inv.get("anomaly") is not self.anomaly and self.anomaly:
+                self.anomaly.forget(self.hr_serial)
+            self.anomaly = inv.get("anomaly")
+            if self.history and self.isreg:
+                self.history.track(self.hr_serial, inv)
+                self.history.describe(self.hr_serial, self.get_invariants())
+            if inv["compress"] != old["compress"] or \
+               inv["tolerances"] != old["tolerances"]:
+                self.write_samples(self.flush_compressor())
+                if inv["compress"]:
+                    self.compressor = SwingingDoor(inv["tolerances"])
+                else:
+                    self.compressor = None
+            if inv["logpath"] != self.logpath:
+                # logrotate() opens the new one on the next poll
+                self.write_samples(self.flush_compressor())
+                self.logpath = inv["logpath"]
+                if self.logfile:
+                    self.logfile.close()
+                    self.logfile = None
+                if self.energy:
+                    self.energy.statefile = self.energy_statefile()
+            if inv["tsdbpath"] != self.tsdbpath:
+                if self.tsdb:
+                    self.tsdb.close()
+                    self.tsdb = None
+                self.tsdbpath = inv["tsdbpath"]
+                if self.tsdbpath and self.isreg:
+                    self.tsdb = TSDBWriter(self.tsdbpath, self.hr_serial)
+        MONLOG.info("Reconfigured inverter %s on %s", self.hr_serial,
+                    self.devname)
+
+    def save_energy(self):
+        """ Persists the energy totals """
+        # logrotate() creates the directory, but it may have failed
+        try:
+            self.energy.save()
+        except OSError as exc:
+            ENERGYLOG.error("Unable to save energy totals to %s: %s",
+                            self.energy.statefile, exc)
+        self.energy_saved = time.monotonic()
+
+    def stop(self):
+        """ Asks the polling loop to shut down """
+        self.stopping.set()
+
+    def active(self):
+        """ Are we still polling, from our own thread or a fleet worker? """
+        if self.session:
+            return not self.session.closed.is_set()
+        return self.is_alive()
+
+    def shutdown(self):
+        """ Flushes and closes everything we have open """
+        # flush and close the device
+        if self.dev:
+            self.dev.flush()
+            self.dev.close()
+            self.dev = None
+        if self.site:
+            self.site.forget(self.hr_serial)
+        if self.anomaly:
+            self.anomaly.forget(self.hr_serial)
+        # let the sink workers write what we've given them
+        if self.sinks:
+            self.sinks.flush(self)
+        with self.cfglock:
+            self.close_outputs()
+        if self.idx is not None:
+            self.bus.release(self.idx, self.hr_serial)
+
+    def close_outputs(self):
+        """ Closes the outputs; called with cfglock held """
+        self.outputs_closed = True
+        # break connection to sstored
+        if self.sst:
+            self.sst.free()
+            self.sst = None
+        # close the time-series store
+        if self.tsdb:
+            self.tsdb.close()
+            self.tsdb = None
+        # close the logfile
+        if self.logfile:
+            self.write_samples(self.flush_compressor())
+            self.logfile.close()
+            self.logfile = None
+        # persist the energy totals
+        if self.energy:
+            self.save_energy()
+        # send whatever we have for the current pvoutput.org interval
+        if self.apikey:
+            valdata = self.pvslot.status()
+            if valdata:
+                self.pvoutput_send(valdata)
+
+    def wait_for_slot(self):
+        """
+        Sleeps until the next multiple of self.period seconds on the
+        wall clock and returns that slot as a datetime, or None if
+        we've been asked to stop in the meantime. If a poll overran,
+        we've simply missed the slots it overran into.
+        """
+        now = time.time()
+        slot = (math.floor(now / self.period) + 1) * self.period
+        if self.stopping.wait(slot - now):
+            return None
+        return datetime.datetime.fromtimestamp(slot)
+
     def run(self):
         """ This is where we do all the work. """
-        while True:
-            # check whether we need to rotate the logfile
-            self.logrotate()
-            if not self.dev:
-                return
+        while not self.stopping.is_set():
+            # don't hammer the bus if the inverter isn't answering
+            if self.stopping.wait(self.health.wait()):
+                break
+            if self.health.is_open():
+                self.probe()
+                continue
+
+            # Samples are stamped with their slot. If we're not
+            # daemonizing, there's no point waiting for one.
+            if self.oneshot:
+                slot = self.wait_for_slot()
+                if slot is None:
+                    break
+            else:
+                slot = datetime.datetime.now().replace(microsecond=0)
 
             # query the inverter
             stats = self.query_normal_info()
             if not stats:
+                self.poll_failed()
                 continue
-            if self.debug:
-                print("stats {0}".format(stats))
+            self.health.succeeded()
+            POLLLOG.debug("stats %s", stats)
 
-            line = getline(stats)
+            self.publish(slot, stats)
 
-            if self.logfile:
-                self.logfile.write(line)
+            # shutdown if required
+            if not self.oneshot:
+                POLLLOG.info("Not daemonizing")
+                break
+
+            # refetch the invariant information if the cache has
+            # expired; we do this after the poll so it can't make us
+            # late for the slot
+            if self.invariants_expired():
+                self.refresh_invariants()
+
+        self.shutdown()
 
-            # update sstored
-            if self.usesstore:
+    def replay(self, capname, speed):
+        """
+        Feeds the inverter's responses in a capture through decode_pkt
+        and on to our outputs, at speed times the rate at which they
+        were captured (or as fast as we can, if speed is 0). Returns
+        the number of samples replayed.
+        """
+        nsamples = 0
+        first = None             # monotonic ns of the first sample
+        origin = None            # wall clock time of an untimed capture
+        asked = None             # the function code we last sent
+        started = time.monotonic()
+        for nsecs, tstamp, direction, frame in read_capture(capname):
+            response = decode_pkt(frame)
+            if not response or not response["chksum"]["ok"]:
+                continue
+            if direction != "rx":
+                asked = response["func"]
+                continue
+            if response["ctrl"] == CtrlCodes["Register"] and \
+               response["func"] == "OfflineQueryResponse":
+                if self.hr_serial is None:
+                    self.set_serial(response["pktdata"])
+                continue
+            # Only take the response to a QueryNormalInfo as a sample
+            if response["ctrl"] != CtrlCodes["Read"] or \
+               response["func"] != "QueryNormalInfoResponse" or \
+               asked != "QueryNormalInfo":
+                continue
+
+            if nsecs is not None and speed:
+                if first is None:
+                    first = nsecs
+                delay = started + (nsecs - first) / 1e9 / speed - \
+                    time.monotonic()
+                if delay > 0 and self.stopping.wait(delay):
+                    break
+            if tstamp is None:
+                # no timing in the capture, so assume one poll per period
+                if origin is None:
+                    origin = datetime.datetime.now().replace(microsecond=0)
+                tstamp = origin + datetime.timedelta(
+                    seconds=nsamples * self.period)
+            tstamp = tstamp.replace(microsecond=0)
+
+            if self.logfile is None:
+                if self.hr_serial is None:
+                    # the capture started after registration
+                    self.hr_serial = os.path.basename(capname)
+                self.setup_outputs(tstamp)
+            self.output(tstamp, self.unpack_normal_info(response["pktdata"]))
+            nsamples += 1
+
+        self.shutdown()
+        return nsamples
+
+    def publish(self, tstamp, stats):
+        """
+        Hands a sample to the sink workers (see jfysinks.py), or writes
+        it to the outputs ourselves if there aren't any, and adds it to
+        the site totals and the anomaly checks.
+        """
+        if self.sinks:
+            self.sinks.put(self, tstamp, stats)
+        else:
+            self.output(tstamp, stats)
+        if self.site:
+            self.site.add(self.hr_serial, tstamp, stats)
+        if self.anomaly:
+            self.anomaly.add(self.hr_serial, tstamp, stats)
+
+    def output(self, tstamp, stats):
+        """ Sends a sample to each of the configured outputs """
+        for sink in SINK_POLICIES:
+            getattr(self, "output_" + sink)(tstamp, stats)
+
+    # The output_<sink>() methods each write a sample to one output. The
+    # sink workers call them from their own threads, so they hold
+    # cfglock against reconfigure() and shutdown().
+
+    def output_logfile(self, tstamp, stats):
+        """ The logfile (and SQLite), rotating it if the day has changed """
+        with self.cfglock:
+            if self.outputs_closed:
+                return
+            self.logrotate(tstamp)
+            if self.compressor:
+                self.write_samples(self.compressor.add(tstamp, stats))
+            else:
+                self.write_samples([(tstamp, stats)])
+
+    def output_tsdb(self, tstamp, stats):
+        """ The time-series store """
+        with self.cfglock:
+            if self.tsdb:
+                self.tsdb.append(tstamp, stats)
+
+    def output_energy(self, tstamp, stats):
+        """ The running energy totals """
+        with self.cfglock:
+            if self.energy and not self.outputs_closed:
+                self.energy.add(tstamp, stats)
+                if self.history:
+                    day = tstamp.strftime("%Y-%m-%d")
+                    self.history.tally(self.hr_serial, {
+                        "day": round(self.energy.day_total(day), 1),
+                        "month": round(self.energy.month_total(day[:7]), 1)})
+                if time.monotonic() - self.energy_saved >= \
+                   ENERGY_SAVEINTERVAL:
+                    self.save_energy()
+
+    def output_history(self, tstamp, stats):
+        """ The history API's recent samples """
+        with self.cfglock:
+            if self.history and not self.outputs_closed:
+                self.history.add(self.hr_serial, tstamp, stats)
+
+    def output_stats(self, tstamp, stats):
+        """ sstored, or its shared memory equivalent """
+        with self.cfglock:
+            if self.shm and not self.outputs_closed:
+                self.shm.update(self.hr_serial, tstamp, stats)
+            elif self.usesstore and self.sst:
                 self.sstore_update(stats)
 
-            # update pvoutput.org
-            if self.apikey:
-                self.pvoutput_update(stats)
+    def output_mqtt(self, tstamp, stats):
+        """ The MQTT broker """
+        with self.cfglock:
+            if self.mqtt and not self.outputs_closed:
+                self.mqtt.add(self.hr_serial, tstamp, stats)
 
-            # shutdown if required
-            if not self.oneshot:
-                print("Not daemonizing")
-                # flush and close the device
-                self.dev.flush()
-                self.dev.close()
-                # break connection to sstored
-                if self.sst:
-                    self.sst.free()
-                    self.sst = None
-                # close the logfile
-                if self.logfile:
-                    self.logfile.close()
-                    self.logfile = None
+    def output_pvoutput(self, tstamp, stats):
+        """ pvoutput.org; we don't hold cfglock while sending """
+        with self.cfglock:
+            if self.outputs_closed or not self.apikey:
+                return
+            valdata = self.pvslot.add(tstamp, stats)
+        if valdata:
+            self.pvoutput_send(valdata)
+
+
+class FleetSession():
+    """
+    Runs an Inverter from a FleetWorker instead of its own thread. We
+    keep to the same schedule as Inverter.run(), and drive the same
+    *_steps() protocol generators, but never block: each packet is
+    written and the worker calls us back when the response arrives, or
+    when FLEET_TIMEOUT runs out. Between transfers, the deadline is
+    when the next step (registering, or polling) is due.
+    """
+
+    def __init__(self, inverter):
+        self.inverter = inverter
+        self.worker = None       # the FleetWorker driving us
+        self.steps = None        # protocol generator in progress
+        self.ondone = None       # called with the generator's result
+        self.pkt = None          # the packet awaiting a response
+        self.tries = 0           # times we've sent it
+        self.buf = b""           # what we've read of the response
+        self.slot = None         # the slot we're polling for
+        self.nextstep = self.start_register
+        self.deadline = time.monotonic()
+        self.finished = False
+        self.closed = threading.Event()
+
+    def __repr__(self):
+        return "fleet session for {0}".format(self.inverter.devname)
+
+    def fileno(self):
+        """ The device's file descriptor, for the worker's selector """
+        return self.inverter.dev.fileno()
+
+    def schedule(self, when, nextstep):
+        """ Arranges for nextstep to be called at time.monotonic() when """
+        self.nextstep = nextstep
+        self.deadline = when
+
+    def begin(self, steps, ondone):
+        """ Starts driving a protocol generator, see Inverter.drive() """
+        self.steps = steps
+        self.ondone = ondone
+        self.advance(None)
+
+    def advance(self, response):
+        """ Sends the generator a response, and transmits its next packet """
+        try:
+            pkt = self.steps.send(response)
+        except StopIteration as stop:
+            self.steps = None
+            self.ondone(stop.value)
+            return
+        self.tries = 0
+        self.transmit(pkt)
+
+    def transmit(self, pkt):
+        """ Writes a packet and starts waiting for the response """
+        dev = self.inverter.dev
+        dev.reset_input_buffer()
+        rval = dev.write(pkt)
+        if rval != len(pkt):
+            SERIALLOG.warning("Unable to write all of bytestream. %s of "
+                              "%s transferred.", rval, len(pkt))
+        self.pkt = pkt
+        self.buf = b""
+        self.tries += 1
+        self.deadline = time.monotonic() + FLEET_TIMEOUT
+
+    def readable(self):
+        """ Collects the response, and acts on it once it's complete """
+        data = self.inverter.dev.read(FLEET_READSIZE)
+        if self.steps is None or not data:
+            # line noise, or a response we've given up on
+            return
+        self.buf += data
+        for _offset, frame in scan_frames(self.buf):
+            if frame == self.pkt:
+                # our own packet, echoed by a two-wire adapter
+                continue
+            SERIALLOG.debug("response %s", frame)
+            self.advance(frame)
+            return
+
+    def expired(self):
+        """ Retries a transfer, or takes the next step """
+        if self.steps is not None:
+            if self.tries < xfer_tries(self.pkt):
+                self.transmit(self.pkt)
+            else:
+                self.advance(None)
+            return
+        self.nextstep()
+
+    def idle(self, _result=None):
+        """ Works out what we have to do next, and when """
+        inv = self.inverter
+        if inv.stopping.is_set():
+            self.finished = True
+            return
+        now = time.monotonic()
+        if not inv.isreg or inv.health.is_open():
+            # registering, or probing an inverter which stopped answering
+            if not inv.isreg and not inv.oneshot and inv.logfile is None:
+                MONLOG.error("Registration failed for %s", inv.devname)
+                self.finished = True
+                return
+            self.schedule(max(now, inv.health.next_attempt),
+                          self.start_register)
+            return
+        # Samples are stamped with their slot. If we're not
+        # daemonizing, there's no point waiting for one.
+        if not inv.oneshot:
+            self.slot = datetime.datetime.now().replace(microsecond=0)
+            self.schedule(now, self.start_poll)
+            return
+        wall = time.time()
+        slot = (math.floor((wall + inv.health.wait()) / inv.period) + 1) * \
+            inv.period
+        self.slot = datetime.datetime.fromtimestamp(slot)
+        self.schedule(now + slot - wall, self.start_poll)
+
+    def start_register(self):
+        """ Registers (or re-registers) with the inverter """
+        self.begin(self.inverter.register_steps(), self.registered)
+
+    def registered(self, _result):
+        """ Sets up the outputs the first time we register """
+        inv = self.inverter
+        if not inv.isreg:
+            inv.health.failed()
+            self.idle()
+            return
+        if inv.health.is_open():
+            POLLLOG.info("Inverter %s on %s is back", inv.hr_serial,
+                         inv.devname)
+        inv.health.succeeded()
+        if inv.logfile is None:
+            inv.name = "inverter-" + inv.hr_serial
+            inv.setup_outputs()
+            # Fetch the invariant information while we're here
+            self.begin(inv.refresh_steps(), self.idle)
+            return
+        self.idle()
+
+    def start_poll(self):
+        """ Queries the inverter for the current slot """
+        self.begin(self.inverter.normal_info_steps(), self.polled)
+
+    def polled(self, stats):
+        """ Sends a sample to the outputs """
+        inv = self.inverter
+        if not stats:
+            inv.poll_failed()
+            self.idle()
+            return
+        inv.health.succeeded()
+        POLLLOG.debug("stats %s", stats)
+
+        inv.publish(self.slot, stats)
+
+        if not inv.oneshot:
+            POLLLOG.info("Not daemonizing")
+            self.finished = True
+            return
+
+        # as in Inverter.run(), after the poll so it can't make us late
+        if inv.invariants_expired():
+            self.begin(inv.refresh_steps(), self.idle)
+        else:
+            self.idle()
+
+    def close(self):
+        """ Called by the worker once it has dropped us """
+        if not self.closed.is_set():
+            self.inverter.shutdown()
+            self.closed.set()
+
+
+# Changing any of these in an [inverter-N] section (or in [global])
+# means restarting the inverter rather than reconfiguring it.
+RESTART_KEYS = ["devname", "usesstore", "shmpath", "capturepath"]
+
+# Shared objects that Monitor adds to each inverter's settings
+SHARED_KEYS = ["sqlite", "shm", "history", "sinks", "mqtt", "site",
+               "anomaly"]
+
+
+def _settings(inv):
+    """ Returns the settings in inv without the shared objects """
+    return {key: val for key, val in inv.items() if key not in SHARED_KEYS}
+
+
+class Monitor():
+    """
+    Owns the running inverters and the outputs they share, and
+    reloads the configuration on SIGHUP.
+    """
+
+    def __init__(self, cfgfile, logpath, oneshot, debug):
+        self.cfgfile = cfgfile
+        self.logpath = logpath
+        self.oneshot = oneshot
+        self.debug = debug
+        self.inverters = {}      # devname -> Inverter
+        self.fleetworkers = 0    # how many FleetWorkers, if any
+        self.workers = []        # the FleetWorkers
+        self.sqlsinks = {}       # database name -> SQLiteSink
+        self.shm = None          # ShmWriter, if we're using one
+        self.oldshm = []         # replaced by a reload, still in use
+        self.history = History()  # recent samples, for the history API
+        self.http = None         # HistoryServer, if we're serving
+        self.http_addr = None    # (address, port) we should serve on
+        self.sinks = None        # Dispatcher for the outputs
+        self.maintainer = Maintainer()  # compresses and prunes old days
+        self.mqtt = None         # MQTTPublisher, if we're publishing
+        self.oldmqtt = []        # replaced by a reload, still in use
+        self.site = None         # the site's virtual Inverter, if any
+        self.aggregator = None   # SiteAggregator feeding it
+        self.anomaly = None      # AnomalyDetector, if we're looking
+        self.running = False     # have we started the threads?
+        self.reload_wanted = threading.Event()
+        self.profiler = Profiler(logpath)
+        self.profile_wanted = threading.Event()
+        self.snapshot_wanted = threading.Event()
+
+    def attach_sinks(self, attached):
+        """ Adds the shared outputs to each inverter's settings """
+        # One SQLite writer per database, shared between inverters
+        for inv in attached:
+            dbname = inv["sqlitedb"]
+            if dbname and dbname not in self.sqlsinks:
+                self.sqlsinks[dbname] = SQLiteSink(dbname, self.debug)
+                if self.running:
+                    self.sqlsinks[dbname].start()
+            inv["sqlite"] = self.sqlsinks.get(dbname)
+        # Without sstored, usesstore means the shared memory segment
+        if SStore is None and attached and attached[0]["usesstore"]:
+            shmpath = attached[0]["shmpath"]
+            if self.shm is None or self.shm.path != shmpath:
+                if self.shm:
+                    # release_sinks() closes it once nothing is using it
+                    self.oldshm.append(self.shm)
+                self.shm = ShmWriter(shmpath)
+        for inv in attached:
+            inv["shm"] = self.shm if inv["usesstore"] else None
+        # The history API is configured in [global]
+        self.http_addr = None
+        if attached and attached[0]["httpport"]:
+            self.http_addr = (attached[0]["httpaddr"],
+                              attached[0]["httpport"])
+        for inv in attached:
+            inv["history"] = self.history if self.http_addr else None
+        # One worker per output, shared between inverters
+        if attached:
+            if self.sinks is None:
+                self.sinks = Dispatcher(attached[0]["spoolpath"],
+                                        self.lookup,
+                                        attached[0]["sinkpolicies"],
+                                        attached[0]["sinkqueue"])
+                if self.running:
+                    self.sinks.start()
+            else:
+                self.sinks.configure(attached[0]["sinkpolicies"])
+        for inv in attached:
+            inv["sinks"] = self.sinks
+        # One MQTT connection, configured in [global]
+        settings = attached[0]["mqttsettings"] if attached else None
+        if self.mqtt and self.mqtt.settings != settings:
+            # release_sinks() closes it once nothing is using it
+            self.oldmqtt.append(self.mqtt)
+            self.mqtt = None
+        if self.mqtt is None and settings:
+            self.mqtt = MQTTPublisher(settings)
+            if self.running:
+                self.mqtt.start()
+        for inv in attached:
+            inv["mqtt"] = self.mqtt
+        # One set of anomaly checks, since they compare the inverters
+        settings = attached[0]["anomalysettings"] if attached else None
+        if self.anomaly and self.anomaly.settings != settings:
+            self.anomaly = None
+        if self.anomaly is None and settings:
+            self.anomaly = AnomalyDetector(settings, self.anomaly_event)
+        for inv in attached:
+            inv["anomaly"] = self.anomaly
+        # The site totals go to the outputs through a virtual inverter
+        settings = attached[0]["sitesettings"] if attached else None
+        site = self.site_settings(attached[0]) if settings else None
+        if self.site and (site is None or any(
+                [site[key] != self.site.inv[key] for key in RESTART_KEYS])):
+            self.stop_site()
+        if self.site is None and site:
+            self.start_site(site)
+        elif site and (_settings(site) != _settings(self.site.inv) or any(
+                [site[key] is not self.site.inv[key] for key in SHARED_KEYS])):
+            self.site.reconfigure(site)
+        for inv in attached:
+            inv["site"] = self.aggregator
+        # Day file retention is configured in [global]
+        if attached:
+            self.maintainer.configure(
+                [inv["logpath"] for inv in attached],
+                attached[0]["compressafter"] or None,
+                attached[0]["downsampleafter"],
+                attached[0]["downsampleres"],
+                attached[0]["retaindays"])
+
+    def site_settings(self, inv):
+        """
+        Returns the site's virtual inverter settings: the [global] ones
+        (and shared outputs) from inv, with those from [site].
+        """
+        site = dict(inv)
+        settings = inv["sitesettings"]
+        site.update({
+            "devname": "site:" + settings["serial"],
+            "apikey": settings["apikey"],
+            "sysid": settings["sysid"],
+            "logpath": settings["logpath"] or self.logpath,
+            "sqlitedb": settings["sqlitedb"],
+            "compress": False,
+            "capturepath": None,
+            "site": None,
+            "anomaly": None
+        })
+        dbname = site["sqlitedb"]
+        if dbname and dbname not in self.sqlsinks:
+            self.sqlsinks[dbname] = SQLiteSink(dbname, self.debug)
+            if self.running:
+                self.sqlsinks[dbname].start()
+        site["sqlite"] = self.sqlsinks.get(dbname)
+        return site
+
+    def start_site(self, site):
+        """ Starts publishing the site totals as a virtual inverter """
+        thr = Inverter(site, self.oneshot, self.debug)
+        thr.set_serial(site["sitesettings"]["serial"].encode("ascii"))
+        thr.isreg = True
+        thr.setup_outputs()
+        self.site = thr
+        self.aggregator = SiteAggregator(
+            site["pollinterval"] * SITE_STALEPOLLS, thr.publish)
+        MONLOG.info("Publishing the site totals as %s", thr.hr_serial)
+
+    def stop_site(self):
+        """ Publishes the last site totals and closes the virtual inverter """
+        self.aggregator.flush()
+        self.site.shutdown()
+        self.site = None
+        self.aggregator = None
+
+    def anomaly_event(self, event):
+        """ Reports an anomaly raised or cleared by the checks """
+        when = datetime.datetime.fromtimestamp(event["tstamp"])
+        if event["state"] == "raised":
+            ANOMALYLOG.warning("%s: %s is at %.0f%% of its usual level "
+                               "since %s", event["serial"], event["check"],
+                               event["ratio"] * 100, when)
+        else:
+            ANOMALYLOG.info("%s: %s is back to %.0f%% of its usual level "
+                            "at %s", event["serial"], event["check"],
+                            event["ratio"] * 100, when)
+        if self.mqtt:
+            self.mqtt.event(event)
+        self.history.stream.announce(event)
+
+    def lookup(self, devname):
+        """ Returns the running Inverter (or the site's) for devname """
+        if self.site and self.site.devname == devname:
+            return self.site
+        return self.inverters.get(devname)
+
+    def release_sinks(self):
+        """ Closes any shared outputs which no inverter uses any more """
+        users = list(self.inverters.values())
+        if self.site:
+            users.append(self.site)
+        for dbname in list(self.sqlsinks):
+            if not any([thr.sqlite is self.sqlsinks[dbname]
+                        for thr in users]):
+                if self.running:
+                    self.sqlsinks[dbname].close()
+                del self.sqlsinks[dbname]
+        if self.shm and not any([thr.shm is self.shm for thr in users]):
+            self.shm.close()
+            self.shm = None
+        for shm in list(self.oldshm):
+            if not any([thr.shm is shm for thr in users]):
+                shm.close()
+                self.oldshm.remove(shm)
+        for mqtt in list(self.oldmqtt):
+            if not any([thr.mqtt is mqtt for thr in users]):
+                if self.running:
+                    mqtt.close()
+                self.oldmqtt.remove(mqtt)
+
+    def add_inverter(self, inv):
+        """ Registers with an inverter, and starts it if we're running """
+        thr = Inverter(inv, self.oneshot, self.debug)
+        if self.fleetworkers:
+            # the fleet worker registers with it
+            if not thr.open_device(timeout=0):
                 return
+            thr.session = FleetSession(thr)
+            self.inverters[inv["devname"]] = thr
+            if self.running:
+                self.assign(thr.session)
+            return
+        thr.setup()
+        if not thr.isreg:
+            # didn't get registration
+            MONLOG.error("Registration failed for %s", inv["devname"])
+            return
+        thr.name = "inverter-" + thr.hr_serial
+        self.inverters[inv["devname"]] = thr
+        if self.running:
+            thr.start()
+
+    def assign(self, session):
+        """ Hands a fleet session to the least busy worker """
+        session.worker = min(self.workers, key=len)
+        session.worker.add(session)
+
+    def stop_inverter(self, devname):
+        """ Stops an inverter and waits for it to finish """
+        thr = self.inverters.pop(devname)
+        thr.stop()
+        if thr.session and thr.session.worker:
+            thr.session.worker.remove(thr.session)
+            thr.session.closed.wait()
+        elif thr.session:
+            thr.session.close()
+        elif thr.is_alive():
+            thr.join()
+        MONLOG.info("Stopped inverter %s on %s", thr.hr_serial, devname)
+
+    def update_http(self):
+        """ Starts, moves or stops the history API to suit the config """
+        if self.http and self.http.addr != self.http_addr:
+            self.http.close()
+            self.http = None
+        if self.http is None and self.http_addr:
+            try:
+                self.http = HistoryServer(self.history, *self.http_addr,
+                                          metrics=self.sinks.metrics)
+            except OSError as exc:
+                MONLOG.error("Unable to serve history on %s:%s: %s",
+                             self.http_addr[0], self.http_addr[1], exc)
+                return
+            self.http.start()
+
+    def setup(self, attached):
+        """ Registers with each of the configured inverters """
+        if attached:
+            self.fleetworkers = attached[0]["fleetworkers"]
+        self.attach_sinks(attached)
+        for inv in attached:
+            self.add_inverter(inv)
+        self.release_sinks()
+
+    def reload(self):
+        """
+        Rereads the configuration file and applies the differences to
+        the running inverters.
+        """
+        MONLOG.info("Reloading configuration from %s", self.cfgfile)
+        try:
+            attached = parse_cfg(self.cfgfile, self.logpath)
+        except (configparser.Error, KeyError, ValueError) as exc:
+            MONLOG.error("Unable to reload configuration, keeping the "
+                         "current one: %s", exc)
+            return
+        if attached:
+            set_levels(self.debug, attached[0]["loglevels"])
+            if attached[0]["fleetworkers"] != self.fleetworkers:
+                MONLOG.warning("fleetworkers= only changes on restart")
+        self.attach_sinks(attached)
+        wanted = dict([(inv["devname"], inv) for inv in attached])
+        for devname in list(self.inverters):
+            inv = wanted.get(devname)
+            old = self.inverters[devname].inv
+            if inv is None or \
+               any([inv[key] != old[key] for key in RESTART_KEYS]):
+                self.stop_inverter(devname)
+        for devname, inv in wanted.items():
+            thr = self.inverters.get(devname)
+            if thr is None:
+                self.add_inverter(inv)
+            elif _settings(inv) != _settings(thr.inv) or \
+                    inv["sqlite"] is not thr.sqlite or \
+                    inv["mqtt"] is not thr.mqtt or \
+                    inv["site"] is not thr.site or \
+                    inv["anomaly"] is not thr.anomaly:
+                thr.reconfigure(inv)
+        self.release_sinks()
+        self.update_http()
+
+    def run(self):
+        """ Runs the inverters until they've all finished """
+        self.running = True
+        for sink in self.sqlsinks.values():
+            sink.start()
+        if self.sinks:
+            self.sinks.start()
+        if self.mqtt:
+            self.mqtt.start()
+        self.maintainer.start()
+        for num in range(self.fleetworkers):
+            self.workers.append(FleetWorker("fleet-{0}".format(num)))
+            self.workers[-1].start()
+        for thr in self.inverters.values():
+            if thr.session:
+                self.assign(thr.session)
             else:
-                time.sleep(30)
+                thr.start()
+        self.update_http()
+        # The handlers only flag the work, which we do from this loop
+        signal.signal(signal.SIGHUP,
+                      lambda _signum, _frame: self.reload_wanted.set())
+        signal.signal(signal.SIGUSR1,
+                      lambda _signum, _frame: self.profile_wanted.set())
+        signal.signal(signal.SIGUSR2,
+                      lambda _signum, _frame: self.snapshot_wanted.set())
+        while any([thr.active() for thr in self.inverters.values()]):
+            if self.reload_wanted.wait(1):
+                self.reload_wanted.clear()
+                self.reload()
+            if self.profile_wanted.is_set():
+                self.profile_wanted.clear()
+                self.profiler.toggle()
+            if self.snapshot_wanted.is_set():
+                self.snapshot_wanted.clear()
+                self.profiler.memory()
+        for worker in self.workers:
+            worker.stop()
+            worker.join()
+        self.maintainer.stop()
+        self.maintainer.join()
+        if self.site:
+            self.stop_site()
+        if self.http:
+            self.http.close()
+        if self.sinks:
+            self.sinks.close()
+        if self.mqtt:
+            self.mqtt.close()
+        for sink in self.sqlsinks.values():
+            sink.close()
+        if self.shm:
+            self.shm.close()
+        for shm in self.oldshm:
+            shm.close()
+
+    def replay(self, attached, capname, speed):
+        """
+        Replays a capture through the outputs configured for the
+        device it was captured from (or the first inverter, if we
+        can't tell). Nothing is sent to pvoutput.org: the data has
+        already been sent, or belongs to somebody else. Nor do we touch
+        the stats or energy totals, which the daemon may be keeping
+        for the same inverter as we speak.
+        """
+        devname = read_header(capname).get("devname")
+        matches = [inv for inv in attached if inv["devname"] == devname]
+        inv = dict(matches[0] if matches else attached[0])
+        inv["apikey"] = None
+        inv["mqttsettings"] = None
+        inv["sitesettings"] = None
+        inv["anomalysettings"] = None
+        inv["usesstore"] = False
+        inv["integrate"] = False
+        self.attach_sinks([inv])
+        # we write the samples ourselves, so none are dropped
+        inv["sinks"] = None
+        self.running = True
+        for sink in self.sqlsinks.values():
+            sink.start()
+        thr = Inverter(inv, True, self.debug)
+        started = time.monotonic()
+        nsamples = thr.replay(capname, speed)
+        elapsed = time.monotonic() - started
+        MONLOG.info("Replayed %s samples from %s in %.1fs (%.0f/s)",
+                    nsamples, capname, elapsed, nsamples / max(elapsed, 1e-6))
+        for sink in self.sqlsinks.values():
+            sink.close()
+        if self.shm:
+            self.shm.close()
 
 
 def parseargs(arglist):
@@ -633,7 +2024,7 @@ def parseargs(arglist):
     cfgfile = ""
     readcode = None
     debug = False
-    lopts, extra = getopt.getopt(arglist, "dF:l:ox:")
+    lopts, extra = getopt.getopt(arglist, "dF:l:ox:r:s:")
     dopts = dict(lopts)
 
     if '-F' not in dopts:
@@ -657,7 +2048,13 @@ def parseargs(arglist):
     if '-d' in dopts:
         debug = True
 
-    return cfgfile, logpath, daemonize, readcode, debug
+    capture = dopts.get("-r")
+    try:
+        speed = float(dopts.get("-s", 1))
+    except ValueError:
+        usage(True)
+
+    return cfgfile, logpath, daemonize, readcode, debug, capture, speed
 
 
 def parse_cfg(cfgfile, logpath):
@@ -666,16 +2063,111 @@ def parse_cfg(cfgfile, logpath):
     cfg.read(cfgfile)
     if len(cfg.sections()) < 2 or not cfg["global"]:
         # Not enough sections
-        print("Supplied configuration file {0} is incorrectly formed:\n"
-              "no [global] section found".format(cfgfile),
-              file=sys.stderr)
+        MONLOG.error("Supplied configuration file %s is incorrectly formed: "
+                     "no [global] section found", cfgfile)
     usesstore = cfg["global"].getboolean("usesstore")
+    tsdbpath = cfg["global"].get("tsdbpath")
+    sqlitedb = cfg["global"].get("sqlitedb")
+    shmpath = cfg["global"].get("shmpath", SHM_PATH)
+    httpport = cfg["global"].getint("httpport")
+    httpaddr = cfg["global"].get("httpaddr", HTTP_ADDR)
+    capturepath = cfg["global"].get("capturepath")
+    fleetworkers = cfg["global"].getint("fleetworkers", 0)
+    spoolpath = cfg["global"].get("spoolpath", os.path.join(logpath, "spool"))
+    sinkqueue = cfg["global"].getint("sinkqueue", SINK_QUEUELEN)
+    compressafter = cfg["global"].getint("compressafter", LOG_COMPRESSAFTER)
+    downsampleafter = cfg["global"].getint("downsampleafter")
+    downsampleres = cfg["global"].getint("downsampleres", LOG_DOWNSAMPLERES)
+    retaindays = cfg["global"].getint("retaindays")
+    mqttsettings = None
+    if cfg.has_option("global", "mqtthost"):
+        mqttsettings = {
+            "host": cfg["global"]["mqtthost"],
+            "port": cfg["global"].getint("mqttport", MQTT_PORT),
+            "topic": cfg["global"].get("mqtttopic", MQTT_TOPIC),
+            "qos": cfg["global"].getint("mqttqos", MQTT_QOS),
+            "retain": cfg["global"].getboolean("mqttretain", True),
+            "clientid": cfg["global"].get("mqttclientid",
+                                          "jfy-" + platform.node()),
+            "username": cfg["global"].get("mqttuser"),
+            "password": cfg["global"].get("mqttpassword")
+        }
+        if mqttsettings["qos"] not in [0, 1]:
+            raise ValueError("Unsupported MQTT QoS {0}".format(
+                mqttsettings["qos"]))
+    sinkpolicies = {}
+    for sink in SINK_POLICIES:
+        if cfg.has_option("global", "sinkpolicy-" + sink):
+            sinkpolicies[sink] = cfg["global"]["sinkpolicy-" + sink]
+            if sinkpolicies[sink] not in POLICIES:
+                raise ValueError("Unknown sink policy {0}".format(
+                    sinkpolicies[sink]))
+    pollinterval = cfg["global"].getint("pollinterval", POLLINTERVAL)
+    tolerances = dict(COMPRESSTOLERANCES)
+    for fname in JFYData:
+        if cfg.has_option("global", "tolerance-" + fname):
+            tolerances[fname] = cfg["global"].getfloat("tolerance-" + fname)
+    deadbands = dict(STATDEADBANDS)
+    for sname in STATS:
+        if cfg.has_option("global", "deadband-" + sname):
+            deadbands[sname] = cfg["global"].getfloat("deadband-" + sname)
+    loglevels = {}
+    for subsystem in LOG_SUBSYSTEMS:
+        if cfg.has_option("global", "loglevel-" + subsystem):
+            loglevels[subsystem] = parse_level(
+                cfg["global"]["loglevel-" + subsystem])
+    # The site totals, if wanted, are configured in [site]
+    sitesettings = None
+    if cfg.has_section("site"):
+        sitesettings = {
+            "serial": cfg["site"].get("serial", SITE_SERIAL),
+            "apikey": cfg["site"].get("pvoutput_apikey"),
+            "sysid": cfg["site"].get("pvoutput_sysid"),
+            "logpath": cfg["site"].get("logpath"),
+            "sqlitedb": sqlitedb
+        }
+        cfg.remove_section("site")
+    anomalysettings = None
+    if cfg["global"].getboolean("anomalies", False):
+        anomalysettings = {
+            "drop": cfg["global"].getfloat("anomalydrop", ANOMALY_DROP)
+        }
+        if not 0 < anomalysettings["drop"] < 1:
+            raise ValueError("anomalydrop= must be between 0 and 1")
     # Now to deal with the inverters
     cfg.remove_section("global")
     rlist = list()
     for invsect in cfg.sections():
         inv = {}
         inv["usesstore"] = usesstore
+        inv["deadbands"] = deadbands
+        inv["loglevels"] = loglevels
+        inv["tolerances"] = tolerances
+        inv["tsdbpath"] = tsdbpath
+        inv["shmpath"] = shmpath
+        inv["httpport"] = httpport
+        inv["httpaddr"] = httpaddr
+        inv["capturepath"] = capturepath
+        inv["fleetworkers"] = fleetworkers
+        inv["spoolpath"] = spoolpath
+        inv["sinkqueue"] = sinkqueue
+        inv["sinkpolicies"] = sinkpolicies
+        inv["compressafter"] = compressafter
+        inv["downsampleafter"] = downsampleafter
+        inv["downsampleres"] = downsampleres
+        inv["retaindays"] = retaindays
+        inv["pollinterval"] = pollinterval
+        inv["mqttsettings"] = mqttsettings
+        inv["sitesettings"] = sitesettings
+        inv["anomalysettings"] = anomalysettings
+        if cfg.has_option(invsect, "sqlitedb"):
+            inv["sqlitedb"] = cfg[invsect]["sqlitedb"]
+        else:
+            inv["sqlitedb"] = sqlitedb
+        if cfg.has_option(invsect, "compress"):
+            inv["compress"] = cfg[invsect].getboolean("compress")
+        else:
+            inv["compress"] = False
         inv["devname"] = cfg[invsect]["devname"]
         if cfg.has_option(invsect, "pvoutput_apikey"):
             inv["apikey"] = cfg[invsect]["pvoutput_apikey"]
@@ -696,45 +2188,39 @@ def parse_cfg(cfgfile, logpath):
 def main():
     """ The utility proper starts here """
 
-    cfgfile, logpath, oneshot, readcode, debug = parseargs(sys.argv[1:])
+    cfgfile, logpath, oneshot, readcode, debug, capture, speed = \
+        parseargs(sys.argv[1:])
 
     if readcode:
         print("The -x option is not supported yet")
         sys.exit(1)
 
     attached = parse_cfg(cfgfile, logpath)
-    thrlist = []
-    for inv in attached:
-        thrlist.append(Inverter(inv, oneshot, debug))
-
-    if len(thrlist) > 0:
-        for thr in thrlist:
-            thr.setup()
-            if not thr.isreg:
-                # didn't get registration
-                print("Registration failed, removing thr {0}".format(thr))
-                thrlist.remove(thr)
-                continue
-            thr.setName("inverter-" + thr.hr_serial)
+    start_logging(debug, attached[0]["loglevels"] if attached else None)
+
+    monitor = Monitor(cfgfile, logpath, oneshot, debug)
+    if capture:
+        monitor.replay(attached, capture, speed)
+        sys.exit(0)
+    monitor.setup(attached)
 
     if debug:
-        print("Inverter map:")
-        for index in _INVERTER_MAP:
-            print("id {0:3}: {1}".format(index, _INVERTER_MAP[index]))
+        MONLOG.debug("Inverter map:")
+        for devname, bus in sorted(_BUSES.items()):
+            for index, serial in bus.items():
+                MONLOG.debug("%s id %3s: %s", devname, index, serial)
 
-    if len(thrlist) > 0:
+    if len(monitor.inverters) > 0:
         try:
             _pid = os.fork()
         except OSError as err:
-            print("Error encountered when forking jfymonitor process: "
-                  "{0}".format(err))
+            MONLOG.error("Error encountered when forking jfymonitor "
+                         "process: %s", err)
         if _pid == 0:
             # Child process (run threads)
-            for _thr in thrlist:
-                _thr.run()
+            monitor.run()
     else:
-        print("No inverters passed registration for monitoring",
-              file=sys.stderr)
+        MONLOG.error("No inverters passed registration for monitoring")
         # SMF_ERR_EXIT_CONFIG
         sys.exit(96)
 
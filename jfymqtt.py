@@ -0,0 +1,418 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Publishes samples to an MQTT broker.
+
+Each sample becomes one message per field, on the topic
+
+    <mqtttopic>/<serial>/<field>
+
+with the scaled value as text, plus <mqtttopic>/<serial>/tstamp in
+epoch seconds. Messages are retained by default, so a subscriber
+gets the latest values as soon as it subscribes. Anomalies (see
+jfyanomaly.py) go to <mqtttopic>/<serial>/anomaly/<check> as JSON, so
+the retained message is whether that check is currently raised.
+
+A single MQTTPublisher is shared by all of the inverters, and keeps
+one connection to the broker open (MQTT 3.1.1, which is all we need
+and all we speak). Samples are not sent as they arrive: they are
+coalesced by topic for MQTT_FLUSHINTERVAL, so a poll cycle across all
+of the inverters goes out in one write, and a topic which was updated
+twice in that time is only sent once.
+
+With QoS 1 (the default), at most MQTT_MAXINFLIGHT messages are sent
+without the broker's acknowledgement; any left unacknowledged when
+the connection drops are sent again once we reconnect. While we're
+disconnected, messages are kept in a queue of at most MQTT_QUEUELEN
+(the oldest are dropped), and we try to reconnect with an exponential
+backoff of up to MQTT_RECONNECTMAX seconds.
+"""
+
+import collections
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from jfyDefinitions import (JFYData, JFYDivisors, MQTT_KEEPALIVE,
+                            MQTT_FLUSHINTERVAL, MQTT_QUEUELEN,
+                            MQTT_MAXINFLIGHT, MQTT_TIMEOUT,
+                            MQTT_RECONNECTMAX, MQTT_CLOSETIMEOUT)
+from jfylog import getlogger
+
+
+LOG = getlogger("mqtt")
+
+# Control packet types, already shifted into the fixed header
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def _string(text):
+    """ A length-prefixed UTF-8 string """
+    data = text.encode("utf-8")
+    return struct.pack("!H", len(data)) + data
+
+
+def packet(ptype, body=b""):
+    """ Prefixes body with the fixed header for ptype """
+    header = bytearray([ptype])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def connect_packet(clientid, keepalive, clean, username=None,
+                   password=None):
+    """ CONNECT """
+    flags = 0x02 if clean else 0
+    payload = _string(clientid)
+    if username is not None:
+        flags |= 0x80
+        payload += _string(username)
+        if password is not None:
+            flags |= 0x40
+            payload += _string(password)
+    return packet(CONNECT, _string("MQTT") +
+                  struct.pack("!BBH", 4, flags, keepalive) + payload)
+
+
+def publish_packet(topic, payload, qos, retain, pktid=None, dup=False):
+    """ PUBLISH """
+    flags = (qos << 1) | (0x08 if dup else 0) | (0x01 if retain else 0)
+    body = _string(topic)
+    if qos:
+        body += struct.pack("!H", pktid)
+    return packet(PUBLISH | flags, body + payload.encode("utf-8"))
+
+
+def read_packets(buf):
+    """
+    Returns ([(type, body)], rest) for the complete packets at the
+    start of buf.
+    """
+    packets = []
+    while len(buf) >= 2:
+        length = 0
+        mult = 1
+        pos = 1
+        while True:
+            if pos >= len(buf):
+                return packets, buf
+            length += (buf[pos] & 0x7F) * mult
+            mult *= 128
+            pos += 1
+            if not buf[pos - 1] & 0x80:
+                break
+        if len(buf) < pos + length:
+            break
+        packets.append((buf[0] & 0xF0, buf[pos:pos + length]))
+        buf = buf[pos + length:]
+    return packets, buf
+
+
+class MQTTPublisher(threading.Thread):
+    """ One connection to the broker, shared by all of the inverters """
+
+    def __init__(self, settings):
+        self.settings = dict(settings)
+        self.host = settings["host"]
+        self.port = settings["port"]
+        self.topic = settings["topic"]
+        self.qos = settings["qos"]
+        self.retain = settings["retain"]
+        self.pending = collections.OrderedDict()  # topic -> payload
+        self.flushat = None      # when pending goes to the queue
+        self.queue = collections.deque(maxlen=MQTT_QUEUELEN)
+        self.inflight = collections.OrderedDict()  # packet id -> message
+        self.pktid = 0
+        self.lock = threading.Lock()
+        self.sock = None
+        self.rbuf = b""
+        self.lastsent = 0.0      # for the keepalive
+        self.pingsent = None
+        self.retryat = 0.0
+        self.backoff = 1
+        self.stopping = threading.Event()
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        # metrics
+        self.sent = 0
+        self.dropped = 0
+        threading.Thread.__init__(self, name="mqtt", daemon=True)
+
+    def wake(self):
+        """ Interrupts the publisher's wait """
+        try:
+            os.write(self.wake_w, b"x")
+        except BlockingIOError:
+            pass
+
+    def add(self, serial, tstamp, stats):
+        """ Publishes a datetime-stamped sample of (unscaled) stats """
+        if self.stopping.is_set():
+            return
+        prefix = "{0}/{1}/".format(self.topic, serial)
+        with self.lock:
+            for idx, fname in enumerate(JFYData):
+                self.pending[prefix + fname] = \
+                    "{0:g}".format(stats[fname] / JFYDivisors[idx])
+            self.pending[prefix + "tstamp"] = \
+                "{0:.0f}".format(tstamp.timestamp())
+            if self.flushat is None:
+                self.flushat = time.monotonic() + MQTT_FLUSHINTERVAL
+                self.wake()
+
+    def event(self, event):
+        """
+        Publishes an anomaly event (see jfyanomaly.py) as JSON, on
+        <topic>/<serial>/anomaly/<check>
+        """
+        if self.stopping.is_set():
+            return
+        topic = "{0}/{1}/anomaly/{2}".format(self.topic, event["serial"],
+                                             event["check"])
+        with self.lock:
+            self.pending[topic] = json.dumps(event)
+            if self.flushat is None:
+                self.flushat = time.monotonic() + MQTT_FLUSHINTERVAL
+                self.wake()
+
+    def close(self):
+        """ Sends what we can, and disconnects """
+        self.stopping.set()
+        self.wake()
+        if self.is_alive():
+            self.join()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def metrics(self):
+        """ Returns a dict of our counters """
+        with self.lock:
+            return {
+                "connected": self.sock is not None,
+                "queued": len(self.queue) + len(self.pending),
+                "inflight": len(self.inflight),
+                "sent": self.sent,
+                "dropped": self.dropped
+            }
+
+    def _flush_pending(self):
+        """ Moves the coalesced messages to the send queue """
+        with self.lock:
+            room = self.queue.maxlen - len(self.queue)
+            self.dropped += max(len(self.pending) - room, 0)
+            self.queue.extend(self.pending.items())
+            self.pending.clear()
+            self.flushat = None
+
+    def _connect(self):
+        """ Connects to the broker, returning True if we did """
+        try:
+            sock = socket.create_connection((self.host, self.port),
+                                            timeout=MQTT_TIMEOUT)
+        except OSError as exc:
+            LOG.warning("Unable to connect to %s:%s: %s", self.host,
+                        self.port, exc)
+            self._retry_later()
+            return False
+        try:
+            sock.sendall(connect_packet(
+                self.settings["clientid"], MQTT_KEEPALIVE, self.qos == 0,
+                self.settings.get("username"), self.settings.get("password")))
+            buf = b""
+            packets = []
+            while not packets:
+                data = sock.recv(4)
+                if not data:
+                    raise OSError("connection closed")
+                buf += data
+                packets, buf = read_packets(buf)
+            ptype, body = packets[0]
+            if ptype != CONNACK or len(body) != 2 or body[1]:
+                raise OSError("connection refused, code {0}".format(
+                    body[1] if ptype == CONNACK and len(body) == 2 else "?"))
+        except OSError as exc:
+            LOG.warning("Unable to connect to %s:%s: %s", self.host,
+                        self.port, exc)
+            sock.close()
+            self._retry_later()
+            return False
+        self.sock = sock
+        self.rbuf = buf
+        self.lastsent = time.monotonic()
+        self.pingsent = None
+        self.backoff = 1
+        LOG.info("Connected to %s:%s", self.host, self.port)
+        # anything the broker didn't acknowledge goes again
+        resend = [publish_packet(topic, payload, self.qos, self.retain,
+                                 pktid, dup=True)
+                  for pktid, (topic, payload) in self.inflight.items()]
+        if resend:
+            self._send(b"".join(resend))
+        return self.sock is not None
+
+    def _disconnect(self, why):
+        """ Drops the connection, and schedules a reconnection """
+        if self.sock is None:
+            return
+        LOG.warning("Disconnected from %s:%s: %s", self.host, self.port, why)
+        self.sock.close()
+        self.sock = None
+        self._retry_later()
+
+    def _retry_later(self):
+        """ Backs off before trying to connect again """
+        self.retryat = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, MQTT_RECONNECTMAX)
+
+    def _send(self, data):
+        """ Writes to the broker, disconnecting if we can't """
+        try:
+            self.sock.sendall(data)
+        except OSError as exc:
+            self._disconnect(exc)
+            return False
+        self.lastsent = time.monotonic()
+        return True
+
+    def _next_id(self):
+        """ Returns a packet id which isn't in flight """
+        while True:
+            self.pktid = self.pktid % 65535 + 1
+            if self.pktid not in self.inflight:
+                return self.pktid
+
+    def _send_queued(self):
+        """ Sends as much of the queue as the in-flight window allows """
+        data = []
+        with self.lock:
+            while self.queue and (self.qos == 0 or
+                                  len(self.inflight) < MQTT_MAXINFLIGHT):
+                topic, payload = self.queue.popleft()
+                pktid = None
+                if self.qos:
+                    pktid = self._next_id()
+                    self.inflight[pktid] = (topic, payload)
+                data.append(publish_packet(topic, payload, self.qos,
+                                           self.retain, pktid))
+                self.sent += 1
+        if data:
+            self._send(b"".join(data))
+
+    def _receive(self):
+        """ Reads and handles whatever the broker has sent us """
+        try:
+            data = self.sock.recv(4096)
+        except OSError as exc:
+            self._disconnect(exc)
+            return
+        if not data:
+            self._disconnect("connection closed by the broker")
+            return
+        packets, self.rbuf = read_packets(self.rbuf + data)
+        for ptype, body in packets:
+            if ptype == PUBACK and len(body) == 2:
+                with self.lock:
+                    self.inflight.pop(struct.unpack("!H", body)[0], None)
+            elif ptype == PINGRESP:
+                self.pingsent = None
+
+    def _timeout(self, now):
+        """ How long we may wait before there's something to do """
+        due = [now + MQTT_KEEPALIVE]
+        if self.flushat is not None:
+            due.append(self.flushat)
+        if self.sock is None:
+            due.append(self.retryat)
+        else:
+            due.append(self.lastsent + MQTT_KEEPALIVE / 2)
+            if self.pingsent is not None:
+                due.append(self.pingsent + MQTT_TIMEOUT)
+        return max(min(due) - now, 0)
+
+    def _keepalive(self, now):
+        """ Pings the broker when we've been quiet, and checks it answers """
+        if self.pingsent is not None and now - self.pingsent > MQTT_TIMEOUT:
+            self._disconnect("no response to ping")
+        elif self.pingsent is None and \
+                now - self.lastsent >= MQTT_KEEPALIVE / 2:
+            self.pingsent = now
+            self._send(packet(PINGREQ))
+
+    def run(self):
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            if self.flushat is not None and now >= self.flushat:
+                self._flush_pending()
+            if self.sock is None and now >= self.retryat:
+                self._connect()
+            if self.sock is not None:
+                self._send_queued()
+            waiton = [self.wake_r]
+            if self.sock is not None:
+                waiton.append(self.sock)
+            readable, _w, _x = select.select(waiton, [], [],
+                                             self._timeout(time.monotonic()))
+            if self.wake_r in readable:
+                try:
+                    os.read(self.wake_r, 4096)
+                except BlockingIOError:
+                    pass
+            if self.sock is not None and self.sock in readable:
+                self._receive()
+            if self.sock is not None:
+                self._keepalive(time.monotonic())
+        self._finish()
+
+    def _finish(self):
+        """ Sends what's left, waits briefly for the acks, and disconnects """
+        self._flush_pending()
+        deadline = time.monotonic() + MQTT_CLOSETIMEOUT
+        while self.sock is not None and (self.queue or self.inflight):
+            self._send_queued()
+            timeout = deadline - time.monotonic()
+            if self.sock is None or timeout <= 0:
+                break
+            if select.select([self.sock], [], [], timeout)[0]:
+                self._receive()
+        if self.sock is not None:
+            self._send(packet(DISCONNECT))
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        unsent = len(self.queue) + len(self.inflight)
+        if unsent:
+            LOG.warning("%s messages were not delivered to %s:%s", unsent,
+                        self.host, self.port)
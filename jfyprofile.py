@@ -0,0 +1,199 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+On-demand profiling of the running daemon.
+
+    kill -USR1 <pid>   start sampling every thread's stack; a second
+                       SIGUSR1 (or PROFILE_WINDOW seconds) stops it
+                       and writes the report
+    kill -USR2 <pid>   start tracing allocations with tracemalloc; a
+                       second SIGUSR2 writes the report and stops it
+
+cProfile only sees the thread which enabled it, so rather than
+instrumenting each inverter thread we sample all of them from a
+thread of our own, via sys._current_frames(). Until the first signal
+arrives nothing is sampled or traced, so this costs nothing.
+
+Reports go to the log directory:
+
+  profile-<time>.txt     samples per thread, and the functions which
+                         were most often running (self) or on the
+                         stack (total)
+  profile-<time>.folded  the sampled stacks, one per line, ready for
+                         flamegraph.pl
+  memory-<time>.txt      the allocation sites which grew the most
+                         between the two SIGUSR2s
+
+tracemalloc costs memory and time on every allocation, so it is only
+on between the two signals.
+"""
+
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from jfyDefinitions import (PROFILE_INTERVAL, PROFILE_WINDOW, PROFILE_TOP,
+                            TRACEMALLOC_FRAMES)
+from jfylog import getlogger
+
+
+LOG = getlogger("profile")
+
+
+def _stamp():
+    """ A timestamp for report filenames """
+    return datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+
+
+def _snapshot():
+    """ A snapshot of the traced heap, less tracemalloc's own use """
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def _where(frame):
+    """ Describes the function a frame is running """
+    code = frame.f_code
+    return "{0} ({1}:{2})".format(code.co_name,
+                                  os.path.basename(code.co_filename),
+                                  code.co_firstlineno)
+
+
+class StackSampler(threading.Thread):
+    """ Samples the stacks of all the other threads until stopped """
+
+    def __init__(self, outdir, interval=PROFILE_INTERVAL,
+                 window=PROFILE_WINDOW):
+        self.outdir = outdir
+        self.interval = interval
+        self.window = window
+        self.stacks = collections.Counter()  # (thread, fn, ...) -> samples
+        self.nsamples = 0
+        self.elapsed = 0.0
+        self.stopping = threading.Event()
+        threading.Thread.__init__(self, name="profiler", daemon=True)
+
+    def sample(self):
+        """ Records the current stack of every other thread """
+        names = dict([(thr.ident, thr.name) for thr in threading.enumerate()])
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_where(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[tuple(reversed(stack))] += 1
+        self.nsamples += 1
+
+    def run(self):
+        started = time.monotonic()
+        deadline = started + self.window
+        while not self.stopping.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= deadline:
+                break
+        self.elapsed = time.monotonic() - started
+        try:
+            self.report()
+        except OSError as exc:
+            LOG.error("Unable to write profile to %s: %s", self.outdir, exc)
+
+    def report(self):
+        """ Writes the report and the folded stacks """
+        threads = collections.Counter()
+        selfs = collections.Counter()
+        totals = collections.Counter()
+        for stack, count in self.stacks.items():
+            threads[stack[0]] += count
+            selfs[stack[-1]] += count
+            # recursion shouldn't count a function more than once
+            for func in set(stack[1:]):
+                totals[func] += count
+
+        basename = os.path.join(self.outdir, "profile-" + _stamp())
+        with open(basename + ".txt", "w") as repf:
+            repf.write("{0} samples every {1}s over {2:.1f}s\n\n".format(
+                self.nsamples, self.interval, self.elapsed))
+            repf.write("samples  thread\n")
+            for name, count in threads.most_common():
+                repf.write("{0:7}  {1}\n".format(count, name))
+            for title, counter in [("self", selfs), ("total", totals)]:
+                repf.write("\n{0:>7}  function\n".format(title))
+                for func, count in counter.most_common(PROFILE_TOP):
+                    repf.write("{0:7}  {1}\n".format(count, func))
+        with open(basename + ".folded", "w") as foldf:
+            for stack, count in self.stacks.items():
+                foldf.write("{0} {1}\n".format(";".join(stack), count))
+        LOG.info("Wrote profile to %s.txt", basename)
+
+
+class Profiler():
+    """ Starts and stops the profilers on behalf of the signal handlers """
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.sampler = None
+        self.snapshot = None     # the heap when tracing started
+
+    def toggle(self):
+        """ Starts sampling, or stops it and writes the report """
+        if self.sampler and self.sampler.is_alive():
+            self.sampler.stopping.set()
+            self.sampler.join()
+            self.sampler = None
+            return
+        LOG.info("Profiling for up to %ss", PROFILE_WINDOW)
+        self.sampler = StackSampler(self.outdir)
+        self.sampler.start()
+
+    def memory(self):
+        """
+        Starts tracing allocations, or reports the growth since then
+        and stops again
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.snapshot = _snapshot()
+            LOG.info("Started tracing memory allocations")
+            return
+        stats = _snapshot().compare_to(self.snapshot, "lineno")
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.snapshot = None
+        LOG.info("Stopped tracing memory allocations")
+
+        repname = os.path.join(self.outdir, "memory-{0}.txt".format(_stamp()))
+        try:
+            with open(repname, "w") as repf:
+                repf.write("traced {0} bytes (peak {1}); growth since "
+                           "tracing started\n\n".format(current, peak))
+                for stat in stats[:PROFILE_TOP]:
+                    repf.write("{0}\n".format(stat))
+        except OSError as exc:
+            LOG.error("Unable to write memory report to %s: %s", repname,
+                      exc)
+            return
+        LOG.info("Wrote memory report to %s", repname)
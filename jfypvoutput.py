@@ -0,0 +1,380 @@
+#! /usr/bin/python3
+
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Uploads logged samples to pvoutput.org after the fact, eg to fill the
+gap left by an outage.
+
+$ jfypvoutput.py -l /path/to/logfile/hierarchy -S serial -k apikey
+      -i sysid -s start -e end [-p checkpoint] [-b batchsize]
+      [-q quota] [-a maxage] [-n]
+
+    -l /path/to/logfile/hierarchy (logpath/<serial>/YYYY/MM/DD)
+    -S the inverter's serial number
+    -k the pvoutput.org API key
+    -i the pvoutput.org system id
+    -s, -e the range to upload, as epoch seconds or ISO8601 (from the
+       start of the interval -s falls in)
+    -p file recording how far we've got, and the requests we've made
+       in the last hour; rerunning the backfill resumes from there
+       (default: .jfypvoutput-<sysid> in the logfile hierarchy)
+    -b statuses per request (default PVOUTPUT_BATCHSIZE)
+    -q requests per hour (default PVOUTPUT_QUOTA)
+    -a skip statuses more than this many days old (default
+       PVOUTPUT_MAXAGE), since pvoutput.org refuses them
+    -n print the batches rather than uploading them
+
+The samples are aggregated into the same PVOUTPUT_INTERVAL statuses
+that the daemon sends, and uploaded with addbatchstatus. We never make
+more than the quota of requests in any hour, and if pvoutput.org says
+we've run out anyway, we wait until it says the quota resets.
+"""
+
+import collections
+import datetime
+import getopt
+import http.client
+import json
+import math
+import os
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from jfyDefinitions import (JFYData, JFYDivisors, PVOUTPUT_INTERVAL,
+                            BATCHURL, PVOUTPUT_TIMEOUT, PVOUTPUT_BATCHSIZE,
+                            PVOUTPUT_QUOTA, PVOUTPUT_MAXAGE, PVOUTPUT_RETRY)
+from jfylogs import read_range
+
+
+class PVOutputSlot():
+    """
+    Aggregates the samples taken during one PVOUTPUT_INTERVAL, so that
+    we send exactly one status to pvoutput.org per interval. Intervals
+    are labelled with their end time, as pvoutput.org expects.
+    """
+
+    def __init__(self):
+        self.end = None          # epoch seconds at the end of the interval
+        self.count = 0
+        self.sums = {}
+        self.energy = None       # energy is cumulative, so we want the last
+
+    def add(self, slot, vals):
+        """
+        Adds the sample taken at slot. If that sample is the first of a
+        new interval, returns the status for the previous interval.
+        """
+        end = math.ceil(slot.timestamp() / PVOUTPUT_INTERVAL) * \
+            PVOUTPUT_INTERVAL
+        done = None
+        if end != self.end:
+            done = self.status()
+            self.end = end
+            self.count = 0
+            self.sums = {"powerGenerated": 0, "temperature": 0,
+                         "voltageDC": 0}
+        self.count += 1
+        for fname in self.sums:
+            self.sums[fname] += vals[fname]
+        self.energy = vals["energyGenerated"]
+        return done
+
+    def status(self):
+        """ Returns the addstatus parameters for the current interval """
+        if not self.count:
+            return None
+        endtime = datetime.datetime.fromtimestamp(self.end)
+        mean = dict([(fname, total / self.count)
+                     for fname, total in self.sums.items()])
+        return {
+            'd': endtime.strftime("%Y%m%d"),                 # date
+            't': endtime.strftime("%H:%M"),                  # time
+            'v1': self.energy / JFYDivisors[4],              # energy
+            'v2': mean["powerGenerated"] / JFYDivisors[1],   # power
+            'v5': mean["temperature"] / JFYDivisors[0],      # temperature
+            'v6': mean["voltageDC"] / JFYDivisors[2]         # Vdc
+        }
+
+
+def post(url, apikey, sysid, params):
+    """
+    Posts the parameters to a pvoutput.org service, returning the
+    response body and headers. Raises urllib.error.URLError (or its
+    subclass HTTPError), another OSError (eg a timeout) or an
+    http.client.HTTPException if that fails.
+    """
+    data = urllib.parse.urlencode(params).encode("ascii")
+    req = urllib.request.Request(url=url, data=data)
+    req.add_header("X-Pvoutput-Apikey", apikey)
+    req.add_header("X-Pvoutput-SystemId", sysid)
+    # ask for the X-Rate-Limit-* headers in the response
+    req.add_header("X-Rate-Limit", "1")
+    with urllib.request.urlopen(req, timeout=PVOUTPUT_TIMEOUT) as resp:
+        return resp.read().decode("utf-8", "replace"), resp.headers
+
+
+class RequestQuota():
+    """ Holds us to at most quota requests in any hour """
+
+    def __init__(self, quota, sent=()):
+        self.quota = quota
+        self.sent = collections.deque(sorted(sent))  # epoch seconds
+        self.reset = 0           # pvoutput.org says wait until then
+
+    def wait(self, now=None):
+        """ Returns how many seconds until we may make a request """
+        if now is None:
+            now = time.time()
+        while self.sent and self.sent[0] <= now - 3600:
+            self.sent.popleft()
+        wait = max(self.reset - now, 0)
+        if len(self.sent) >= self.quota:
+            wait = max(wait, self.sent[0] + 3600 - now)
+        return wait
+
+    def record(self, headers=None):
+        """ Notes a request, and what pvoutput.org said about the quota """
+        self.sent.append(time.time())
+        if headers and headers.get("X-Rate-Limit-Remaining") == "0":
+            self.exhausted(headers)
+
+    def exhausted(self, headers=None):
+        """ pvoutput.org says we're out of requests until it resets """
+        reset = headers.get("X-Rate-Limit-Reset") if headers else None
+        try:
+            self.reset = float(reset)
+        except (TypeError, ValueError):
+            self.reset = time.time() + 3600
+
+
+def statuses(logpath, serial, start, end):
+    """
+    Generator yielding the addstatus parameters for each complete
+    PVOUTPUT_INTERVAL of logged samples between start and end (epoch
+    seconds), as the daemon would have sent them. start is taken back
+    to the beginning of its interval, so the first is complete too; the
+    last is only complete if it ended by the last sample and by end.
+    """
+    # an interval ends on a multiple of PVOUTPUT_INTERVAL, and holds
+    # the samples after its start, up to and including its end
+    start = math.ceil(start / PVOUTPUT_INTERVAL) * PVOUTPUT_INTERVAL - \
+        PVOUTPUT_INTERVAL
+    pvslot = PVOutputSlot()
+    last = None
+    for secs, values in read_range(logpath, serial, start, end):
+        if secs <= start:
+            continue
+        last = secs
+        if any([math.isnan(val) for val in values]):
+            continue
+        # PVOutputSlot takes the inverter's unscaled values
+        vals = dict([(fname, values[idx] * JFYDivisors[idx])
+                     for idx, fname in enumerate(JFYData)])
+        valdata = pvslot.add(datetime.datetime.fromtimestamp(secs), vals)
+        if valdata:
+            yield pvslot_end(valdata), valdata
+    valdata = pvslot.status()
+    if valdata and pvslot.end <= min(last, end):
+        yield pvslot_end(valdata), valdata
+
+
+def pvslot_end(valdata):
+    """ Returns the epoch seconds of a status's date and time """
+    return datetime.datetime.strptime(valdata["d"] + valdata["t"],
+                                      "%Y%m%d%H:%M").timestamp()
+
+
+def batch_line(valdata):
+    """ Formats a status as an addbatchstatus entry """
+    return "{0},{1},{2:.0f},{3:.0f},,,{4:.1f},{5:.1f}".format(
+        valdata["d"], valdata["t"], valdata["v1"], valdata["v2"],
+        valdata["v5"], valdata["v6"])
+
+
+def load_checkpoint(progname):
+    """ Returns (last status uploaded, recent request times) """
+    if not os.path.exists(progname):
+        return 0, []
+    with open(progname) as progf:
+        prog = json.load(progf)
+    return prog.get("done", 0), prog.get("sent", [])
+
+
+def save_checkpoint(progname, done, quota):
+    """ Records our progress, replacing the file atomically """
+    with open(progname + ".tmp", "w") as progf:
+        json.dump({"done": done, "sent": list(quota.sent)}, progf)
+    os.replace(progname + ".tmp", progname)
+
+
+def parse_time(text):
+    """ Returns epoch seconds from epoch seconds or ISO8601 text """
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def usage():
+    """ Provides the usage statement for the utility """
+    print(__doc__, file=sys.stderr)
+    sys.exit(1)
+
+
+def upload(batch, apikey, sysid, quota):
+    """
+    Uploads a batch of statuses, waiting for the quota and retrying
+    after network errors. Returns the number pvoutput.org added, or
+    None if it refused the batch.
+    """
+    while True:
+        wait = quota.wait()
+        if wait > 0:
+            print("Waiting {0:.0f}s for the request quota".format(wait),
+                  file=sys.stderr)
+            time.sleep(wait)
+            continue
+        try:
+            body, headers = post(BATCHURL, apikey, sysid,
+                                 {"data": ";".join(batch)})
+        except urllib.error.HTTPError as exc:
+            quota.record()
+            message = exc.read().decode("utf-8", "replace")
+            if exc.code == 403 and "Exceeded" in message:
+                quota.exhausted(exc.headers)
+                continue
+            print("pvoutput.org refused the batch: {0} {1}".format(
+                exc.code, message.strip()), file=sys.stderr)
+            return None
+        except (OSError, http.client.HTTPException) as exc:
+            # URLError, or a timeout or broken response
+            print("Unable to reach pvoutput.org ({0}); retrying in "
+                  "{1}s".format(getattr(exc, "reason", exc), PVOUTPUT_RETRY),
+                  file=sys.stderr)
+            time.sleep(PVOUTPUT_RETRY)
+            continue
+        quota.record(headers)
+        # one "date,time,added" entry per status
+        return len([entry for entry in body.split(";")
+                    if entry.strip().endswith(",1")])
+
+
+def send_batch(batch, apikey, sysid, quota, dryrun):
+    """
+    Uploads (or with dryrun, prints) a batch, returning how many were
+    added, or None if pvoutput.org refused it.
+    """
+    if dryrun:
+        print(";".join(batch))
+        return 0
+    added = upload(batch, apikey, sysid, quota)
+    if added is None:
+        return None
+    print("Up to {0}: {1} of {2} statuses added".format(
+        " ".join(batch[-1].split(",")[:2]), added, len(batch)),
+          file=sys.stderr)
+    return added
+
+
+def send_and_save(batch, apikey, sysid, quota, dopts, progname, last,
+                  counts):
+    """
+    Sends a batch and, once pvoutput.org has accepted it, records our
+    progress up to last. Returns False if pvoutput.org refused it, so
+    that a rerun starts with that batch again.
+    """
+    added = send_batch(batch, apikey, sysid, quota, "-n" in dopts)
+    if added is None:
+        print("Stopping; rerunning resumes from this batch",
+              file=sys.stderr)
+        return False
+    counts["sent"] += len(batch)
+    counts["added"] += added
+    if "-n" not in dopts:
+        save_checkpoint(progname, last, quota)
+    return True
+
+
+def main():
+    """ The utility proper starts here """
+    try:
+        lopts, extra = getopt.getopt(sys.argv[1:], "l:S:k:i:s:e:p:b:q:a:n")
+    except getopt.GetoptError:
+        usage()
+    dopts = dict(lopts)
+    if extra or not all([opt in dopts for opt in
+                         ["-l", "-S", "-k", "-i", "-s", "-e"]]):
+        usage()
+    logpath = dopts["-l"]
+    serial = dopts["-S"]
+    apikey = dopts["-k"]
+    sysid = dopts["-i"]
+    try:
+        start = parse_time(dopts["-s"])
+        end = parse_time(dopts["-e"])
+        batchsize = int(dopts.get("-b", PVOUTPUT_BATCHSIZE))
+        quota = int(dopts.get("-q", PVOUTPUT_QUOTA))
+        maxage = float(dopts.get("-a", PVOUTPUT_MAXAGE))
+    except ValueError:
+        usage()
+    progname = dopts.get("-p", os.path.join(logpath,
+                                            ".jfypvoutput-" + sysid))
+
+    done, sent = load_checkpoint(progname)
+    quota = RequestQuota(quota, sent)
+    oldest = time.time() - maxage * 86400
+    if done:
+        print("Resuming after {0}".format(
+            datetime.datetime.fromtimestamp(done)), file=sys.stderr)
+
+    counts = {"sent": 0, "added": 0}
+    nskipped = 0
+    batch = []
+    last = done
+    todo = statuses(logpath, serial, max(start, done + 1), end)
+    for statend, valdata in todo:
+        if statend <= done:
+            continue
+        if statend < oldest:
+            nskipped += 1
+            continue
+        batch.append(batch_line(valdata))
+        last = statend
+        if len(batch) < batchsize:
+            continue
+        if not send_and_save(batch, apikey, sysid, quota, dopts, progname,
+                             last, counts):
+            break
+        batch = []
+    else:
+        if batch:
+            send_and_save(batch, apikey, sysid, quota, dopts, progname,
+                          last, counts)
+
+    print("Sent {0} statuses, {1} added ({2} too old to send)".format(
+        counts["sent"], counts["added"], nskipped), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A shared memory stats segment, for systems without sstored.
+
+The segment is a file (by default SHM_PATH, which lives in tmpfs on
+Linux) which the daemon and any readers mmap. Updating a stat is a
+memory write, and reading one is a memory read: no syscalls, and no
+IPC with the daemon.
+
+Layout (all fields in native byte order):
+
+  header   magic "JFYS", layout version, number of slots,
+           number of stats (u32 each)
+  slot[n]  sequence number   u64
+           serial number     SHM_SERIALLEN bytes, NUL padded
+           timestamp         f64, seconds since the epoch
+           values            f64 per stat, in STATS order
+
+Each inverter owns one slot, allocated by serial number when the
+inverter first updates the segment. The sequence number is a seqlock:
+the daemon makes it odd before updating the slot and even afterwards,
+so a reader which sees the same even number before and after copying
+the slot knows that its copy is consistent.
+
+To read the segment from another process:
+
+    reader = ShmReader()
+    for serial, (tstamp, values) in reader.read_all().items():
+        print(serial, tstamp, values["power-generated"])
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+from jfyDefinitions import (JFYData, JFYDivisors, STATS, SHM_PATH,
+                            SHM_SLOTS, SHM_SERIALLEN)
+
+
+SHM_MAGIC = b"JFYS"
+SHM_VERSION = 1
+
+_HEADER = struct.Struct("=4sIII")
+_SEQ = struct.Struct("=Q")
+_SLOT = struct.Struct("=Q{0}sd{1}d".format(SHM_SERIALLEN, len(STATS)))
+_BODY = struct.Struct("={0}sd{1}d".format(SHM_SERIALLEN, len(STATS)))
+
+
+def _slot_offset(slot):
+    """ Returns the offset of this slot in the segment """
+    return _HEADER.size + slot * _SLOT.size
+
+
+class ShmWriter():
+    """
+    The daemon's side of the segment. One of these is shared by all
+    the inverter threads; each thread only ever writes its own slot,
+    so the only locking needed is around slot allocation.
+    """
+
+    def __init__(self, path=SHM_PATH, nslots=SHM_SLOTS):
+        self.path = path
+        self.nslots = nslots
+        size = _slot_offset(nslots)
+        fdesc = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fdesc, 0)
+            os.ftruncate(fdesc, size)
+            self.mem = mmap.mmap(fdesc, size)
+        finally:
+            os.close(fdesc)
+        _HEADER.pack_into(self.mem, 0, SHM_MAGIC, SHM_VERSION, nslots,
+                          len(STATS))
+        self.slots = {}          # serial number -> slot
+        self.lock = threading.Lock()
+
+    def slot_for(self, serial):
+        """ Returns (allocating if necessary) the slot for this serial """
+        with self.lock:
+            if serial not in self.slots:
+                if len(self.slots) >= self.nslots:
+                    return None
+                self.slots[serial] = len(self.slots)
+            return self.slots[serial]
+
+    def update(self, serial, tstamp, stats):
+        """
+        Writes a datetime-stamped sample of (unscaled) JFYData stats
+        into this inverter's slot.
+        """
+        slot = self.slot_for(serial)
+        if slot is None:
+            return
+        offset = _slot_offset(slot)
+        values = [stats[fname] / JFYDivisors[idx]
+                  for idx, fname in enumerate(JFYData)]
+        seq = _SEQ.unpack_from(self.mem, offset)[0]
+        # odd: update in progress
+        _SEQ.pack_into(self.mem, offset, seq + 1)
+        _BODY.pack_into(self.mem, offset + _SEQ.size,
+                        serial.encode("ascii")[:SHM_SERIALLEN],
+                        tstamp.timestamp(), *values)
+        _SEQ.pack_into(self.mem, offset, seq + 2)
+
+    def close(self):
+        """ Unmaps the segment and removes it """
+        self.mem.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class ShmReader():
+    """ A reader's view of the segment """
+
+    def __init__(self, path=SHM_PATH):
+        with open(path, "rb") as shmf:
+            self.mem = mmap.mmap(shmf.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.nslots, nstats = _HEADER.unpack_from(self.mem)
+        if magic != SHM_MAGIC or version != SHM_VERSION or \
+           nstats != len(STATS):
+            self.mem.close()
+            raise ValueError("{0} is not a version {1} stats "
+                             "segment".format(path, SHM_VERSION))
+
+    def read(self, slot, retries=100):
+        """
+        Returns (serial, tstamp, values) for the slot, where values is
+        keyed by the STATS names, or None if the slot isn't in use or
+        we couldn't get a consistent copy.
+        """
+        offset = _slot_offset(slot)
+        for _tries in range(retries):
+            before = _SEQ.unpack_from(self.mem, offset)[0]
+            if before & 1:
+                # the daemon's in the middle of an update
+                time.sleep(0)
+                continue
+            body = _BODY.unpack_from(self.mem, offset + _SEQ.size)
+            after = _SEQ.unpack_from(self.mem, offset)[0]
+            if before != after:
+                continue
+            if before == 0:
+                return None
+            serial = body[0].rstrip(b"\0").decode("ascii")
+            return serial, body[1], dict(zip(STATS, body[2:]))
+        return None
+
+    def read_all(self):
+        """ Returns {serial: (tstamp, values)} for every slot in use """
+        rval = {}
+        for slot in range(self.nslots):
+            entry = self.read(slot)
+            if entry is None:
+                continue
+            rval[entry[0]] = (entry[1], entry[2])
+        return rval
+
+    def close(self):
+        """ Unmaps the segment """
+        self.mem.close()
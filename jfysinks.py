@@ -0,0 +1,383 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+The output pipeline.
+
+Polling only hands each sample to the Dispatcher, which fans it out to
+one SinkQueue per sink (see SINK_POLICIES). Each SinkQueue has its own
+worker thread, shared between all of the inverters, which writes the
+samples by calling the inverter's output_<sink>(tstamp, stats)
+method. A slow sink (pvoutput.org, say) therefore only falls behind
+itself; it can't make us late for the next poll. Adding a sink means
+adding its output_<sink>() method and an entry in SINK_POLICIES.
+
+Each queue holds at most SINK_QUEUELEN samples. What happens when it
+is full depends on the sink's policy:
+
+    drop-oldest  the oldest queued sample is discarded
+    block        the poller waits for room: backpressure
+    spill        samples go to <sink>.spill in the spool directory,
+                 and are written from there (in order) once the
+                 queue has caught up. Anything still spilled at
+                 shutdown is written after the next start.
+
+Spilled samples for an inverter whose outputs aren't open yet (eg one
+a fleet worker hasn't registered with since we started) stay on disk,
+in order, and we try them again every SINK_DRAINRETRY seconds. An
+inverter which still isn't ready after SINK_HOLDTIME seconds has its
+samples dropped, so that it can't keep the queue on disk for good.
+
+Each queue keeps counts of what it has written, dropped and spilled,
+and how far behind it is (see metrics()).
+"""
+
+import collections
+import datetime
+import json
+import os
+import threading
+import time
+
+from jfyDefinitions import (SINK_POLICIES, SINK_QUEUELEN, SINK_LAGWARN,
+                            SINK_FLUSHTIMEOUT, SINK_DRAINRETRY,
+                            SINK_HOLDTIME)
+from jfylog import getlogger
+
+
+LOG = getlogger("sinks")
+
+POLICIES = ["drop-oldest", "block", "spill"]
+
+
+class SinkQueue(threading.Thread):
+    """ A bounded queue of samples, and the worker which writes them """
+
+    def __init__(self, sink, policy, maxlen, spooldir, lookup):
+        self.sink = sink
+        self.method = "output_" + sink
+        self.policy = policy
+        self.maxlen = maxlen
+        self.lookup = lookup     # devname -> running Inverter, or None
+        self.queue = collections.deque()  # (enqueued, inverter, tstamp, stats)
+        self.pending = collections.Counter()  # inverter -> samples queued
+        self.cond = threading.Condition()
+        self.closing = False
+        self.spillname = None
+        self.spillfile = None    # open while we're spilling
+        self.spilled = 0         # samples waiting on disk
+        self.drainat = 0.0       # when we may next write spilled samples
+        self.holding = {}        # devname -> when we first kept its samples
+        if spooldir:
+            self.spillname = os.path.join(spooldir, sink + ".spill")
+            for name in [self.spillname, self.drainname()]:
+                if os.path.exists(name):
+                    with open(name) as spf:
+                        self.spilled += sum(1 for _line in spf)
+        # metrics
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.lag = 0.0           # how late the last sample was written
+        self.maxlag = 0.0
+        self.writetime = 0.0     # total seconds spent writing
+        threading.Thread.__init__(self, name="sink-" + sink, daemon=True)
+
+    def drainname(self):
+        """ The spill file we're writing out from """
+        return self.spillname + ".draining"
+
+    def put(self, inverter, tstamp, stats):
+        """ Queues a sample, applying our policy if the queue is full """
+        with self.cond:
+            if self.spilled or (len(self.queue) >= self.maxlen and
+                                self.policy == "spill" and self.spillname):
+                # once we've spilled, everything goes to disk until the
+                # worker has caught up, so samples stay in order
+                self._spill(inverter, tstamp, stats)
+            else:
+                if len(self.queue) >= self.maxlen:
+                    if self.policy == "block":
+                        self.cond.wait_for(lambda: len(self.queue) <
+                                           self.maxlen or self.closing)
+                    else:
+                        _enq, oldest, _ts, _st = self.queue.popleft()
+                        self._done(oldest)
+                        self.dropped += 1
+                self.queue.append((time.monotonic(), inverter, tstamp, stats))
+                self.pending[inverter] += 1
+            self.cond.notify_all()
+
+    def _spill(self, inverter, tstamp, stats):
+        """ Appends a sample to the spill file; called with cond held """
+        try:
+            if self.spillfile is None:
+                self.spillfile = open(self.spillname, "a")
+            self.spillfile.write(json.dumps({
+                "devname": inverter.devname,
+                "tstamp": tstamp.timestamp(),
+                "stats": stats}) + "\n")
+            self.spillfile.flush()
+        except OSError as exc:
+            LOG.error("Unable to spill to %s, dropping the sample: %s",
+                      self.spillname, exc)
+            self.dropped += 1
+            return
+        self.spilled += 1
+
+    def _done(self, inverter):
+        """ Forgets a queued sample; called with cond held """
+        self.pending[inverter] -= 1
+        if not self.pending[inverter]:
+            del self.pending[inverter]
+
+    def flush(self, inverter, timeout=SINK_FLUSHTIMEOUT):
+        """
+        Waits (for at most timeout seconds) until everything queued
+        for this inverter has been written. Returns False on timeout.
+        """
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: inverter not in self.pending, timeout)
+
+    def close(self):
+        """ Writes out the queue, and stops the worker """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join()
+        if self.spillfile:
+            self.spillfile.close()
+            self.spillfile = None
+
+    def metrics(self):
+        """ Returns a dict of our counters """
+        with self.cond:
+            oldest = time.monotonic() - self.queue[0][0] if self.queue else 0
+            return {
+                "policy": self.policy,
+                "queued": len(self.queue),
+                "spilled": self.spilled,
+                "written": self.written,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "oldest": round(oldest, 3),
+                "lag": round(self.lag, 3),
+                "maxlag": round(self.maxlag, 3),
+                "avgwrite": round(self.writetime / max(self.written, 1), 6)
+            }
+
+    def _write(self, inverter, tstamp, stats, lag):
+        """ Writes one sample to the sink """
+        started = time.monotonic()
+        try:
+            getattr(inverter, self.method)(tstamp, stats)
+            failed = False
+        except Exception:          # pylint: disable=broad-except
+            LOG.exception("Unable to write a sample from %s to the %s sink",
+                          inverter.hr_serial, self.sink)
+            failed = True
+        elapsed = time.monotonic() - started
+        with self.cond:
+            self.written += 1
+            self.errors += failed
+            self.writetime += elapsed
+            self.lag = lag + elapsed
+            self.maxlag = max(self.maxlag, self.lag)
+        if self.lag > SINK_LAGWARN:
+            LOG.warning("The %s sink is %.0fs behind", self.sink, self.lag)
+
+    def _gather(self):
+        """
+        Moves the spill file to the end of the one we're writing out
+        from; called with cond held.
+        """
+        if self.spillfile:
+            self.spillfile.close()
+            self.spillfile = None
+        if not os.path.exists(self.spillname):
+            return
+        if not os.path.exists(self.drainname()):
+            os.replace(self.spillname, self.drainname())
+            return
+        with open(self.drainname(), "a") as drf, \
+                open(self.spillname) as spf:
+            drf.writelines(spf)
+        os.remove(self.spillname)
+
+    def _keep(self, lines):
+        """ Replaces the file we're writing out from with lines """
+        with open(self.drainname() + ".tmp", "w") as tmp:
+            tmp.writelines(lines)
+        os.replace(self.drainname() + ".tmp", self.drainname())
+
+    def _drain(self):
+        """
+        Writes out the spilled samples, oldest first. Those for an
+        inverter whose outputs aren't open yet are kept, in order,
+        for a later pass, unless we've been keeping them for more than
+        SINK_HOLDTIME seconds.
+        """
+        kept = []
+        waiting = set()          # devnames we're keeping samples for
+        expired = set()          # devnames we've given up on
+        now = time.monotonic()
+        with open(self.drainname()) as spf:
+            lines = iter(spf)
+            for line in lines:
+                if self.closing:
+                    # keep the rest for next time
+                    self._keep(kept + [line] + list(lines))
+                    return
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    with self.cond:
+                        self.spilled -= 1
+                    continue
+                devname = item["devname"]
+                inverter = self.lookup(devname)
+                if devname not in waiting and inverter is not None and \
+                   not inverter.outputs_open and \
+                   not inverter.outputs_closed:
+                    since = self.holding.setdefault(devname, now)
+                    if now - since > SINK_HOLDTIME:
+                        expired.add(devname)
+                    waiting.add(devname)
+                if devname in waiting and devname not in expired:
+                    kept.append(line)
+                    continue
+                with self.cond:
+                    self.spilled -= 1
+                if devname in expired or inverter is None or \
+                   inverter.outputs_closed:
+                    with self.cond:
+                        self.dropped += 1
+                    continue
+                self._write(inverter,
+                            datetime.datetime.fromtimestamp(item["tstamp"]),
+                            item["stats"], time.time() - item["tstamp"])
+        for devname in expired:
+            LOG.warning("Gave up waiting for %s to be ready for its spilled "
+                        "%s samples, dropping them", devname, self.sink)
+        self.holding = dict([(devname, since) for devname, since in
+                             self.holding.items()
+                             if devname in waiting])
+        if kept:
+            self._keep(kept)
+            with self.cond:
+                self.drainat = time.monotonic() + SINK_DRAINRETRY
+        else:
+            os.remove(self.drainname())
+
+    def run(self):
+        """ The worker thread """
+        while True:
+            drain = False
+            with self.cond:
+                while not (self.queue or self.closing or
+                           (self.spilled and
+                            time.monotonic() >= self.drainat)):
+                    self.cond.wait(max(self.drainat - time.monotonic(), 0)
+                                   if self.spilled else None)
+                if self.queue:
+                    enq, inverter, tstamp, stats = self.queue.popleft()
+                elif self.spilled and not self.closing:
+                    # what's left of the last pass goes first
+                    try:
+                        self._gather()
+                    except OSError as exc:
+                        LOG.error("Unable to write out %s, dropping it: "
+                                  "%s", self.spillname, exc)
+                        self.dropped += self.spilled
+                        self.spilled = 0
+                        continue
+                    drain = True
+                else:
+                    break
+                self.cond.notify_all()
+            if drain:
+                try:
+                    self._drain()
+                except OSError as exc:
+                    LOG.error("Unable to write out %s, dropping it: %s",
+                              self.drainname(), exc)
+                    with self.cond:
+                        self.dropped += self.spilled
+                        self.spilled = 0
+                continue
+            self._write(inverter, tstamp, stats, time.monotonic() - enq)
+            with self.cond:
+                self._done(inverter)
+                self.cond.notify_all()
+
+
+class Dispatcher():
+    """ Fans samples out to a SinkQueue per sink """
+
+    def __init__(self, spooldir, lookup, policies=None, maxlen=SINK_QUEUELEN):
+        try:
+            os.makedirs(spooldir, exist_ok=True)
+        except OSError as exc:
+            LOG.error("Unable to create spool directory %s, so nothing "
+                      "can be spilled: %s", spooldir, exc)
+            spooldir = None
+        self.spooldir = spooldir
+        self.queues = {}
+        for sink in SINK_POLICIES:
+            self.queues[sink] = SinkQueue(sink, SINK_POLICIES[sink], maxlen,
+                                          spooldir, lookup)
+        self.configure(policies)
+
+    def configure(self, policies):
+        """ Applies the (reloaded) policy for each sink """
+        policies = policies or {}
+        for sink, queue in self.queues.items():
+            with queue.cond:
+                queue.policy = policies.get(sink, SINK_POLICIES[sink])
+                queue.cond.notify_all()
+
+    def start(self):
+        """ Starts the workers """
+        for queue in self.queues.values():
+            queue.start()
+
+    def put(self, inverter, tstamp, stats):
+        """ Queues a sample for every sink """
+        for queue in self.queues.values():
+            queue.put(inverter, tstamp, stats)
+
+    def flush(self, inverter, timeout=SINK_FLUSHTIMEOUT):
+        """ Waits until every sink has written this inverter's samples """
+        deadline = time.monotonic() + timeout
+        for sink, queue in self.queues.items():
+            if not queue.flush(inverter, max(deadline - time.monotonic(), 0)):
+                LOG.warning("Gave up waiting for the %s sink to write the "
+                            "samples from %s", sink, inverter.hr_serial)
+
+    def metrics(self):
+        """ Returns each sink's metrics, by sink """
+        return dict([(sink, queue.metrics())
+                     for sink, queue in self.queues.items()])
+
+    def close(self):
+        """ Writes out what's queued, and stops the workers """
+        for queue in self.queues.values():
+            queue.close()
@@ -0,0 +1,180 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Site totals across all of the inverters, kept up to date as each
+sample arrives.
+
+SiteAggregator holds each inverter's latest sample and running sums
+over them, so a new sample only replaces that inverter's contribution
+rather than adding everything up again. Once every inverter we've
+heard from recently (or which has just started, see track()) has
+reported for a poll slot, or the first sample for a later slot
+arrives if some haven't, the slot's totals are
+handed to the publish callback as if they were a sample from a
+single inverter:
+
+    powerGenerated, current   summed
+    energyGenerated           summed (each inverter's daily total)
+    temperature               weighted by each inverter's power
+    voltageDC, voltageAC      averaged
+
+An inverter which hasn't reported for the stale window stops counting
+towards the power, current, temperature and voltages, so a dead
+inverter doesn't hold the site's power up. Its energy for the day has
+still been generated, though, so that stays in the total until the
+day changes.
+"""
+
+import collections
+import datetime
+import threading
+import time
+
+from jfyDefinitions import JFYData
+
+
+# The fields which are summed; the rest are averaged
+_SUMMED = ["powerGenerated", "current"]
+_AVERAGED = ["voltageDC", "voltageAC"]
+
+
+class SiteAggregator():
+    """ Maintains the site's totals, publishing one sample per slot """
+
+    def __init__(self, stale, publish):
+        self.stale = stale       # seconds after which an inverter drops out
+        self.publish = publish   # called with (tstamp, stats), in order
+        # serial -> (secs, stats), oldest first
+        self.latest = collections.OrderedDict()
+        self.sums = dict([(fname, 0) for fname in
+                          _SUMMED + _AVERAGED + ["weightedtemp",
+                                                 "temperature"]])
+        self.energy = {}         # serial -> today's energyGenerated
+        self.energysum = 0
+        self.day = None          # the date of self.slot
+        self.slot = None         # epoch seconds of the slot we're filling
+        self.reported = set()    # serials which have reported for it
+        self.joining = {}        # serial -> when tracked, until it reports
+        self.emitted = None      # the last slot we published
+        self.lock = threading.Lock()
+
+    def _contribute(self, stats, sign):
+        """ Adds (sign 1) or removes (sign -1) a sample from the sums """
+        for fname in _SUMMED + _AVERAGED + ["temperature"]:
+            self.sums[fname] += sign * stats[fname]
+        self.sums["weightedtemp"] += \
+            sign * stats["temperature"] * stats["powerGenerated"]
+
+    def track(self, serial):
+        """ Expects samples from an inverter which has just started """
+        with self.lock:
+            if serial not in self.latest:
+                self.joining[serial] = time.time()
+
+    def forget(self, serial):
+        """ Stops counting an inverter which has stopped """
+        with self.lock:
+            self.joining.pop(serial, None)
+            previous = self.latest.pop(serial, None)
+            if previous is not None:
+                self._contribute(previous[1], -1)
+            self.reported.discard(serial)
+
+    def _expire(self, now):
+        """ Drops the inverters which haven't reported since now - stale """
+        while self.latest:
+            serial, (secs, stats) = next(iter(self.latest.items()))
+            if secs >= now - self.stale:
+                break
+            self._contribute(stats, -1)
+            del self.latest[serial]
+            self.reported.discard(serial)
+        for serial, since in list(self.joining.items()):
+            if since < now - self.stale:
+                del self.joining[serial]
+
+    def totals(self):
+        """ Returns the site's stats from the current sums """
+        count = len(self.latest)
+        if not count:
+            return None
+        power = self.sums["powerGenerated"]
+        stats = {}
+        for fname in _SUMMED:
+            stats[fname] = self.sums[fname]
+        for fname in _AVERAGED:
+            stats[fname] = round(self.sums[fname] / count)
+        if power > 0:
+            stats["temperature"] = round(self.sums["weightedtemp"] / power)
+        else:
+            stats["temperature"] = round(self.sums["temperature"] / count)
+        stats["energyGenerated"] = self.energysum
+        return dict([(fname, stats[fname]) for fname in JFYData])
+
+    def _emit(self):
+        """ Publishes the current slot; called with the lock held """
+        self.emitted = self.slot
+        stats = self.totals()
+        if stats is not None:
+            self.publish(datetime.datetime.fromtimestamp(self.slot), stats)
+
+    def add(self, serial, tstamp, stats):
+        """ Adds a datetime-stamped sample of (unscaled) stats """
+        secs = tstamp.timestamp()
+        with self.lock:
+            if self.slot is None or secs > self.slot:
+                # a new slot; publish the last one if we haven't yet
+                if self.slot is not None and self.emitted != self.slot:
+                    self._expire(self.slot)
+                    self._emit()
+                self.slot = secs
+                self.reported = set()
+                if tstamp.date() != self.day:
+                    self.day = tstamp.date()
+                    self.energy = {}
+                    self.energysum = 0
+            previous = self.latest.pop(serial, None)
+            if previous is not None:
+                self._contribute(previous[1], -1)
+            self.joining.pop(serial, None)
+            self.latest[serial] = (secs, stats)
+            if secs < self.slot:
+                # a late sample; keep self.latest in time order for
+                # _expire() by moving the newer ones after it
+                for other in [key for key, (osecs, _st) in
+                              self.latest.items() if osecs > secs]:
+                    self.latest.move_to_end(other)
+            self._contribute(stats, 1)
+            self.energysum += stats["energyGenerated"] - \
+                self.energy.get(serial, 0)
+            self.energy[serial] = stats["energyGenerated"]
+            if secs == self.slot:
+                self.reported.add(serial)
+            self._expire(self.slot)
+            if self.emitted != self.slot and \
+                    len(self.reported) >= len(self.latest) + len(self.joining):
+                # everyone we're expecting has reported
+                self._emit()
+
+    def flush(self):
+        """ Publishes the current slot if we haven't already """
+        with self.lock:
+            if self.slot is not None and self.emitted != self.slot:
+                self._emit()
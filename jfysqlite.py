@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+SQLite storage for the samples we write to the logfiles.
+
+The samples table is keyed on (serial, tstamp) and declared WITHOUT
+ROWID, so the table itself is the covering index for the usual "this
+inverter, this time range" query. tstamp is in seconds since the
+epoch, and the value columns hold the scaled values, named as in
+JFYData.
+
+The daemon never touches the database from the polling threads: they
+hand samples to SQLiteSink, which queues them for a single writer
+thread. The writer inserts them in batches of up to SQLITE_BATCHSIZE
+samples, committing at least every SQLITE_BATCHTIME seconds.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+from jfyDefinitions import (JFYData, JFYDivisors, SQLITE_BATCHSIZE,
+                            SQLITE_BATCHTIME, SQLITE_QUEUELEN)
+from jfylog import getlogger
+
+
+LOG = getlogger("sqlite")
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    serial TEXT NOT NULL,
+    tstamp INTEGER NOT NULL,
+    {0},
+    PRIMARY KEY (serial, tstamp)
+) WITHOUT ROWID
+""".format(",\n    ".join(["{0} REAL".format(fname) for fname in JFYData]))
+
+INSERT = "INSERT OR IGNORE INTO samples (serial, tstamp, {0}) " \
+    "VALUES (?, ?, {1})".format(", ".join(JFYData),
+                                ", ".join(["?"] * len(JFYData)))
+
+
+def connect(dbname):
+    """
+    Opens the database in WAL mode, creating the schema if necessary.
+    """
+    conn = sqlite3.connect(dbname, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL makes NORMAL safe against corruption; at worst we lose the
+    # last batch if the system crashes.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(SCHEMA)
+    return conn
+
+
+def insert_rows(conn, rows):
+    """
+    Inserts (serial, tstamp, value...) rows in a single transaction.
+    Rows which are already present are ignored.
+    """
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(INSERT, rows)
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def query_rows(dbname, serial, start, end):
+    """
+    Generator yielding (tstamp, values) for an inverter's samples
+    between the start and end epoch seconds (inclusive), with the
+    values in JFYData order. The database is opened read-only.
+    """
+    conn = sqlite3.connect("file:{0}?mode=ro".format(dbname), uri=True)
+    try:
+        cursor = conn.execute(
+            "SELECT tstamp, {0} FROM samples WHERE serial = ? AND "
+            "tstamp BETWEEN ? AND ? ORDER BY tstamp".format(
+                ", ".join(JFYData)), (serial, int(start), int(end)))
+        for row in cursor:
+            yield row[0], list(row[1:])
+    finally:
+        conn.close()
+
+
+def earliest(dbname, serial):
+    """ Returns the epoch seconds of an inverter's first sample, or None """
+    conn = sqlite3.connect("file:{0}?mode=ro".format(dbname), uri=True)
+    try:
+        return conn.execute("SELECT MIN(tstamp) FROM samples WHERE "
+                            "serial = ?", (serial,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+class SQLiteSink(threading.Thread):
+    """ Batches samples from any number of inverters into SQLite """
+
+    def __init__(self, dbname, debug=False):
+        self.dbname = dbname
+        self.debug = debug
+        self.queue = queue.Queue(maxsize=SQLITE_QUEUELEN)
+        self.dropped = 0         # samples dropped because we fell behind
+        threading.Thread.__init__(self, name="sqlite-" + dbname,
+                                  daemon=True)
+
+    def put(self, serial, tstamp, stats):
+        """
+        Queues a datetime-stamped sample of (unscaled) JFYData stats.
+        This never blocks: if the writer has fallen SQLITE_QUEUELEN
+        samples behind, the sample is dropped.
+        """
+        row = [serial, int(tstamp.timestamp())]
+        row.extend([stats[fname] / JFYDivisors[idx]
+                    for idx, fname in enumerate(JFYData)])
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ Flushes anything still queued and stops the writer """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        """ The writer thread """
+        conn = connect(self.dbname)
+        running = True
+        while running:
+            # Wait as long as we like for the first row of a batch...
+            row = self.queue.get()
+            if row is None:
+                break
+            batch = [row]
+            # ... then gather more until the batch is full or old
+            deadline = time.monotonic() + SQLITE_BATCHTIME
+            while len(batch) < SQLITE_BATCHSIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    running = False
+                    break
+                batch.append(row)
+            try:
+                insert_rows(conn, batch)
+            except sqlite3.Error as exc:
+                LOG.error("Unable to insert %s samples into %s: %s",
+                          len(batch), self.dbname, exc)
+                continue
+            LOG.debug("Inserted %s samples into %s (%s dropped)",
+                      len(batch), self.dbname, self.dropped)
+        conn.close()
@@ -0,0 +1,410 @@
+#! /usr/bin/python3
+
+#
+# Copyright (c) 2021 James C. McPherson.  All Rights Reserved
+#
+
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Compressed long-term storage for JFYData series, after the scheme in
+Facebook's "Gorilla" paper: timestamps are stored as delta-of-deltas
+and each value is XORed with the previous value for that field, so a
+field that doesn't change costs a single bit.
+
+Each inverter gets a pair of files in the store directory:
+
+  <serial>.blk   fixed-size (TSDB_BLOCKSIZE) blocks of encoded samples
+  <serial>.idx   one (first timestamp, last timestamp, sample count)
+                 entry per block, in block order
+
+Blocks are only ever appended, and are only decoded when a query
+needs them, so a query over years of data for many inverters only
+ever holds one block per inverter in memory.
+
+Values are the scaled values (as written by getline), in JFYData
+order. Timestamps are whole seconds since the epoch.
+
+To dump part of a store as CSV:
+
+$ jfytsdb.py [-s serial] [-f YYYY-MM-DD] [-t YYYY-MM-DD] /path/to/store
+"""
+
+import bisect
+import datetime
+import getopt
+import heapq
+import os
+import struct
+import sys
+
+from jfyDefinitions import JFYData, JFYDivisors, TSDB_BLOCKSIZE
+
+
+# A block is a 2 byte sample count followed by the bitstream
+_BLOCKHDR = struct.Struct("!H")
+_IDXENTRY = struct.Struct("!qqI")
+_BLOCKBITS = (TSDB_BLOCKSIZE - _BLOCKHDR.size) * 8
+
+# Worst case encoding of a sample: the largest timestamp bucket plus
+# a full-width XOR for every field.
+_MAXSAMPLEBITS = (4 + 32) + len(JFYData) * (2 + 5 + 6 + 64)
+
+# Delta-of-delta buckets: (control bits, control length, value bits)
+_DOD_BUCKETS = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+    (0b1111, 4, 32)
+]
+
+
+def _float_bits(value):
+    """ Returns the IEEE754 representation of value as an integer """
+    return struct.unpack("!Q", struct.pack("!d", value))[0]
+
+
+def _bits_float(bits):
+    """ The inverse of _float_bits """
+    return struct.unpack("!d", struct.pack("!Q", bits))[0]
+
+
+def _signed(value, nbits):
+    """ Sign-extends an nbits two's complement value """
+    if value & (1 << (nbits - 1)):
+        return value - (1 << nbits)
+    return value
+
+
+class BitWriter():
+    """ Accumulates a bitstream, most significant bit first """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.acc = 0
+        self.nacc = 0
+
+    def write(self, value, nbits):
+        """ Appends the low nbits of value """
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.nacc += nbits
+        while self.nacc >= 8:
+            self.nacc -= 8
+            self.buf.append((self.acc >> self.nacc) & 0xff)
+        self.acc &= (1 << self.nacc) - 1
+
+    def __len__(self):
+        return len(self.buf) * 8 + self.nacc
+
+    def getvalue(self):
+        """ Returns the bitstream, padded out to a whole byte """
+        if self.nacc:
+            return bytes(self.buf) + bytes([self.acc << (8 - self.nacc)])
+        return bytes(self.buf)
+
+
+class BitReader():
+    """ Reads back a bitstream produced by BitWriter """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, nbits):
+        """ Returns the next nbits as an unsigned integer """
+        start = self.pos >> 3
+        end = (self.pos + nbits + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], "big")
+        shift = end * 8 - (self.pos + nbits)
+        self.pos += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+
+class BlockEncoder():
+    """ Encodes samples into a single block """
+
+    def __init__(self, tstamp, values):
+        self.writer = BitWriter()
+        self.writer.write(tstamp, 64)
+        self.prev = [_float_bits(val) for val in values]
+        for bits in self.prev:
+            self.writer.write(bits, 64)
+        # (leading zeros, meaningful bits) of the last XOR, per field
+        self.window = [None] * len(values)
+        self.first = tstamp
+        self.last = tstamp
+        self.delta = 0
+        self.count = 1
+
+    def has_room(self):
+        """ Can we be sure that another sample will fit? """
+        return len(self.writer) + _MAXSAMPLEBITS <= _BLOCKBITS
+
+    def append(self, tstamp, values):
+        """ Encodes a sample, which must be later than the last one """
+        wrt = self.writer
+        delta = tstamp - self.last
+        dod = delta - self.delta
+        if dod == 0:
+            wrt.write(0, 1)
+        else:
+            for ctrl, clen, vbits in _DOD_BUCKETS:
+                if -(1 << (vbits - 1)) <= dod < (1 << (vbits - 1)):
+                    wrt.write(ctrl, clen)
+                    wrt.write(dod, vbits)
+                    break
+        self.delta = delta
+        self.last = tstamp
+
+        for idx, val in enumerate(values):
+            bits = _float_bits(val)
+            xor = bits ^ self.prev[idx]
+            self.prev[idx] = bits
+            if xor == 0:
+                wrt.write(0, 1)
+                continue
+            lead = min(64 - xor.bit_length(), 31)
+            trail = (xor & -xor).bit_length() - 1
+            window = self.window[idx]
+            if window and lead >= window[0] and \
+               64 - window[0] - window[1] <= trail:
+                wrt.write(0b10, 2)
+                wrt.write(xor >> (64 - window[0] - window[1]), window[1])
+            else:
+                meaningful = 64 - lead - trail
+                wrt.write(0b11, 2)
+                wrt.write(lead, 5)
+                wrt.write(meaningful - 1, 6)
+                wrt.write(xor >> trail, meaningful)
+                self.window[idx] = (lead, meaningful)
+        self.count += 1
+
+    def getvalue(self):
+        """ Returns the block, padded out to TSDB_BLOCKSIZE """
+        data = _BLOCKHDR.pack(self.count) + self.writer.getvalue()
+        return data + bytes(TSDB_BLOCKSIZE - len(data))
+
+
+def decode_block(data, nfields=len(JFYData)):
+    """ Generator yielding (timestamp, values) from an encoded block """
+    count = _BLOCKHDR.unpack_from(data)[0]
+    rdr = BitReader(memoryview(data)[_BLOCKHDR.size:])
+    tstamp = rdr.read(64)
+    prev = [rdr.read(64) for _idx in range(nfields)]
+    yield tstamp, [_bits_float(bits) for bits in prev]
+
+    window = [None] * nfields
+    delta = 0
+    for _sample in range(1, count):
+        if rdr.read(1) == 0:
+            dod = 0
+        else:
+            for ctrl, clen, vbits in _DOD_BUCKETS[:-1]:
+                # we've already consumed the leading 1 of the control
+                if rdr.read(1) == 0:
+                    break
+            else:
+                ctrl, clen, vbits = _DOD_BUCKETS[-1]
+            dod = _signed(rdr.read(vbits), vbits)
+        delta += dod
+        tstamp += delta
+
+        for idx in range(nfields):
+            if rdr.read(1) == 0:
+                continue
+            if rdr.read(1) == 0:
+                lead, meaningful = window[idx]
+            else:
+                lead = rdr.read(5)
+                meaningful = rdr.read(6) + 1
+                window[idx] = (lead, meaningful)
+            prev[idx] ^= rdr.read(meaningful) << (64 - lead - meaningful)
+        yield tstamp, [_bits_float(bits) for bits in prev]
+
+
+def _paths(path, serial):
+    """ Returns the block and index file names for this serial """
+    base = os.path.join(path, serial)
+    return base + ".blk", base + ".idx"
+
+
+class TSDBWriter():
+    """
+    Appends the samples from one inverter to the store. Samples which
+    are not later than the last one written (eg after the clock has
+    been stepped backwards) are dropped.
+    """
+
+    def __init__(self, path, serial):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        blkname, idxname = _paths(path, serial)
+        self.idxfile = open(idxname, "ab")
+        nblocks = self.idxfile.tell() // _IDXENTRY.size
+        # Throw away any partial index entry, and any block data that
+        # never made it into the index.
+        self.idxfile.truncate(nblocks * _IDXENTRY.size)
+        self.blkfile = open(blkname, "ab")
+        self.blkfile.truncate(nblocks * TSDB_BLOCKSIZE)
+        self.last = None
+        if nblocks:
+            with open(idxname, "rb") as idxf:
+                idxf.seek((nblocks - 1) * _IDXENTRY.size)
+                self.last = _IDXENTRY.unpack(idxf.read(_IDXENTRY.size))[1]
+        self.encoder = None
+
+    def append(self, tstamp, stats):
+        """ Adds a datetime-stamped sample of (unscaled) JFYData stats """
+        secs = int(tstamp.timestamp())
+        if self.last is not None and secs <= self.last:
+            return
+        values = [stats[fname] / JFYDivisors[idx]
+                  for idx, fname in enumerate(JFYData)]
+        self.append_values(secs, values)
+
+    def append_values(self, secs, values):
+        """ Adds a sample of scaled values stamped with epoch seconds """
+        if self.encoder is None:
+            self.encoder = BlockEncoder(secs, values)
+        else:
+            self.encoder.append(secs, values)
+        self.last = secs
+        if not self.encoder.has_room():
+            self.flush()
+
+    def flush(self):
+        """ Seals the current block and writes it to the store """
+        if self.encoder is None:
+            return
+        enc = self.encoder
+        self.encoder = None
+        self.blkfile.write(enc.getvalue())
+        self.blkfile.flush()
+        self.idxfile.write(_IDXENTRY.pack(enc.first, enc.last, enc.count))
+        self.idxfile.flush()
+
+    def close(self):
+        """ Flushes any partial block and closes the files """
+        self.flush()
+        self.blkfile.close()
+        self.idxfile.close()
+
+
+class TSDBReader():
+    """ Queries the store; blocks are read and decoded lazily. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def serials(self):
+        """ Returns the serial numbers of the inverters in the store """
+        return sorted([fname[:-4] for fname in os.listdir(self.path)
+                       if fname.endswith(".idx")])
+
+    def index(self, serial):
+        """ Returns the list of index entries for this serial """
+        _blkname, idxname = _paths(self.path, serial)
+        with open(idxname, "rb") as idxf:
+            data = idxf.read()
+        return [_IDXENTRY.unpack_from(data, off)
+                for off in range(0, len(data) - _IDXENTRY.size + 1,
+                                 _IDXENTRY.size)]
+
+    def earliest(self, serial):
+        """ Returns the epoch seconds of this serial's first sample """
+        index = self.index(serial)
+        return index[0][0] if index else None
+
+    def query(self, serial, start=None, end=None, fields=None):
+        """
+        Generator yielding (datetime, values) for this serial between
+        the start and end datetimes (inclusive). If fields is given,
+        only those JFYData fields are returned, in the order given.
+        """
+        lowest = int(start.timestamp()) if start else None
+        highest = int(end.timestamp()) if end else None
+        if fields:
+            cols = [JFYData.index(fname) for fname in fields]
+        else:
+            cols = None
+
+        index = self.index(serial)
+        first = 0
+        if lowest is not None:
+            # The first block that could contain lowest
+            lasts = [entry[1] for entry in index]
+            first = bisect.bisect_left(lasts, lowest)
+        blkname, _idxname = _paths(self.path, serial)
+        with open(blkname, "rb") as blkf:
+            for blockno in range(first, len(index)):
+                if highest is not None and index[blockno][0] > highest:
+                    break
+                blkf.seek(blockno * TSDB_BLOCKSIZE)
+                block = blkf.read(TSDB_BLOCKSIZE)
+                for secs, values in decode_block(block):
+                    if lowest is not None and secs < lowest:
+                        continue
+                    if highest is not None and secs > highest:
+                        break
+                    if cols is not None:
+                        values = [values[col] for col in cols]
+                    yield datetime.datetime.fromtimestamp(secs), values
+
+    def query_many(self, serials=None, start=None, end=None, fields=None):
+        """
+        Generator yielding (datetime, serial, values) for several
+        inverters at once, merged in timestamp order.
+        """
+        if serials is None:
+            serials = self.serials()
+
+        def tagged(serial):
+            for tstamp, values in self.query(serial, start, end, fields):
+                yield tstamp, serial, values
+
+        return heapq.merge(*[tagged(serial) for serial in serials],
+                           key=lambda sample: sample[0])
+
+
+def main():
+    """ Dumps (part of) a store to stdout as CSV """
+    try:
+        lopts, extra = getopt.getopt(sys.argv[1:], "s:f:t:")
+    except getopt.GetoptError:
+        lopts, extra = [], []
+    if len(extra) != 1:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    dopts = dict(lopts)
+    start = end = None
+    if "-f" in dopts:
+        start = datetime.datetime.strptime(dopts["-f"], "%Y-%m-%d")
+    if "-t" in dopts:
+        end = datetime.datetime.strptime(dopts["-t"], "%Y-%m-%d") + \
+            datetime.timedelta(days=1, seconds=-1)
+    serials = [dopts["-s"]] if "-s" in dopts else None
+
+    reader = TSDBReader(extra[0])
+    for tstamp, serial, values in reader.query_many(serials, start, end):
+        line = serial + "," + \
+            datetime.date.strftime(tstamp, "%Y-%m-%dT%H:%M:%S")
+        for val in values:
+            line = line + "," + "{0}".format(val)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
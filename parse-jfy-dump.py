@@ -1,9 +1,28 @@
 #!/usr/bin/python3.4
 
+"""
+Decodes the JFY frames in a raw serial capture.
+
+$ parse-jfy-dump.py [-i] [-n N[:M]] [-f func] capture
+
+    -i   list the frames from the capture's index rather than
+         decoding them
+    -n   only decode frame N (numbered from 0), or frames N to M
+    -f   only decode frames with this function code (eg 0xbd)
+
+With any of these options the capture is indexed first (see
+jfycapture.py), into a sidecar <capture>.idx which later runs reuse,
+so looking something up in a large capture doesn't mean scanning the
+whole of it again.
+"""
+
+import getopt
 import os
 import struct
 import sys
 
+from jfycapture import CaptureIndex, IDX_RX, IDX_CSUMOK, scan_frames
+
 pkthead = 0xA5A5
 pktend = 0x0A0D
 
@@ -220,7 +239,7 @@ def DecodeStringData(vals=None):
     for n in range(0, len(vals)):
         if vals[n] < 0x20 or vals[n] > 0x7f:
             rstr = rstr + "{:02x}".format(vals[n])
-        elif vals[n] is 0x20:
+        elif vals[n] == 0x20:
             rstr = rstr + "."
         else:
             rstr = rstr + "{:s}".format(chr(int(vals[n])))
@@ -274,13 +293,13 @@ def parsepkt(pkt=None):
     hmsg = "{0} {1:=02X} {2} {3:=02X} {4} {5:=02X} ({6})".format(
         "Source", pkt[2], "Destination", pkt[3], "Control Op",
         pkt[4], ctrlop[pkt[4]])
-    if pkt[4] is 0x30:
+    if pkt[4] == 0x30:
         if pkt[5] < 0x50:
             # horrible hack
             desc = register_funcs
         else:
             desc = register_resps
-    elif pkt[4] is 0x31:
+    elif pkt[4] == 0x31:
         if pkt[5] < 0x50:
             # horrible hack
             desc = read_funcs
@@ -303,7 +322,7 @@ def parsepkt(pkt=None):
 
     tpkt = bytearray(pkt[7:plen - 5])
     print("Packet data: ({0} bytes)\n".format(pkt[6]))
-    if pkt[5] is 0xbd:
+    if pkt[5] == 0xbd:
         print("{0}\n".format(DecodeData(tpkt, True)))
         print("{0}\n".format(DecodeData(tpkt, False)))
     else:
@@ -311,23 +330,67 @@ def parsepkt(pkt=None):
         # for now...
 
 
+def usage():
+    """ Provides the usage statement for the utility """
+    print(__doc__, file=sys.stderr)
+    sys.exit(1)
+
+
+def listframes(index, nums):
+    """ Prints the index entries for the numbered frames """
+    print("{0:>8s} {1:>12s} {2:>6s} {3:15s} {4:>4s} {5:>4s} {6:>4s} "
+          "{7:>4s} {8:s}".format("frame", "offset", "length", "direction",
+                                 "src", "dest", "ctrl", "func", "checksum"))
+    for num in nums:
+        offset, length, src, dest, ctrl, func, flags = index.entry(num)
+        print("{0:8d} {1:12d} {2:6d} {3:15s} {4:4X} {5:4X} {6:4X} {7:4X} "
+              "{8:s}".format(num, offset, length,
+                             "inverter->ap" if flags & IDX_RX
+                             else "ap->inverter", src, dest, ctrl, func,
+                             "ok" if flags & IDX_CSUMOK else "BAD"))
+
+
+def lookup(capname, dopts):
+    """ Finds the frames asked for through the index """
+    index = CaptureIndex(capname)
+    nums = range(len(index))
+    if "-n" in dopts:
+        first, _sep, last = dopts["-n"].partition(":")
+        first = int(first)
+        last = int(last) if last else first
+        nums = range(max(first, 0), min(last + 1, len(index)))
+        if not nums:
+            print("There are only {0} frames in {1}".format(
+                len(index), capname), file=sys.stderr)
+    if "-f" in dopts:
+        nums = [num for num in index.find(func=int(dopts["-f"], 0))
+                if num in nums]
+    if "-i" in dopts:
+        listframes(index, nums)
+    else:
+        for num in nums:
+            print("Frame {0}:".format(num))
+            parsepkt(index.frame(num))
+    index.close()
+
+
 if __name__ == "__main__":
-    inf = open(sys.argv[1], "rb")
-    binf = bytearray(inf.read())
-    # basic loop:
-    i = 0
-    while i < len(binf):
-        if binf[i] == 0xa5 and binf[i+1] == 0xa5:
-            pkt = list()
-            dlen = binf[i+6]
-            tlen = headerlen + taillen + dlen
-            for j in range(0, tlen):
-                pkt.append(binf[i + j])
-                
-            #while binf[i] != 0x0a and binf[i+1] != 0x0d:
-            #    pkt.append(binf[i])
-            #    i = i + 1
-                # don't forget the end bytes
-            parsepkt(pkt)
-            del pkt
-        i = i + 1
+    try:
+        lopts, extra = getopt.getopt(sys.argv[1:], "in:f:")
+    except getopt.GetoptError:
+        usage()
+    dopts = dict(lopts)
+    if len(extra) != 1:
+        usage()
+    if dopts:
+        try:
+            lookup(extra[0], dopts)
+        except ValueError:
+            usage()
+        sys.exit(0)
+    with open(extra[0], "rb") as inf:
+        binf = inf.read()
+    # the same frames, numbered the same way, as the index (and so -n)
+    for num, (_offset, pkt) in enumerate(scan_frames(binf)):
+        print("Frame {0}:".format(num))
+        parsepkt(pkt)